@@ -0,0 +1,90 @@
+"""Maintenance of the campaigns statistics aggregates.
+
+Usage:
+    python -m api.commands.campaign_stats rebuild [CAMPAIGN_ID ...]
+    python -m api.commands.campaign_stats check [CAMPAIGN_ID ...]
+
+The rebuild action recomputes the aggregates of the campaigns from their records.
+The check action compares the persisted aggregates with the ones computed from the records,
+and exits with an error status if some campaigns are not consistent.
+"""
+import argparse
+import asyncio
+import math
+import sys
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from api.db import engine
+from api.models.domain import Campaign
+from api.services.campaign_stats import CampaignStatsService
+from api.services.records import RecordService
+from api.services.stats.accumulators import StatsAggregates
+
+
+async def rebuild(session: AsyncSession, campaigns: list[Campaign]) -> None:
+    """Rebuild the statistics aggregates of the campaigns"""
+    service = RecordService(session)
+    for campaign in campaigns:
+        await service.rebuild_campaign_stats(campaign.id, campaign.company_id)
+        await session.commit()
+        print(f"Campaign {campaign.id}: rebuilt")
+
+
+async def check(session: AsyncSession, campaigns: list[Campaign]) -> bool:
+    """Check the statistics aggregates of the campaigns against their records"""
+    consistent = True
+    for campaign in campaigns:
+        entity = await CampaignStatsService(session).get(campaign.id)
+        if entity is None:
+            print(f"Campaign {campaign.id}: no aggregates")
+            continue
+        expected = await RecordService(session).compute_campaign_stats(campaign.id)
+        actual = StatsAggregates.from_dict(entity.data)
+        if _equals(_canonical(expected.to_stats().model_dump()), _canonical(actual.to_stats().model_dump())):
+            print(f"Campaign {campaign.id}: OK")
+        else:
+            print(f"Campaign {campaign.id}: inconsistent")
+            consistent = False
+    return consistent
+
+
+def _canonical(obj):
+    """Sort lists, as the order of the entries depends on the records order"""
+    if isinstance(obj, dict):
+        return {key: _canonical(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return sorted((_canonical(item) for item in obj), key=repr)
+    return obj
+
+
+def _equals(obj1, obj2) -> bool:
+    """Compare statistics, with a tolerance for floats summed in a different order"""
+    if isinstance(obj1, dict) and isinstance(obj2, dict):
+        return obj1.keys() == obj2.keys() and all(_equals(obj1[key], obj2[key]) for key in obj1)
+    if isinstance(obj1, list) and isinstance(obj2, list):
+        return len(obj1) == len(obj2) and all(_equals(item1, item2) for item1, item2 in zip(obj1, obj2))
+    if isinstance(obj1, float) or isinstance(obj2, float):
+        return math.isclose(obj1, obj2, rel_tol=1e-6, abs_tol=1e-2)
+    return obj1 == obj2
+
+
+async def main(action: str, campaign_ids: list[int]) -> int:
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        query = select(Campaign).order_by(Campaign.id)
+        if campaign_ids:
+            query = query.where(Campaign.id.in_(campaign_ids))
+        campaigns = (await session.exec(query)).all()
+        if action == "rebuild":
+            await rebuild(session, campaigns)
+            return 0
+        return 0 if await check(session, campaigns) else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Maintenance of the campaigns statistics aggregates")
+    parser.add_argument("action", choices=["rebuild", "check"])
+    parser.add_argument("campaign_ids", nargs="*", type=int,
+                        help="Campaigns to process, all if not specified")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.action, args.campaign_ids)))
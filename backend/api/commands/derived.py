@@ -0,0 +1,52 @@
+"""Maintenance of the records derived metrics.
+
+Usage:
+    python -m api.commands.derived backfill [CAMPAIGN_ID ...] [--batch-size BATCH_SIZE]
+
+The backfill action computes the derived metrics of the records that have none, or that have
+metrics of a previous version. The snapshots of the updated campaigns are deleted, to be written
+again with the derived metrics.
+"""
+import argparse
+import asyncio
+import sys
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from api.config import config
+from api.db import engine
+from api.models.domain import Campaign
+from api.services.records import RecordService
+from api.services.snapshots import RecordSnapshotService
+
+
+async def backfill(session: AsyncSession, campaigns: list[Campaign], batch_size: int) -> None:
+    """Compute the missing or outdated derived metrics of the records of the campaigns"""
+    service = RecordService(session)
+    for campaign in campaigns:
+        count = await service.backfill_derived(campaign.id, batch_size)
+        if count > 0 and config.SNAPSHOTS_PATH:
+            RecordSnapshotService(session).delete(campaign.id)
+        print(f"Campaign {campaign.id}: {count} records updated")
+
+
+async def main(action: str, campaign_ids: list[int], batch_size: int) -> int:
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        query = select(Campaign).order_by(Campaign.id)
+        if campaign_ids:
+            query = query.where(Campaign.id.in_(campaign_ids))
+        campaigns = (await session.exec(query)).all()
+        if action == "backfill":
+            await backfill(session, campaigns, batch_size)
+        return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Maintenance of the records derived metrics")
+    parser.add_argument("action", choices=["backfill"])
+    parser.add_argument("campaign_ids", nargs="*", type=int,
+                        help="Campaigns to process, all if not specified")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="Records updated per transaction")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.action, args.campaign_ids, args.batch_size)))
@@ -27,6 +27,13 @@ class Config(BaseSettings):
 
     PATH_PREFIX: str = "/api"
 
+    # Statistics
+    STATS_CACHE_SIZE: int = 128  # 0 to disable
+    STATS_POOL_SIZE: int = 2  # worker processes, 0 to compute in the API process
+    STATS_POOL_QUEUE_SIZE: int = 8  # computations waiting for a worker, beyond which 503 is returned
+    RECORD_STATS_POOL_SIZE: int = 1  # worker processes of the record writes statistics, 0 to compute in the API process
+    SNAPSHOTS_PATH: str | None = None  # directory of the campaigns records snapshots, None to disable
+
     @model_validator(mode="before")
     def form_db_url(cls, values: dict) -> dict:
         """Form the DB URL from the settings"""
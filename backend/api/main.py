@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, status, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from api.config import config
@@ -14,10 +15,20 @@ from api.views.users import router as users_router
 from api.views.collect import router as collect_router
 from api.views.stats import router as stats_router
 from api.views.isochrones import router as isochrones_router
+from api.services.stats.pool import stats_pool, record_stats_pool
 
 basicConfig(level=DEBUG)
 
-app = FastAPI(root_path=config.PATH_PREFIX)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # stop the statistics worker processes
+    stats_pool.shutdown()
+    record_stats_pool.shutdown()
+
+
+app = FastAPI(root_path=config.PATH_PREFIX, lifespan=lifespan)
 
 origins = ["*"]
 
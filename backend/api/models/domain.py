@@ -1,10 +1,29 @@
 from typing import List, Dict, Optional
 from sqlmodel import SQLModel, Field, Relationship, Column
 from sqlalchemy.dialects.postgresql import JSONB as JSON
-from sqlalchemy import TIMESTAMP
+from sqlalchemy import TIMESTAMP, Boolean, Computed, Float, Index, String
 from datetime import datetime
 from pydantic import BaseModel
 
+# JSON text values that can be converted to a number, others are considered missing: digits and exponent are
+# bounded, out of range values would fail the conversion, and so the records writes
+NUMBER_PATTERN = r'^\s*[-+]?(\d{1,20}(\.\d{0,30})?|\.\d{1,30})([eE][-+]?\d{1,2})?\s*$'
+
+
+def json_number_sql(column: str, field: str, key: str) -> str:
+    """SQL expression of a JSON nested number, null if it is missing or not numeric"""
+    value = f"(({column} -> '{field}') ->> '{key}')"
+    return f"(CASE WHEN {value} ~ '{NUMBER_PATTERN}' THEN CAST({value} AS FLOAT) END)"
+
+
+# First recommended mode of a record, typo.reco.reco_dt2[0]: records having one are completed
+RECO_PRIMARY_SQL = "(typo #>> '{reco,reco_dt2,0}')"
+
+
+def generated_column(column_type, sql: str, index: bool = False) -> Column:
+    """Column computed by the database from the record JSON fields, to filter records without scanning them"""
+    return Column(column_type, Computed(sql, persisted=True), index=index)
+
 # Base classes
 
 
@@ -103,6 +122,10 @@ class Campaign(CampaignBase, table=True):
     workplaces: list["Workplace"] = Relationship(
         back_populates="campaign", cascade_delete=True)
 
+    __table_args__ = (
+        Index("ix_campaign_slug", "slug"),
+    )
+
 
 class ParticipantBase(TimestampMixin):
     token: str = Field(default=None, unique=True)
@@ -118,8 +141,11 @@ class Participant(ParticipantBase, table=True):
         primary_key=True,
         index=True,
     )
-    campaign_id: int = Field(default=None, foreign_key="campaign.id")
+    campaign_id: int = Field(
+        default=None, foreign_key="campaign.id", index=True)
     campaign: Campaign | None = Relationship(back_populates="participants")
+    # identifiers are also searched with a trigram index, ix_participant_identifier_trgm, that is only
+    # created by migration as it requires the pg_trgm extension
 
 
 class WorkplaceBase(SQLModel):
@@ -158,8 +184,59 @@ class Record(RecordBase, table=True):
         primary_key=True,
         index=True,
     )
-    campaign_id: int = Field(default=None, foreign_key="campaign.id")
-    company_id: int = Field(default=None, foreign_key="company.id")
+    campaign_id: int = Field(
+        default=None, foreign_key="campaign.id", index=True)
+    company_id: int = Field(
+        default=None, foreign_key="company.id", index=True)
+    # metrics computed from the data when the record is written, see compute_derived()
+    derived: Optional[Dict] = Field(default=None, sa_column=Column(JSON))
+    # generated columns, read-only
+    data_version: Optional[str] = Field(
+        default=None, sa_column=generated_column(String, "(data ->> 'version')", index=True))
+    reco_primary: Optional[str] = Field(
+        default=None, sa_column=generated_column(String, RECO_PRIMARY_SQL, index=True))
+    completed: Optional[bool] = Field(
+        default=None, sa_column=generated_column(Boolean, f"({RECO_PRIMARY_SQL} IS NOT NULL)", index=True))
+    origin_lat: Optional[float] = Field(
+        default=None, sa_column=generated_column(Float, json_number_sql("data", "origin", "lat")))
+    origin_lon: Optional[float] = Field(
+        default=None, sa_column=generated_column(Float, json_number_sql("data", "origin", "lon")))
+    workplace_lat: Optional[float] = Field(
+        default=None, sa_column=generated_column(Float, json_number_sql("data", "workplace", "lat")))
+    workplace_lon: Optional[float] = Field(
+        default=None, sa_column=generated_column(Float, json_number_sql("data", "workplace", "lon")))
+
+    __table_args__ = (
+        # records are created or updated by token
+        Index("ix_record_token", "token", unique=True),
+        Index("ix_record_origin_location", "origin_lat", "origin_lon"),
+        Index("ix_record_workplace_location",
+              "workplace_lat", "workplace_lon"),
+    )
+    # generated columns are read back when the record is written
+    __mapper_args__ = {"eager_defaults": True}
+
+
+# Fields of the records that are generated from their JSON fields
+RECORD_GENERATED_FIELDS = {'data_version', 'reco_primary', 'completed',
+                           'origin_lat', 'origin_lon', 'workplace_lat', 'workplace_lon'}
+
+
+class CampaignStats(SQLModel, table=True):
+    """Statistics aggregates of the records of a campaign, maintained on record writes."""
+    id: Optional[int] = Field(
+        default=None,
+        nullable=False,
+        primary_key=True,
+        index=True,
+    )
+    campaign_id: int = Field(
+        default=None, foreign_key="campaign.id", unique=True, ondelete="CASCADE")
+    company_id: int = Field(
+        default=None, foreign_key="company.id", ondelete="CASCADE")
+    data: Optional[Dict] = Field(default=None, sa_column=Column(JSON))
+    updated_at: Optional[datetime] = Field(
+        sa_column=TIMESTAMP(timezone=True), default=None)
 
 
 class DataEntryBase(Entity):
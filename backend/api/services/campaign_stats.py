@@ -0,0 +1,155 @@
+import asyncio
+from logging import exception
+from typing import Awaitable, Callable
+from api.db import AsyncSession
+from sqlmodel import select
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from api.models.domain import CampaignStats
+from api.models.query import Stats
+from api.services.stats.accumulators import InconsistentAggregatesError, StatsAggregates
+from datetime import datetime, timezone
+
+
+class CampaignStatsService:
+    """Persisted statistics aggregates per campaign.
+
+    Changes are not committed, they are part of the transaction of the record write.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def get(self, campaign_id: int) -> CampaignStats | None:
+        """Get the statistics aggregates of a campaign"""
+        res = await self.session.exec(
+            select(CampaignStats).where(
+                CampaignStats.campaign_id == campaign_id))
+        return res.one_or_none()
+
+    async def find(self, campaign_ids: list[int]) -> list[CampaignStats]:
+        """Get the statistics aggregates of some campaigns"""
+        res = await self.session.exec(
+            select(CampaignStats).where(
+                CampaignStats.campaign_id.in_(campaign_ids)))
+        return res.all()
+
+    async def lock(self, campaign_id: int, company_id: int) -> None:
+        """Lock the statistics aggregates of a campaign until the end of the transaction.
+
+        Their rebuilds and the deltas of the record writes are serialized, so that none is lost.
+        """
+        await self.session.exec(select(func.pg_advisory_xact_lock(campaign_id, company_id)))
+
+    async def save(self, campaign_id: int, company_id: int, aggregates: StatsAggregates) -> None:
+        """Create or replace the statistics aggregates of a campaign"""
+        values = {
+            "campaign_id": campaign_id,
+            "company_id": company_id,
+            "data": aggregates.to_dict(),
+            "updated_at": datetime.now(timezone.utc)
+        }
+        query = insert(CampaignStats).values(**values)
+        query = query.on_conflict_do_update(
+            index_elements=[CampaignStats.campaign_id], set_=values)
+        await self.session.exec(query)
+
+    async def apply(self, campaign_id: int, added: StatsAggregates, retracted: StatsAggregates) -> bool:
+        """Apply the delta of a record write to the statistics aggregates of a campaign.
+
+        Returns:
+            bool: False if the campaign has no statistics aggregates yet, or if they are stale.
+        """
+        res = await self.session.exec(
+            select(CampaignStats).where(
+                CampaignStats.campaign_id == campaign_id).with_for_update())
+        entity = res.one_or_none()
+        if not entity:
+            return False
+        aggregates = StatsAggregates.from_dict(entity.data)
+        try:
+            aggregates.retract(retracted).merge(added)
+        except InconsistentAggregatesError:
+            return False
+        entity.data = aggregates.to_dict()
+        entity.updated_at = datetime.now(timezone.utc)
+        return True
+
+    async def delete(self, campaign_id: int) -> None:
+        """Delete the statistics aggregates of a campaign, statistics are then computed from the records"""
+        entity = await self.get(campaign_id)
+        if entity:
+            await self.session.delete(entity)
+
+    async def get_stats(self, filter: dict, sections: list[str] = None) -> Stats | None:
+        """Get the statistics of the records of some campaigns from their aggregates.
+
+        Args:
+            filter (dict): The records filter, only campaign_id and company_id criteria are supported.
+            sections (list[str], optional): The statistics to finalize. Defaults to all.
+
+        Returns:
+            Stats: The statistics, None if they cannot be served from the aggregates.
+        """
+        if not filter or any(key not in ["campaign_id", "company_id"] for key in filter):
+            return None
+        campaign_ids = get_filter_ids(filter.get("campaign_id"))
+        if not campaign_ids:
+            return None
+        company_ids = None
+        if "company_id" in filter:
+            company_ids = get_filter_ids(filter["company_id"])
+            if not company_ids:
+                return None
+        entities = await self.find(campaign_ids)
+        if len(entities) != len(set(campaign_ids)):
+            # some campaigns are not aggregated
+            return None
+        aggregates = StatsAggregates()
+        for entity in entities:
+            if company_ids is None or entity.company_id in company_ids:
+                aggregates.merge(StatsAggregates.from_dict(entity.data))
+        return aggregates.to_stats(sections)
+
+
+class CampaignStatsRebuilds:
+    """Rebuilds of the campaigns statistics aggregates in the background, at most one pending per campaign."""
+
+    def __init__(self):
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def schedule(self, campaign_id: int, rebuild: Callable[[], Awaitable[None]]) -> None:
+        """Schedule the rebuild of the aggregates of a campaign, unless one is already pending"""
+        if campaign_id in self._tasks:
+            return
+        self._tasks[campaign_id] = asyncio.create_task(
+            self._run(campaign_id, rebuild))
+
+    async def wait(self) -> None:
+        """Wait for the pending rebuilds"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks.values())
+
+    async def _run(self, campaign_id: int, rebuild: Callable[[], Awaitable[None]]) -> None:
+        try:
+            await rebuild()
+        except Exception:
+            exception(f"Campaign {campaign_id} statistics aggregates rebuild failed")
+        finally:
+            del self._tasks[campaign_id]
+
+
+campaign_stats_rebuilds = CampaignStatsRebuilds()
+
+
+def get_filter_ids(criteria) -> list[int] | None:
+    """Get the ids of an equality or inclusion filter criteria, None if not supported"""
+    if isinstance(criteria, dict) and len(criteria) == 1:
+        if "$eq" in criteria:
+            criteria = criteria["$eq"]
+        elif "$in" in criteria:
+            criteria = criteria["$in"]
+    ids = criteria if isinstance(criteria, list) else [criteria]
+    if not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+        return None
+    return ids
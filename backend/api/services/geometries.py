@@ -0,0 +1,61 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import shapely
+from geojson_pydantic import MultiPolygon, Polygon
+from shapely.geometry.base import BaseGeometry
+
+
+class GeometryCache:
+    """LRU cache of prepared shapely geometries, keyed by the hash of their GeoJSON."""
+
+    def __init__(self, maxsize: int = 32):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, BaseGeometry] = OrderedDict()
+
+    def get(self, geometry: Polygon | MultiPolygon) -> BaseGeometry:
+        """Get the prepared shapely geometry of a GeoJSON polygon or multipolygon, interior rings included.
+
+        Raises:
+            ValueError: If the geometry is not a polygon nor a multipolygon.
+        """
+        if geometry.type not in ["Polygon", "MultiPolygon"]:
+            raise ValueError(
+                "Unsupported geometry type for workplace location filter")
+        geojson = geometry.model_dump_json(exclude_none=True)
+        key = hashlib.sha256(geojson.encode()).hexdigest()
+        prepared = self._entries.get(key)
+        if prepared is None:
+            prepared = shapely.from_geojson(geojson)
+            # prepared geometries build spatial indexes of their edges, for repeated containment tests
+            shapely.prepare(prepared)
+            self._entries[key] = prepared
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        self._entries.move_to_end(key)
+        return prepared
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+geometry_cache = GeometryCache()
+
+
+def contains_points(geometry: Polygon | MultiPolygon, lat: pd.Series, lon: pd.Series) -> np.ndarray:
+    """Test which points are inside a GeoJSON polygon or multipolygon, vectorized.
+
+    Points on the boundary, in a hole or having missing or invalid coordinates are not inside.
+
+    Args:
+        geometry (Polygon | MultiPolygon): The GeoJSON geometry.
+        lat (pd.Series): The points latitudes.
+        lon (pd.Series): The points longitudes.
+
+    Returns:
+        np.ndarray: A boolean mask of the points inside the geometry.
+    """
+    x = pd.to_numeric(lon, errors='coerce').to_numpy(dtype=float)
+    y = pd.to_numeric(lat, errors='coerce').to_numpy(dtype=float)
+    return shapely.contains_xy(geometry_cache.get(geometry), x, y)
@@ -0,0 +1,338 @@
+import json
+from api.db import AsyncSession
+from sqlalchemy import BigInteger, Float, String, case, cast, column, func, true, values
+from sqlalchemy.dialects.postgresql import JSONB, array
+from sqlmodel import select
+from api.models.domain import NUMBER_PATTERN, Record
+from api.models.query import Emissions, Frequencies, Frequency
+from api.services.records import RecordQueryBuilder
+from api.services.stats.accumulators import EmissionsAccumulator
+from api.services.stats.commons import MODES, format_value
+from api.services.stats.emissions import MODE_EMISSIONS, RECO_MODE_NAMES
+
+
+class RecordStatsService:
+    """Statistics computed in the database, without loading the records.
+
+    Like StatsService, only completed records (having a recommendation) are considered. Values having
+    the same count are in order of appearance in the records, by id, as in the loaded records DataFrame.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def count_completed(self, filter: dict) -> int:
+        """Count the completed records matching filter"""
+        query = select(func.count(Record.id)).where(
+            Record.id.in_(self._build_ids_query(filter)),
+            self._is_completed())
+        return (await self.session.exec(query)).one()
+
+    async def compute_equipments_frequencies(self, filter: dict, total: int = None) -> Frequencies:
+        """Compute equipments frequencies of the records matching filter."""
+        return await self._compute_array_frequencies(filter, 'equipments', 'equipments', total)
+
+    async def compute_constraints_frequencies(self, filter: dict, total: int = None) -> Frequencies:
+        """Compute constraints frequencies of the records matching filter."""
+        return await self._compute_array_frequencies(filter, 'constraints', 'constraints', total)
+
+    async def compute_travel_time_frequencies(self, filter: dict, total: int = None) -> Frequencies:
+        """Compute travel time frequencies of the records matching filter.
+
+        Values are formatted as FrequenciesService formats them, see format_value().
+        """
+        travel_time = Record.data['travel_time']
+        values = select(
+            func.jsonb_typeof(travel_time).label('type'),
+            travel_time.astext.label('value'),
+            Record.id.label('appearance')
+        ).where(
+            Record.id.in_(self._build_ids_query(filter)),
+            self._is_completed()).subquery()
+        first = func.min(values.c.appearance).label('first')
+        query = select(values.c.type, values.c.value, func.count().label('count'), first).where(
+            values.c.value.isnot(None)).group_by(values.c.type, values.c.value)
+        results = (await self.session.exec(query)).all()
+        if total is None:
+            total = await self.count_completed(filter)
+        # value -> [count, first appearance], values formatted the same are counted together
+        counts = {}
+        for row in results:
+            if row.type == 'number':
+                value = format_value(float(row.value))
+            else:
+                value = row.value if row.type == 'string' else str(json.loads(row.value))
+            entry = counts.setdefault(value, [0, row.first])
+            entry[0] += row.count
+            entry[1] = min(entry[1], row.first)
+        return Frequencies(
+            field='travel_time',
+            total=total,
+            data=[
+                Frequency(value=value, count=count)
+                for value, (count, _) in sorted(counts.items(), key=lambda item: (-item[1][0], item[1][1]))
+            ]
+        )
+
+    async def compute_recommendation_frequencies(self, filter: dict, total: int = None) -> Frequencies:
+        """Compute recommendation frequencies of the records matching filter."""
+        return await self._compute_value_frequencies(filter, self._get_recommendation(), 'reco_dt2', total)
+
+    async def compute_frequencies(self, filter: dict) -> list[Frequencies]:
+        """Compute equipments, constraints, travel time and recommendation frequencies, as in Stats.frequencies"""
+        total = await self.count_completed(filter)
+        return [
+            await self.compute_equipments_frequencies(filter, total),
+            await self.compute_constraints_frequencies(filter, total),
+            await self.compute_travel_time_frequencies(filter, total),
+            await self.compute_recommendation_frequencies(filter, total)
+        ]
+
+    async def compute_modes_emissions(self, filter: dict, apply_reco: bool = False) -> list[Emissions]:
+        """Compute all CO2 emissions of the records matching filter, as EmissionsService.compute_modes_emissions()"""
+        emissions = await self.accumulate_modes_emissions(filter, apply_reco)
+        return emissions.to_emissions(await self.count_completed(filter))
+
+    async def accumulate_modes_emissions(self, filter: dict, apply_reco: bool = False) -> EmissionsAccumulator:
+        """Accumulate all CO2 emissions of the records matching filter, without rounding."""
+        records = self._build_emissions_records_query(filter).cte('records')
+        # v1: count emissions from legacy fields
+        emissions = await self._accumulate_modes_emissions_v1(records, apply_reco)
+        # v2: count emissions from data.freq_mod_journeys
+        emissions.merge(await self._accumulate_modes_emissions_v2(records, apply_reco))
+        return emissions
+
+    #
+    # Internal functions
+    #
+
+    async def _compute_array_frequencies(self, filter: dict, key: str, field: str, total: int = None) -> Frequencies:
+        """Count the values of a JSON array in the records data"""
+        elements = func.jsonb_array_elements_text(self._to_array(Record.data[key])).table_valued(
+            'value', with_ordinality='position').render_derived().lateral()
+        # the flattened arrays are read by position, then by record
+        values = select(
+            elements.c.value,
+            array([elements.c.position, cast(Record.id, BigInteger)]).label('appearance')
+        ).select_from(Record).join(elements, true()).where(
+            Record.id.in_(self._build_ids_query(filter)),
+            self._is_completed()).subquery()
+        return await self._count_values(filter, values.c.value, values.c.appearance, field, total)
+
+    async def _compute_value_frequencies(self, filter: dict, value, field: str, total: int = None) -> Frequencies:
+        """Count the values of a JSON scalar in the records"""
+        values = select(value.label('value'), Record.id.label('appearance')).where(
+            Record.id.in_(self._build_ids_query(filter)),
+            self._is_completed()).subquery()
+        return await self._count_values(filter, values.c.value, values.c.appearance, field, total)
+
+    async def _count_values(self, filter: dict, value, appearance, field: str, total: int = None) -> Frequencies:
+        """Group and count non null values, most frequent first, then in order of appearance"""
+        count = func.count().label('count')
+        query = select(value, count).where(value.isnot(None)).group_by(
+            value).order_by(count.desc(), func.min(appearance))
+        results = (await self.session.exec(query)).all()
+        if total is None:
+            total = await self.count_completed(filter)
+        return Frequencies(
+            field=field,
+            total=total,
+            data=[
+                Frequency(
+                    value=value,
+                    count=count
+                )
+                for value, count in results
+            ]
+        )
+
+    async def _accumulate_modes_emissions_v1(self, records, apply_reco: bool = False) -> EmissionsAccumulator:
+        """Accumulate the emissions of the data.freq_mod_<mode> legacy fields, per mode and applied mode"""
+        modes = values(column('mode', String), name='modes').data(
+            [(mode,) for mode in MODES])
+        freq = self._to_number(func.jsonb_extract_path_text(
+            records.c.data, func.concat('freq_mod_', modes.c.mode)))
+        # replace non sustainable modes (car, moto) by recommended mode
+        applied_mode = records.c.applied_mode if apply_reco else modes.c.mode
+        first = func.min(records.c.id).label('first')
+        query = select(
+            modes.c.mode,
+            applied_mode.label('applied_mode'),
+            func.sum(records.c.distance_km).label('distances'),
+            func.sum(freq).label('freq'),
+            func.sum(freq * 45 * 2).label('journeys'),
+            func.sum(records.c.distance_km * freq * 45 * 2 *
+                     self._get_mode_emissions(applied_mode) / 1000).label('emissions'),
+            first
+        ).select_from(records).join(modes, true()).where(
+            records.c.version.is_(None),
+            freq.isnot(None)
+        ).group_by(modes.c.mode, applied_mode).order_by(first)
+        results = (await self.session.exec(query)).all()
+
+        emissions = EmissionsAccumulator()
+        for mode in MODES:
+            mode_results = [row for row in results if row.mode == mode]
+            if len(mode_results) == 0:
+                emissions.add(mode)
+            # applied modes in order of appearance
+            for row in mode_results:
+                journeys = row.journeys if apply_reco else row.freq * 45 * 2
+                emissions.add(row.applied_mode, float(row.distances or 0), int(
+                    journeys), float(row.emissions or 0))
+        return emissions
+
+    async def _accumulate_modes_emissions_v2(self, records, apply_reco: bool = False) -> EmissionsAccumulator:
+        """Accumulate the emissions of the data.freq_mod_journeys, per mode or applied mode"""
+        journeys = self._build_journeys_emissions_query(records).subquery()
+        emissions = EmissionsAccumulator()
+        if apply_reco:
+            # emissions of the applied mode, if it is one of the journey modes
+            query = select(
+                journeys.c.applied_mode,
+                func.sum(journeys.c.km * 45 * 2).label('distances'),
+                func.sum(func.trunc(journeys.c.days * 45 * 2)).label('journeys'),
+                func.sum(journeys.c.co2).label('emissions')
+            ).where(
+                journeys.c.mode == journeys.c.applied_mode,
+                journeys.c.co2 > 0
+            ).group_by(journeys.c.applied_mode)
+            results = {row.applied_mode: row for row in (await self.session.exec(query)).all()}
+            # applied modes of all the records, in order of appearance
+            first = func.min(records.c.id).label('first')
+            query = select(
+                records.c.applied_mode,
+                first,
+                select(journeys.c.record).exists().label('has_journeys')
+            ).where(records.c.version.startswith('2.')).group_by(records.c.applied_mode).order_by(first)
+            applied_modes = (await self.session.exec(query)).all()
+            if len(applied_modes) == 0 or not applied_modes[0].has_journeys:
+                return emissions
+            for row in applied_modes:
+                if row.applied_mode in results:
+                    result = results[row.applied_mode]
+                    emissions.add(row.applied_mode, float(result.distances), int(
+                        result.journeys), float(result.emissions))
+                else:
+                    emissions.add(row.applied_mode)
+            return emissions
+
+        # Emissions for each actual mode, journeys being counted per journey index
+        positive = journeys.c.co2 > 0
+        per_journey = select(
+            journeys.c.mode,
+            journeys.c.idx,
+            func.sum(journeys.c.km * 45 * 2).filter(positive).label('distances'),
+            func.sum(journeys.c.days * 45 * 2).filter(positive).label('journeys'),
+            func.sum(journeys.c.co2).filter(positive).label('emissions')
+        ).group_by(journeys.c.mode, journeys.c.idx).subquery()
+        query = select(
+            per_journey.c.mode,
+            func.sum(per_journey.c.distances).label('distances'),
+            func.sum(func.trunc(per_journey.c.journeys)).label('journeys'),
+            func.sum(per_journey.c.emissions).label('emissions')
+        ).group_by(per_journey.c.mode)
+        results = {row.mode: row for row in (await self.session.exec(query)).all()}
+        if len(results) == 0:
+            return emissions
+        for mode in MODES:
+            if mode in results:
+                result = results[mode]
+                emissions.add(mode, float(result.distances or 0), int(
+                    result.journeys or 0), float(result.emissions or 0))
+            else:
+                emissions.add(mode)
+        return emissions
+
+    def _build_emissions_records_query(self, filter: dict):
+        """Select the completed records matching filter, with their data version,
+        recommended mode and distance from home to workplace"""
+        recommendation = self._get_recommendation()
+        return select(
+            Record.id.label('id'),
+            Record.data.label('data'),
+            Record.data_version.label('version'),
+            case(RECO_MODE_NAMES, value=recommendation,
+                 else_=recommendation).label('applied_mode'),
+            self._get_distance_km().label('distance_km')
+        ).where(
+            Record.id.in_(self._build_ids_query(filter)),
+            self._is_completed())
+
+    def _build_journeys_emissions_query(self, records):
+        """Select the distinct modes of each journey of the v2 records, with the journey CO2 emissions of the mode.
+
+        If the train is one of the modes, consider that 80% of the distance is done by train,
+        then split the rest equally among the other modes used.
+        """
+        journey = func.jsonb_array_elements(self._to_array(records.c.data['freq_mod_journeys'])).table_valued(
+            column('value', JSONB), with_ordinality='idx').render_derived('journey')
+        mode = func.jsonb_array_elements_text(self._to_array(journey.c.value['modes'])).table_valued(
+            column('mode', String)).render_derived('journey_mode')
+        journey_modes = select(
+            records.c.id.label('record'),
+            journey.c.idx,
+            records.c.applied_mode,
+            records.c.distance_km,
+            self._to_number(journey.c.value['days'].astext).label('days'),
+            mode.c.mode
+        ).select_from(records).join(journey, true()).join(mode, true()).where(
+            records.c.version.startswith('2.'),
+            mode.c.mode.isnot(None)
+        ).distinct().subquery()
+
+        partition = [journey_modes.c.record, journey_modes.c.idx]
+        n_modes = func.count().over(partition_by=partition)
+        has_train = func.bool_or(
+            journey_modes.c.mode == 'train').over(partition_by=partition)
+        shares = select(
+            journey_modes,
+            case((has_train, case((journey_modes.c.mode == 'train', 0.8), else_=0.2 / (n_modes - 1))),
+                 else_=1.0 / n_modes).label('share')
+        ).subquery()
+        km = shares.c.days * shares.c.distance_km
+        return select(
+            shares.c.record,
+            shares.c.idx,
+            shares.c.applied_mode,
+            shares.c.mode,
+            shares.c.days,
+            km.label('km'),
+            (shares.c.share * 45 * 2 *
+             (km * self._get_mode_emissions(shares.c.mode) / 1000)).label('co2')
+        )
+
+    def _get_distance_km(self):
+        """The great-circle (haversine) distance from home to workplace, with a factor for real distance"""
+        lat1, lon1, lat2, lon2 = (func.radians(col) for col in (
+            Record.origin_lat, Record.origin_lon, Record.workplace_lat, Record.workplace_lon))
+        a = func.power(func.sin((lat2 - lat1) / 2), 2) + \
+            func.cos(lat1) * func.cos(lat2) * \
+            func.power(func.sin((lon2 - lon1) / 2), 2)
+        return 2 * 6371 * func.asin(func.sqrt(func.least(func.greatest(a, 0), 1))) * 1.3
+
+    def _get_mode_emissions(self, mode):
+        """The emissions factor of a mode, null if unknown"""
+        return case({key: float(value) for key, value in MODE_EMISSIONS.items()}, value=mode, else_=None)
+
+    def _to_number(self, value):
+        """Convert a JSON text value to a number, null if it is not numeric"""
+        return case((value.regexp_match(NUMBER_PATTERN), cast(value, Float)), else_=None)
+
+    def _to_array(self, value):
+        """A JSON value if it is an array, an empty array otherwise"""
+        return case((func.jsonb_typeof(value) == 'array', value), else_=func.jsonb_build_array())
+
+    def _build_ids_query(self, filter: dict):
+        """Select the ids of the records matching filter"""
+        builder = RecordQueryBuilder(
+            Record, filter, [], [], {})
+        return builder.build_count_query_with_joins(filter).with_only_columns(Record.id)
+
+    def _get_recommendation(self):
+        """The first recommended mode, typo.reco.reco_dt2[0]"""
+        return Record.reco_primary
+
+    def _is_completed(self):
+        """Completed records have a recommended mode"""
+        return Record.completed
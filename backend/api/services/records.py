@@ -1,15 +1,25 @@
+import json
 from api.db import AsyncSession
 from sqlalchemy.sql import text
-from sqlalchemy import select, cast
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import cast, func, Integer, Text
 from sqlmodel import select
 from fastapi import HTTPException
-from api.models.domain import Record, Campaign
+from api.models.domain import Record, Campaign, RECORD_GENERATED_FIELDS
 from api.models.query import RecordResult, RecordDraft, LocationFilter
+from api.services.campaign_stats import CampaignStatsService, campaign_stats_rebuilds
+from api.services.geometries import contains_points, geometry_cache
+from api.services.stats.cache import stats_cache
+from api.services.stats.commons import DERIVED_VERSION, compute_derived
+from api.services.stats.accumulators import StatsAggregates
+from api.services.stats.pool import stats_pool, record_stats_pool
 from enacit4r_sql.utils.query import QueryBuilder
 from datetime import datetime
 import pandas as pd
-from shapely.geometry import Point, Polygon as ShapelyPolygon, MultiPolygon as ShapelyMultiPolygon
+
+# Fields of the records DataFrame, in model order, the generated fields are read from the JSON fields.
+# The derived metrics are internal to the statistics, they are only read on demand.
+DATAFRAME_FIELDS = [name for name in Record.model_fields if name not in RECORD_GENERATED_FIELDS | {'derived'}]
+JSON_FIELDS = ['data', 'typo', 'derived']
 
 
 class RecordQueryBuilder(QueryBuilder):
@@ -28,11 +38,33 @@ class RecordQueryBuilder(QueryBuilder):
         query = query.distinct()
         return query
 
+    def apply_location_filter(self, query, location_filter: LocationFilter = None):
+        """Restrict the records to the bounding box of the workplace location filter geometry.
+
+        The bounds predicates use the workplace location index, the exact containment test is
+        left to filter_by_workplace_location.
+        """
+        if location_filter is None:
+            return query
+        min_lon, min_lat, max_lon, max_lat = geometry_cache.get(
+            location_filter.geo_within.geometry).bounds
+        return query.where(
+            Record.workplace_lat.between(min_lat, max_lat),
+            Record.workplace_lon.between(min_lon, max_lon))
+
+    def apply_completed_filter(self, query, completed: bool = False):
+        """Restrict the records to the completed ones, if completed is set"""
+        if not completed:
+            return query
+        return query.where(Record.completed)
+
 
 class RecordService:
 
     def __init__(self, session: AsyncSession):
         self.session = session
+        # campaign id -> company id, of the campaigns aggregates to rebuild once the write is committed
+        self._stale_campaigns: dict[int, int] = {}
 
     async def count(self) -> int:
         """Count all records"""
@@ -44,11 +76,22 @@ class RecordService:
         builder = RecordQueryBuilder(
             Record, filter, [], [], {})
         count_query = builder.build_count_query_with_joins(filter)
-        count_query = count_query.where(
-            Record.typo['reco'] != cast('null', JSONB))
+        count_query = builder.apply_completed_filter(count_query, True)
         count = (await self.session.exec(count_query)).one()
         return count
 
+    async def get_data_version(self, filter: dict) -> tuple:
+        """Get the version of the records matching filter: their count and last update time"""
+        builder = RecordQueryBuilder(
+            Record, filter, [], [], {})
+        # the count query selects a scalar, the matching ids are selected from it
+        ids_query = builder.build_count_query_with_joins(
+            filter).with_only_columns(Record.id)
+        version_query = select(func.count(Record.id), func.max(Record.updated_at)).where(
+            Record.id.in_(ids_query))
+        count, updated_at = (await self.session.exec(version_query)).one()
+        return count, updated_at
+
     async def get(self, id: int) -> Record:
         """Get a record by id"""
         res = await self.session.exec(
@@ -80,23 +123,34 @@ class RecordService:
         if not entity:
             raise HTTPException(
                 status_code=404, detail="Record not found")
+        retracted = await self._get_stats_aggregates(entity)
         await self.session.delete(entity)
+        await self._update_campaign_stats(entity.campaign_id, entity.company_id, StatsAggregates(), retracted)
         await self.session.commit()
+        self._rebuild_stale_campaign_stats()
+        stats_cache.clear()
         return entity
 
-    async def find(self, filter: dict, fields: list, sort: list, range: list) -> RecordResult:
-        """Get all records matching filter and range"""
+    async def find(self, filter: dict, fields: list, sort: list, range: list, location_filter: LocationFilter = None,
+                   completed: bool = False) -> RecordResult:
+        """Get all records matching filter and range, and having their workplace in the bounding box of the location filter if any,
+        only the completed ones if completed is set"""
         builder = RecordQueryBuilder(
             Record, filter, sort, range, {})
 
         # Do a query to satisfy total count
         count_query = builder.build_count_query_with_joins(filter)
+        count_query = builder.apply_location_filter(
+            count_query, location_filter)
+        count_query = builder.apply_completed_filter(count_query, completed)
         total_count_query = await self.session.exec(count_query)
         total_count = total_count_query.one()
 
         # Main query
         start, end, query = builder.build_query_with_joins(
             total_count, filter, fields)
+        query = builder.apply_location_filter(query, location_filter)
+        query = builder.apply_completed_filter(query, completed)
 
         # Execute query
         results = await self.session.exec(query)
@@ -126,8 +180,13 @@ class RecordService:
         entity.company_id = campaign.company_id
         entity.created_at = datetime.now()
         entity.updated_at = datetime.now()
+        entity.derived = await self._get_derived(entity)
         self.session.add(entity)
+        added = await self._get_stats_aggregates(entity)
+        await self._update_campaign_stats(entity.campaign_id, entity.company_id, added, StatsAggregates())
         await self.session.commit()
+        self._rebuild_stale_campaign_stats()
+        stats_cache.clear()
         return entity
 
     async def update(self, id: int, payload: RecordDraft, campaign: Campaign = None) -> Record:
@@ -139,6 +198,10 @@ class RecordService:
         if not entity:
             raise HTTPException(
                 status_code=404, detail="Record not found")
+        # statistics of the record before update
+        campaign_id = entity.campaign_id
+        company_id = entity.company_id
+        retracted = await self._get_stats_aggregates(entity)
         for key, value in payload.model_dump().items():
             # print(key, value)
             if key not in ["id", "created_at", "updated_at"]:
@@ -148,26 +211,100 @@ class RecordService:
         entity.updated_at = datetime.now()
         entity.campaign_id = campaign.id if campaign else entity.campaign_id
         entity.company_id = campaign.company_id if campaign else entity.company_id
+        entity.derived = await self._get_derived(entity)
+        added = await self._get_stats_aggregates(entity)
+        if entity.campaign_id == campaign_id:
+            await self._update_campaign_stats(entity.campaign_id, entity.company_id, added, retracted)
+        else:
+            # record moved to another campaign
+            await self._update_campaign_stats(campaign_id, company_id, StatsAggregates(), retracted)
+            await self._update_campaign_stats(entity.campaign_id, entity.company_id, added, StatsAggregates())
         await self.session.commit()
+        self._rebuild_stale_campaign_stats()
+        stats_cache.clear()
         return entity
 
-    async def get_dataframe(self, filter: dict, flat: bool = False) -> pd.DataFrame:
+    async def get_dataframe(self, filter: dict, flat: bool = False, location_filter: LocationFilter = None,
+                            completed: bool = False, derived: bool = False) -> pd.DataFrame:
         """Get a DataFrame representation of the records.
 
         Args:
             filter (dict): The filter criteria for the records.
             flat (bool, optional): Whether to flatten the DataFrame. Defaults to False.
+            location_filter (LocationFilter, optional): Only fetch the records having their workplace in the bounding box
+                of the filter geometry, the candidates of filter_by_workplace_location. Defaults to None.
+            completed (bool, optional): Only fetch the completed records, the ones statistics are computed from.
+                Defaults to False.
+            derived (bool, optional): Whether to include the derived metrics, for the statistics. Defaults to False.
+
+        Returns:
+            pd.DataFrame: A DataFrame representation of the records.
+        """
+        builder = RecordQueryBuilder(
+            Record, filter, [], [], {})
+        # the matching ids are selected from the count query, the records are not made distinct on their JSON fields
+        ids_query = builder.build_count_query_with_joins(
+            filter).with_only_columns(Record.id)
+        # JSON fields are read as text and decoded in bulk, records are not hydrated as models
+        query = select(*[cast(getattr(Record, name), Text) if name in JSON_FIELDS else getattr(Record, name)
+                         for name in self._get_dataframe_fields(derived)]).where(Record.id.in_(ids_query))
+        query = builder.apply_location_filter(query, location_filter)
+        query = builder.apply_completed_filter(query, completed)
+        rows = (await self.session.exec(query)).all()
+        return self.rows_to_dataframe(rows, flat, derived)
+
+    def rows_to_dataframe(self, rows: list[tuple], flat: bool = False, derived: bool = False) -> pd.DataFrame:
+        """Get a DataFrame representation of some records rows, as to_dataframe does for records.
+
+        Args:
+            rows (list[tuple]): The records rows, with the DATAFRAME_FIELDS values, then derived if included,
+                and the JSON fields as text.
+            flat (bool, optional): Whether to flatten the DataFrame. Defaults to False.
+            derived (bool, optional): Whether the rows include the derived metrics. Defaults to False.
+
+        Returns:
+            pd.DataFrame: A DataFrame representation of the records.
+        """
+        if len(rows) == 0:
+            return pd.DataFrame()
+        columns = dict(zip(self._get_dataframe_fields(derived), map(list, zip(*rows))))
+        json_fields = [col for col in JSON_FIELDS if col in columns]
+        for col in json_fields:
+            # decode all the values of a field at once
+            columns[col] = json.loads(
+                "[" + ",".join(value if value is not None else "null" for value in columns[col]) + "]")
+        if not flat:
+            return pd.DataFrame(columns)
+        frames = []
+        for col in json_fields:
+            df_data = pd.DataFrame([self.flatten_json(value) if isinstance(value, dict) else {}
+                                    for value in columns.pop(col)])
+            # Filter out empty columns and columns with empty names
+            df_data = df_data.loc[:, df_data.notna().any()]
+            df_data = df_data.loc[:, df_data.columns.astype(str).str.strip() != '']
+            frames.append(df_data.add_prefix(f"{col}."))
+        return pd.concat([pd.DataFrame(columns)] + frames, axis=1)
+
+    def to_dataframe(self, records: list[Record], flat: bool = False, derived: bool = False) -> pd.DataFrame:
+        """Get a DataFrame representation of some records.
+
+        Args:
+            records (list[Record]): The records.
+            flat (bool, optional): Whether to flatten the DataFrame. Defaults to False.
+            derived (bool, optional): Whether to include the derived metrics, for the statistics. Defaults to False.
 
         Returns:
             pd.DataFrame: A DataFrame representation of the records.
         """
-        results = await self.find(filter, fields=[], sort=[], range=[])
-        # Read results into a pandas DataFrame
-        df = pd.DataFrame([result.model_dump() for result in results.data])
+        # Read records into a pandas DataFrame
+        # generated fields are read from the JSON fields
+        exclude = RECORD_GENERATED_FIELDS if derived else RECORD_GENERATED_FIELDS | {'derived'}
+        df = pd.DataFrame([record.model_dump(exclude=exclude)
+                          for record in records])
         if not flat:
             return df
-        # Flatten nested JSON fields in 'data' and 'typo'
-        for col in ['data', 'typo']:
+        # Flatten nested JSON fields in 'data', 'typo' and 'derived'
+        for col in ['data', 'typo', 'derived']:
             if col in df.columns:
                 # Replace NaN with empty dict
                 df[col] = df[col].apply(
@@ -177,7 +314,7 @@ class RecordService:
                 # Filter out empty columns
                 df_data = df_data.loc[:, df_data.notna().any()]
                 # Filter out columns with empty names
-                df_data = df_data.loc[:, df_data.columns.str.strip() != '']
+                df_data = df_data.loc[:, df_data.columns.astype(str).str.strip() != '']
                 # Prefix column names
                 df_data = df_data.add_prefix(f"{col}.")
                 # Combine with original DataFrame
@@ -187,6 +324,109 @@ class RecordService:
         # return {"message": f"Columns count: {len(df_flat.columns)}", "columns": df_flat.columns.tolist()}
         return df
 
+    async def backfill_derived(self, campaign_id: int = None, batch_size: int = 1000) -> int:
+        """Compute the derived metrics of the records that have none, or of a previous version.
+
+        Records are processed by batches, each batch is committed.
+
+        Args:
+            campaign_id (int, optional): The campaign of the records. Defaults to all campaigns.
+            batch_size (int, optional): The number of records per batch. Defaults to 1000.
+
+        Returns:
+            int: The number of updated records.
+        """
+        count = 0
+        last_id = 0
+        while True:
+            query = select(Record).where(
+                Record.id > last_id,
+                func.coalesce(cast(Record.derived['version'].astext, Integer), 0) != DERIVED_VERSION)
+            if campaign_id is not None:
+                query = query.where(Record.campaign_id == campaign_id)
+            res = await self.session.exec(query.order_by(Record.id).limit(batch_size))
+            records = res.all()
+            if len(records) == 0:
+                return count
+            for record, derived in zip(records, compute_derived(self.to_dataframe(records, flat=True))):
+                record.derived = derived
+                self.session.add(record)
+            count += len(records)
+            last_id = records[-1].id
+            await self.session.commit()
+
+    async def compute_campaign_stats(self, campaign_id: int) -> StatsAggregates:
+        """Compute the statistics aggregates of all the records of a campaign"""
+        # statistics are computed from the completed records only
+        res = await self.session.exec(
+            select(Record).where(Record.campaign_id == campaign_id, Record.completed))
+        df = self.to_dataframe(res.all(), flat=True, derived=True)
+        # CPU bound, computed in a worker process
+        return await stats_pool.compute_aggregates(df)
+
+    async def rebuild_campaign_stats(self, campaign_id: int, company_id: int) -> None:
+        """Rebuild the statistics aggregates of a campaign from all its records"""
+        service = CampaignStatsService(self.session)
+        await self.session.flush()
+        # the records are read once the concurrent writes of the campaign are committed
+        await service.lock(campaign_id, company_id)
+        try:
+            aggregates = await self.compute_campaign_stats(campaign_id)
+        except Exception:
+            # aggregates cannot be maintained, statistics are computed from the records
+            await service.delete(campaign_id)
+            return
+        await service.save(campaign_id, company_id, aggregates)
+
+    async def _update_campaign_stats(self, campaign_id: int, company_id: int, added: StatsAggregates | None, retracted: StatsAggregates | None) -> None:
+        """Apply the delta of a record write to the statistics aggregates of its campaign.
+
+        When the delta is unknown, the campaign has no aggregates yet or they are stale, they are deleted and
+        rebuilt in the background once the write is committed. Statistics are computed from the records meanwhile.
+        """
+        if campaign_id is None:
+            return
+        service = CampaignStatsService(self.session)
+        await service.lock(campaign_id, company_id)
+        if added is not None and retracted is not None:
+            if await service.apply(campaign_id, added, retracted):
+                return
+        await service.delete(campaign_id)
+        self._stale_campaigns[campaign_id] = company_id
+
+    def _rebuild_stale_campaign_stats(self) -> None:
+        """Schedule the rebuilds of the stale campaigns aggregates, in their own sessions"""
+        bind = self.session.bind
+
+        def rebuild(campaign_id: int, company_id: int):
+            async def run():
+                async with AsyncSession(bind, expire_on_commit=False) as session:
+                    await RecordService(session).rebuild_campaign_stats(campaign_id, company_id)
+                    await session.commit()
+            return run
+
+        for campaign_id, company_id in self._stale_campaigns.items():
+            campaign_stats_rebuilds.schedule(
+                campaign_id, rebuild(campaign_id, company_id))
+        self._stale_campaigns.clear()
+
+    async def _get_derived(self, record: Record) -> dict | None:
+        """Get the derived metrics of a record, computed in a record writes worker process, None if they cannot be computed"""
+        try:
+            return (await record_stats_pool.compute_derived(self.to_dataframe([record], flat=True)))[0]
+        except Exception:
+            return None
+
+    async def _get_stats_aggregates(self, record: Record) -> StatsAggregates | None:
+        """Get the statistics aggregates of a record, computed in a record writes worker process, None if they cannot be computed"""
+        try:
+            return await record_stats_pool.compute_aggregates(self.to_dataframe([record], flat=True, derived=True))
+        except Exception:
+            return None
+
+    def _get_dataframe_fields(self, derived: bool = False) -> list[str]:
+        return DATAFRAME_FIELDS + ['derived'] if derived else DATAFRAME_FIELDS
+
     def filter_completed(self, df: pd.DataFrame) -> pd.DataFrame:
         """Get a DataFrame representation of the completed records.
 
@@ -201,33 +441,17 @@ class RecordService:
         return df
 
     def filter_by_workplace_location(self, df: pd.DataFrame, filter: LocationFilter) -> pd.DataFrame:
-        geom = filter.geo_within.geometry
-        shapely_polygon = None
-        # Depending on geometry type, extract coordinates
-        if geom.type == "Polygon":
-            coordinates = geom.coordinates[0]  # Outer ring
-            shapely_polygon = ShapelyPolygon(coordinates)
-        elif geom.type == "MultiPolygon":
-            # Each element in geom.coordinates is a polygon (list of rings)
-            polygons = [ShapelyPolygon(polygon[0])
-                        for polygon in geom.coordinates]
-            shapely_polygon = ShapelyMultiPolygon(polygons)
-        else:
-            raise ValueError(
-                "Unsupported geometry type for workplace location filter")
-
-        def contains_point(lat, lon):
-            point = Point(lon, lat)  # Note: Point takes (x, y) = (lon, lat)
-            return shapely_polygon.contains(point)
-
-        # Filter out rows with missing or NaN lat/lon before applying polygon filter
-        df = df[
-            pd.notna(df['data.workplace.lat']) &
-            pd.notna(df['data.workplace.lon'])
-        ]
-        df = df[df.apply(lambda row: contains_point(
-            row['data.workplace.lat'], row['data.workplace.lon']), axis=1)]
-        return df
+        """Get the records having their workplace inside the filter polygon or multipolygon.
+
+        Args:
+            df (pd.DataFrame): The flattened records.
+            filter (LocationFilter): The workplace location filter.
+        """
+        if 'data.workplace.lat' not in df.columns or 'data.workplace.lon' not in df.columns:
+            # no records, or none having a workplace location
+            return df.iloc[:0]
+        return df[contains_points(filter.geo_within.geometry,
+                                  df['data.workplace.lat'], df['data.workplace.lon'])]
 
     def flatten_json(self, obj, parent_key="", sep="."):
         """Recursively flatten JSON with lists indexed."""
@@ -0,0 +1,186 @@
+import json
+import os
+import tempfile
+import pandas as pd
+import pyarrow as pa
+from sqlalchemy import ARRAY, Integer, any_, bindparam, literal_column
+from sqlmodel import select
+from api.config import config
+from api.db import AsyncSession
+from api.models.domain import Record
+from api.services.campaign_stats import get_filter_ids
+from api.services.records import RecordService
+from api.services.stats.commons import match_columns
+
+# Snapshot column of the version of each record row: the id of the transaction that last wrote it (xmin)
+# changes with each committed write, unlike updated_at which is set before commit
+ROW_VERSION_COLUMN = "row_version"
+ROW_VERSION = literal_column("record.xmin::text::bigint")
+# Snapshot schema metadata: the columns having values of different types, stored JSON encoded
+JSON_COLUMNS_KEY = b"json_columns"
+
+
+class RecordSnapshotService:
+    """Columnar snapshots of the flattened records of each campaign, stored as Arrow IPC files.
+
+    A snapshot is refreshed when read, if the campaign records have changed: only the records written
+    since the snapshot was, having another row version, are fetched and flattened again, and deleted
+    records are dropped. Snapshots are read memory-mapped, with only the requested columns.
+    """
+
+    def __init__(self, session: AsyncSession, path: str = None):
+        self.session = session
+        self.path = path if path is not None else config.SNAPSHOTS_PATH
+
+    async def get_dataframe(self, filter: dict, columns: list[str] = None, derived: bool = False) -> pd.DataFrame | None:
+        """Get the flattened records matching filter from the campaigns snapshots.
+
+        Args:
+            filter (dict): The records filter, only campaign_id and company_id criteria are supported.
+            columns (list[str], optional): The columns to read, names or prefixes of nested fields. Defaults to all.
+            derived (bool, optional): Whether to include the derived metrics, for the statistics. Defaults to False.
+
+        Returns:
+            pd.DataFrame: The flattened records, None if snapshots are disabled or the filter is not supported.
+        """
+        if not self.path or not filter or any(key not in ["campaign_id", "company_id"] for key in filter):
+            return None
+        campaign_ids = get_filter_ids(filter.get("campaign_id"))
+        if not campaign_ids:
+            return None
+        company_ids = None
+        if "company_id" in filter:
+            company_ids = get_filter_ids(filter["company_id"])
+            if not company_ids:
+                return None
+            if columns is not None:
+                columns = columns + ["company_id"]
+        frames = []
+        for campaign_id in sorted(set(campaign_ids)):
+            await self.refresh(campaign_id)
+            frames.append(self.read(campaign_id, columns))
+        df = pd.concat(frames, ignore_index=True)
+        if company_ids is not None and len(df) > 0:
+            df = df[df["company_id"].isin(company_ids)].reset_index(drop=True)
+        if not derived:
+            df = df.drop(columns=[col for col in df.columns if str(col).startswith('derived.')])
+        return df
+
+    async def refresh(self, campaign_id: int) -> None:
+        """Write the snapshot of a campaign, if its records have changed since the snapshot was written"""
+        res = await self.session.exec(
+            select(Record.id, ROW_VERSION).where(Record.campaign_id == campaign_id))
+        versions = dict(res.all())
+        snapshot_path = self._get_snapshot_path(campaign_id)
+        snapshot_versions = self._read_versions(snapshot_path)
+        if snapshot_versions == versions:
+            return
+        query = select(Record, ROW_VERSION).where(Record.campaign_id == campaign_id)
+        if snapshot_versions is not None:
+            # the added records and the ones written since the snapshot was
+            changed = [id for id, version in versions.items() if snapshot_versions.get(id) != version]
+            query = query.where(Record.id == any_(bindparam("ids", changed, type_=ARRAY(Integer))))
+        rows = (await self.session.exec(query)).all()
+        # snapshots serve the statistics, with the derived metrics
+        df = RecordService(self.session).to_dataframe([record for record, _ in rows], flat=True, derived=True)
+        df[ROW_VERSION_COLUMN] = [version for _, version in rows]
+        if snapshot_versions is not None:
+            # keep the unchanged and not deleted records of the snapshot
+            ids = set(versions) - (set(df['id']) if 'id' in df.columns else set())
+            table = self._read_table(snapshot_path)
+            df_snapshot = self._to_dataframe(table, table.schema.metadata)
+            if 'id' in df_snapshot.columns:
+                df = pd.concat(
+                    [df_snapshot[df_snapshot['id'].isin(ids)], df], ignore_index=True)
+        if 'id' in df.columns:
+            df = df.sort_values('id', ignore_index=True)
+        # drop the record fields of the deleted records only
+        df = df.loc[:, ~df.columns.str.startswith(('data.', 'typo.')) | df.notna().any()]
+        self._write(snapshot_path, df)
+
+    def read(self, campaign_id: int, columns: list[str] = None) -> pd.DataFrame:
+        """Read the snapshot of a campaign, memory-mapped.
+
+        Args:
+            campaign_id (int): The campaign id.
+            columns (list[str], optional): The columns to read, names or prefixes of nested fields. Defaults to all.
+        """
+        snapshot_path = self._get_snapshot_path(campaign_id)
+        if not os.path.exists(snapshot_path):
+            return pd.DataFrame()
+        table = self._read_table(snapshot_path)
+        names = match_columns(table.column_names, columns) if columns is not None else table.column_names
+        return self._to_dataframe(table.select([name for name in names if name != ROW_VERSION_COLUMN]),
+                                  table.schema.metadata)
+
+    def delete(self, campaign_id: int) -> None:
+        """Delete the snapshot of a campaign, if any"""
+        snapshot_path = self._get_snapshot_path(campaign_id)
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+
+    #
+    # Internal functions
+    #
+
+    def _get_snapshot_path(self, campaign_id: int) -> str:
+        return os.path.join(self.path, f"campaign_{campaign_id}.arrow")
+
+    def _read_table(self, snapshot_path: str) -> pa.Table:
+        """Read a snapshot table, memory-mapped"""
+        with pa.memory_map(snapshot_path) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def _read_versions(self, snapshot_path: str) -> dict[int, int] | None:
+        """Read the row version of each record of a snapshot, None if there is none"""
+        if not os.path.exists(snapshot_path):
+            return None
+        table = self._read_table(snapshot_path)
+        if ROW_VERSION_COLUMN not in table.column_names:
+            # written by a previous version
+            return None
+        if 'id' not in table.column_names:
+            # campaign without records
+            return {}
+        return dict(zip(table['id'].to_pylist(), table[ROW_VERSION_COLUMN].to_pylist()))
+
+    def _write(self, snapshot_path: str, df: pd.DataFrame) -> None:
+        """Write a snapshot atomically"""
+        table = self._to_table(df)
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp_path, snapshot_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _to_table(self, df: pd.DataFrame) -> pa.Table:
+        """Convert flattened records to an Arrow table.
+
+        JSON values of a field may have different types across records (e.g. numbers and strings),
+        such columns are stored JSON encoded, and decoded by _to_dataframe.
+        """
+        columns = {}
+        for col in df.columns[df.dtypes == object]:
+            try:
+                pa.array(df[col], from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                columns[col] = df[col].map(json.dumps, na_action='ignore')
+        table = pa.Table.from_pandas(df.assign(**columns), preserve_index=False)
+        return table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            JSON_COLUMNS_KEY: json.dumps(list(columns)).encode()
+        })
+
+    def _to_dataframe(self, table: pa.Table, metadata: dict | None) -> pd.DataFrame:
+        """Convert an Arrow table of flattened records to a DataFrame, with the JSON encoded columns decoded"""
+        df = table.to_pandas()
+        json_columns = json.loads((metadata or {}).get(JSON_COLUMNS_KEY, b"[]"))
+        for col in json_columns:
+            if col in df.columns:
+                df[col] = df[col].map(json.loads, na_action='ignore')
+        return df
@@ -0,0 +1,365 @@
+from api.models.query import Emissions, Frequencies, Frequency, Link, Links, Stats
+
+
+# relative tolerance of the distances and emissions sums when retracted
+EMISSIONS_TOLERANCE = 1e-9
+
+
+class InconsistentAggregatesError(ValueError):
+    """The retracted aggregates were not merged in the aggregates, these are stale."""
+
+
+class FrequenciesAccumulator:
+    """Mergeable frequencies: for each field, the count and the sum of each value."""
+
+    def __init__(self):
+        # field -> value -> [count, sum]
+        self.fields: dict[str, dict[str, list]] = {}
+
+    def add_field(self, field: str) -> None:
+        """Register a field, even without values."""
+        self.fields.setdefault(field, {})
+
+    def add(self, field: str, value: str, count: int, sum: int = None) -> None:
+        """Add the count and sum of a field value."""
+        values = self.fields.setdefault(field, {})
+        entry = values.get(value)
+        if entry is None:
+            values[value] = [count, sum]
+            return
+        entry[0] += count
+        if sum is not None:
+            entry[1] = (entry[1] or 0) + sum
+
+    def add_frequencies(self, frequencies: Frequencies) -> None:
+        """Add the data of a Frequencies."""
+        self.add_field(frequencies.field)
+        for freq in frequencies.data:
+            self.add(frequencies.field, freq.value, freq.count, freq.sum)
+
+    def merge(self, other: "FrequenciesAccumulator") -> "FrequenciesAccumulator":
+        """Merge another accumulator into this one."""
+        for field, values in other.fields.items():
+            self.add_field(field)
+            for value, (count, sum) in values.items():
+                self.add(field, value, count, sum)
+        return self
+
+    def retract(self, other: "FrequenciesAccumulator") -> "FrequenciesAccumulator":
+        """Remove another accumulator, previously merged, from this one.
+
+        Raises:
+            InconsistentAggregatesError: If a value is missing or its count would be negative.
+        """
+        for field, values in other.fields.items():
+            for value, (count, sum) in values.items():
+                entry = self.fields.get(field, {}).get(value)
+                if entry is None or entry[0] < count:
+                    raise InconsistentAggregatesError(
+                        f"Cannot retract {count} {field} {value}")
+                self.add(field, value, -count,
+                         -sum if sum is not None else None)
+                if entry[0] == 0:
+                    del self.fields[field][value]
+        return self
+
+    def to_frequencies(self, total: int) -> list[Frequencies]:
+        """Convert to a list of Frequencies, in fields and values insertion order."""
+        return [
+            Frequencies(
+                field=field,
+                total=total,
+                data=[
+                    Frequency(value=value, count=count, sum=sum)
+                    for value, (count, sum) in values.items()
+                ]
+            )
+            for field, values in self.fields.items()
+        ]
+
+    def to_dict(self) -> dict:
+        return self.fields
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FrequenciesAccumulator":
+        accumulator = cls()
+        accumulator.fields = {
+            field: {value: list(entry) for value, entry in values.items()}
+            for field, values in data.items()
+        }
+        return accumulator
+
+
+class EmissionsAccumulator:
+    """Mergeable emissions: for each mode, the distances, journeys and emissions totals."""
+
+    def __init__(self):
+        # mode -> [distances, journeys, emissions]
+        self.modes: dict[str, list] = {}
+
+    def add(self, mode: str, distances: float = 0, journeys: int = 0, emissions: float = 0) -> None:
+        """Add distances, journeys and emissions of a mode."""
+        entry = self.modes.setdefault(mode, [0, 0, 0])
+        entry[0] += distances
+        entry[1] += journeys
+        entry[2] += emissions
+
+    def merge(self, other: "EmissionsAccumulator") -> "EmissionsAccumulator":
+        """Merge another accumulator into this one."""
+        for mode, (distances, journeys, emissions) in other.modes.items():
+            self.add(mode, distances, journeys, emissions)
+        return self
+
+    def retract(self, other: "EmissionsAccumulator") -> "EmissionsAccumulator":
+        """Remove another accumulator, previously merged, from this one.
+
+        Raises:
+            InconsistentAggregatesError: If a mode is missing or its totals would be negative.
+        """
+        for mode, (distances, journeys, emissions) in other.modes.items():
+            entry = self.modes.get(mode, [0, 0, 0])
+            if entry[1] < journeys or self._exceeds(distances, entry[0]) or self._exceeds(emissions, entry[2]):
+                raise InconsistentAggregatesError(
+                    f"Cannot retract {journeys} {mode} journeys")
+            self.add(mode, -distances, -journeys, -emissions)
+        return self
+
+    def to_emissions(self, total: int) -> list[Emissions]:
+        """Convert to a list of Emissions, in modes insertion order.
+
+        Distances and emissions are rounded and modes without emissions are filtered out.
+        """
+        results = []
+        for mode, (distances, journeys, emissions) in self.modes.items():
+            emissions = round(emissions, 3)
+            if emissions > 0:
+                results.append(Emissions(
+                    mode=mode,
+                    total=total,
+                    distances=round(distances, 3),
+                    journeys=journeys,
+                    emissions=emissions
+                ))
+        return results
+
+    def to_dict(self) -> dict:
+        return self.modes
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "EmissionsAccumulator":
+        accumulator = cls()
+        accumulator.modes = {mode: list(entry) for mode, entry in data.items()}
+        return accumulator
+
+    @staticmethod
+    def _exceeds(value: float, total: float) -> bool:
+        # sums of floats are rounded differently when added and retracted
+        return value - total > EMISSIONS_TOLERANCE * max(1, abs(total))
+
+
+class LinksAccumulator:
+    """Mergeable links: the count of each source and target pair."""
+
+    def __init__(self, total: int = 0):
+        self.total = total
+        # (source, target) -> value
+        self.links: dict[tuple[str, str], int] = {}
+
+    def add(self, source: str, target: str, value: int) -> None:
+        """Add the count of a source and target pair."""
+        key = (source, target)
+        self.links[key] = self.links.get(key, 0) + value
+
+    def add_links(self, links: Links) -> None:
+        """Add the data of a Links."""
+        self.total += links.total
+        for link in links.data:
+            self.add(link.source, link.target, link.value)
+
+    def merge(self, other: "LinksAccumulator") -> "LinksAccumulator":
+        """Merge another accumulator into this one."""
+        self.total += other.total
+        for (source, target), value in other.links.items():
+            self.add(source, target, value)
+        return self
+
+    def retract(self, other: "LinksAccumulator") -> "LinksAccumulator":
+        """Remove another accumulator, previously merged, from this one.
+
+        Raises:
+            InconsistentAggregatesError: If a pair is missing or its count would be negative.
+        """
+        if self.total < other.total:
+            raise InconsistentAggregatesError(
+                f"Cannot retract {other.total} links from {self.total}")
+        self.total -= other.total
+        for (source, target), value in other.links.items():
+            current = self.links.get((source, target))
+            if current is None or current < value:
+                raise InconsistentAggregatesError(
+                    f"Cannot retract {value} {source} to {target} links")
+            self.add(source, target, -value)
+            if self.links[(source, target)] == 0:
+                del self.links[(source, target)]
+        return self
+
+    def to_links(self) -> Links:
+        """Convert to Links, in pairs insertion order."""
+        return Links(
+            total=self.total,
+            data=[
+                Link(source=source, target=target, value=value)
+                for (source, target), value in self.links.items()
+            ]
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'total': self.total,
+            'links': [[source, target, value] for (source, target), value in self.links.items()]
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LinksAccumulator":
+        accumulator = cls(data['total'])
+        for source, target, value in data['links']:
+            accumulator.add(source, target, value)
+        return accumulator
+
+
+class StatsAggregates:
+    """Mergeable state of all the statistics of a set of records.
+
+    Aggregates of disjoint sets of records can be merged, and the aggregates of a record can
+    be retracted, so that statistics can be maintained incrementally and persisted.
+    """
+
+    FREQUENCIES_FIELDS = ['equipments', 'constraints', 'travel_time', 'reco_dt2']
+    PRO_FREQUENCIES_FIELDS = ['reco_pros']
+
+    def __init__(self):
+        # count of completed records, and of completed records in the v2 data version
+        self.total = 0
+        self.total_v2 = 0
+        self.frequencies = FrequenciesAccumulator()
+        for field in self.FREQUENCIES_FIELDS:
+            self.frequencies.add_field(field)
+        self.mode_frequencies = FrequenciesAccumulator()
+        self.mode_emissions = EmissionsAccumulator()
+        self.reco_mode_emissions = EmissionsAccumulator()
+        self.mode_links = LinksAccumulator()
+        self.pro_frequencies = FrequenciesAccumulator()
+        for field in self.PRO_FREQUENCIES_FIELDS:
+            self.pro_frequencies.add_field(field)
+        self.pro_mode_frequencies = FrequenciesAccumulator()
+        self.pro_mode_emissions = EmissionsAccumulator()
+        self.pro_mode_links = LinksAccumulator()
+
+    def _accumulators(self) -> dict:
+        return {
+            'frequencies': self.frequencies,
+            'mode_frequencies': self.mode_frequencies,
+            'mode_emissions': self.mode_emissions,
+            'reco_mode_emissions': self.reco_mode_emissions,
+            'mode_links': self.mode_links,
+            'pro_frequencies': self.pro_frequencies,
+            'pro_mode_frequencies': self.pro_mode_frequencies,
+            'pro_mode_emissions': self.pro_mode_emissions,
+            'pro_mode_links': self.pro_mode_links
+        }
+
+    def merge(self, other: "StatsAggregates") -> "StatsAggregates":
+        """Merge the aggregates of another set of records into this one."""
+        self.total += other.total
+        self.total_v2 += other.total_v2
+        others = other._accumulators()
+        for name, accumulator in self._accumulators().items():
+            accumulator.merge(others[name])
+        return self
+
+    def retract(self, other: "StatsAggregates") -> "StatsAggregates":
+        """Remove the aggregates of a subset of records from this one.
+
+        Raises:
+            InconsistentAggregatesError: If the subset was not merged in these aggregates, which are then left partially retracted.
+        """
+        if self.total < other.total or self.total_v2 < other.total_v2:
+            raise InconsistentAggregatesError(
+                f"Cannot retract {other.total} records from {self.total}")
+        self.total -= other.total
+        self.total_v2 -= other.total_v2
+        others = other._accumulators()
+        for name, accumulator in self._accumulators().items():
+            accumulator.retract(others[name])
+        return self
+
+    def to_stats(self, sections: list[str] = None) -> Stats:
+        """Finalize the aggregates into statistics.
+
+        Args:
+            sections (list[str], optional): The statistics to finalize, the others are left to None. Defaults to all.
+        """
+        def requested(section: str) -> bool:
+            return sections is None or section in sections
+
+        stats = Stats(total=self.total)
+        # individual
+        if requested('frequencies'):
+            stats.frequencies = self.frequencies.to_frequencies(self.total)
+            for freqs in stats.frequencies:
+                # most frequent values first
+                freqs.data.sort(key=lambda x: x.count, reverse=True)
+        if requested('mode_frequencies'):
+            stats.mode_frequencies = self.mode_frequencies.to_frequencies(
+                self.total)
+            for freqs in stats.mode_frequencies:
+                # sort frequencies data by value as integer
+                freqs.data.sort(key=lambda x: int(x.value))
+        if requested('mode_emissions'):
+            stats.mode_emissions = self.mode_emissions.to_emissions(self.total)
+        if requested('reco_mode_emissions'):
+            stats.reco_mode_emissions = self.reco_mode_emissions.to_emissions(
+                self.total)
+        if requested('mode_links'):
+            stats.mode_links = self.mode_links.to_links()
+        # professional
+        if requested('pro_frequencies'):
+            stats.pro_frequencies = self.pro_frequencies.to_frequencies(
+                self.total)
+            for freqs in stats.pro_frequencies:
+                # most frequent values first
+                freqs.data.sort(key=lambda x: x.count, reverse=True)
+        if requested('pro_mode_frequencies'):
+            pro_mode_frequencies = self.pro_mode_frequencies.to_frequencies(
+                self.total)
+            for freqs in pro_mode_frequencies:
+                # sort frequencies data by value as integer
+                freqs.data.sort(key=lambda x: int(x.value))
+            # filter out frequencies with empty data
+            stats.pro_mode_frequencies = [
+                f for f in pro_mode_frequencies if len(f.data) > 0]
+        if requested('pro_mode_emissions'):
+            stats.pro_mode_emissions = self.pro_mode_emissions.to_emissions(
+                self.total_v2)
+        if requested('pro_mode_links'):
+            stats.pro_mode_links = self.pro_mode_links.to_links()
+        return stats
+
+    def to_dict(self) -> dict:
+        data = {
+            'total': self.total,
+            'total_v2': self.total_v2
+        }
+        for name, accumulator in self._accumulators().items():
+            data[name] = accumulator.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "StatsAggregates":
+        aggregates = cls()
+        aggregates.total = data['total']
+        aggregates.total_v2 = data['total_v2']
+        for name, accumulator in aggregates._accumulators().items():
+            setattr(aggregates, name,
+                    type(accumulator).from_dict(data[name]))
+        return aggregates
@@ -0,0 +1,58 @@
+import json
+from collections import OrderedDict
+from api.config import config
+from api.models.query import Stats
+
+
+class StatsCache:
+    """LRU cache of computed statistics, keyed by the records filter and the records data version."""
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, Stats] = OrderedDict()
+
+    def make_key(self, filter: dict, version: tuple, sections: list[str] = None) -> str:
+        """Make a cache key from a filter, the version of the records it selects and the statistics sections.
+
+        Args:
+            filter (dict): The records filter, including the workplace location.
+            version (tuple): The records data version, see RecordService.get_data_version().
+            sections (list[str], optional): The statistics sections. Defaults to all.
+        """
+        return json.dumps({"filter": filter, "version": version, "sections": sections}, sort_keys=True, default=str)
+
+    def get(self, key: str) -> Stats | None:
+        """Get the statistics of a key, None if not cached"""
+        stats = self._entries.get(key)
+        if stats is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return stats
+
+    def put(self, key: str, stats: Stats) -> None:
+        """Cache the statistics of a key, evicting the least recently used ones"""
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = stats
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Invalidate all the cached statistics"""
+        self._entries.clear()
+
+    def info(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+stats_cache = StatsCache(config.STATS_CACHE_SIZE)
@@ -1,7 +1,9 @@
+import re
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 import h3
 
-
 MODES = [
     'walking',
     'bike',
@@ -68,65 +70,314 @@ RECOS_PRO = [
 ]
 
 
-class BaseStatsService:
+JOURNEY_COLUMN_PATTERN = re.compile(
+    r'^data\.freq_mod_journeys\.(\d+)\.(days|modes\.\d+)$')
+
+PRO_JOURNEY_COLUMN_PATTERN = re.compile(
+    r'^data\.freq_mod_pro_journeys\.(\d+)\.(days|mode|hex_id)$')
+
+RECO_PRO_COLUMN_PATTERN = re.compile(r'^typo\.reco_pro\.reco_pros\.(\d+)$')
+
+
+# Hypothèse sur l'allongement des distances : en moyenne, 1.22 (network based vs real measured distances : https://journals.sagepub.com/doi/abs/10.3141/1804-28)
+# On pourrait améliorer ca en cherchant la meme chose pour l'avion (études sur les détours/distances faites lorsqu'on doit attendre au dessus d'un aéroport plein...)
+# Pareil pour le bateau (pour l'instant on applique 1.22 à tous)
+AVG_DIST_COEFF = {'train': 1.22, 'car': 1.22, 'bike': 1.22,
+                  'walk': 1.22, 'moto': 1.22, 'pub': 1.22, 'boat': 1.22, 'plane': 1.22}
+
+# pro journeys distance classes upper bounds, in km
+DISTANCE_TYPES = [('local', 20), ('national', 500), ('europe', 1500)]
+
+# Version of the derived metrics stored in the records, to increment when their computation changes:
+# metrics of a previous version are computed again when reading the records
+DERIVED_VERSION = 1
+
+
+def match_columns(columns: list[str], names: list[str]) -> list[str]:
+    """Get the flattened columns matching some names, or having one of them as nested field prefix"""
+    prefixes = tuple(f'{name}.' for name in names)
+    return [col for col in columns if col in names or col.startswith(prefixes)]
+
+
+def calculate_distances(origin_lat: pd.Series, origin_lon: pd.Series, dest_lat: pd.Series, dest_lon: pd.Series) -> pd.Series:
+    """Calculate the great-circle (haversine) distances between origin and destination locations.
+
+    Missing or invalid coordinates give a NaN distance.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(pd.to_numeric(col, errors='coerce').to_numpy(dtype=float))
+                              for col in (origin_lat, origin_lon, dest_lat, dest_lon))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    distance_km = 2 * 6371 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    # factor for real distance
+    return pd.Series(distance_km * 1.3, index=origin_lat.index)
+
+
+@lru_cache(maxsize=65536)
+def distance_to_h3(lat: float, lon: float, h3_index: str) -> tuple[float, bool]:
+    """Calculate the distance between a location and a H3 cell, memoized.
+
+    Returns:
+        tuple[float, bool]: The distance in km and whether the network detour coefficient of
+            the transport mode applies to it. An invalid location or cell gives a zero distance.
+    """
+    try:
+        resolution = h3.get_resolution(h3_index)
+        if h3.latlng_to_cell(lat, lon, resolution) == h3_index:
+            # Si meme hexagone (apres mise à la resolution choisie par l'utilisateur), on prend une distance moyenne de la taille d'une arrête de l'hexagone.
+            return h3.average_hexagon_edge_length(resolution), False
+        # Si pas meme hexagone, on convertit le centre du h3 sélectionné en h3 plus petit pour calculer des distances plus précises
+        return h3.great_circle_distance(h3.cell_to_latlng(h3.cell_to_center_child(h3_index, 9)), (lat, lon)), True
+    except Exception:
+        return 0, False
+
+
+def calculate_distances_to_h3(lat: pd.Series, lon: pd.Series, h3_index: pd.Series, mode: pd.Series) -> pd.Series:
+    """Calculate the distances between locations and H3 cells with transport modes.
+
+    The distance is computed once per distinct location and cell. Missing or invalid locations
+    and cells, or modes without detour coefficient (when not in the same cell), give a zero distance.
+    """
+    pairs = pd.DataFrame({
+        'lat': pd.to_numeric(lat, errors='coerce').astype(float),
+        'lon': pd.to_numeric(lon, errors='coerce').astype(float),
+        'h3_index': h3_index.astype(object)}, index=lat.index)
+    valid = pairs['lat'].notna() & pairs['lon'].notna() & pairs['h3_index'].notna()
+    distances = pd.Series(0.0, index=lat.index)
+    if not valid.any():
+        return distances
+    table = pairs[valid].drop_duplicates()
+    table['distance_km'], table['detour'] = zip(
+        *[distance_to_h3(*pair) for pair in table.itertuples(index=False)])
+    pairs = pairs[valid].merge(table, how='left', on=['lat', 'lon', 'h3_index'])
+    coeff = mode[valid].astype(object).map(AVG_DIST_COEFF).fillna(0).to_numpy()
+    detour = pairs['detour'].to_numpy(dtype=bool)
+    distance_km = pairs['distance_km'].to_numpy(dtype=float)
+    distances[valid] = np.where(detour, distance_km * coeff, distance_km)
+    return distances
+
+
+def get_column(df: pd.DataFrame, name: str) -> pd.Series:
+    """Get a column of flattened records, with missing values when none of the records has the field."""
+    if name not in df.columns:
+        return pd.Series(np.nan, index=df.index)
+    return df[name]
+
+
+def format_value(value) -> str:
+    """Format a flattened record value as a frequency value.
+
+    Numbers are formatted on their own, not as their column dtype: integral numbers have no decimals, whether
+    the column is of integers or of floats because of missing values.
+    """
+    if isinstance(value, (float, np.floating)) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def get_derived(df: pd.DataFrame, name: str) -> pd.Series:
+    """Get a column of the derived metrics stored in flattened records.
+
+    Values are missing for the records without derived metrics of the current version.
+    """
+    if 'derived.version' not in df.columns or name not in df.columns:
+        return pd.Series(np.nan, index=df.index)
+    current = pd.to_numeric(
+        df['derived.version'], errors='coerce') == DERIVED_VERSION
+    return df[name].where(current)
+
+
+def compute_derived(df: pd.DataFrame) -> list[dict]:
+    """Compute the derived metrics of flattened records, as stored in Record.derived.
+
+    The metrics are the distance from home to workplace and, for each pro journey, the distance
+    from the workplace to the destination and its distance type. They only depend on the record data.
+
+    Args:
+        df (pd.DataFrame): The flattened records, all of them (completed or not).
+
+    Returns:
+        list[dict]: The derived metrics of each record, in the records order.
+    """
+    # under copy-on-write, see StatsService.compute_aggregates
+    with pd.option_context('mode.copy_on_write', True):
+        # metrics are computed again, not read from the previous ones
+        context = StatsContext(df.loc[:, ~df.columns.str.startswith('derived.')])
+        derived = [{'version': DERIVED_VERSION, 'distance_km': None, 'pro_journeys': {}}
+                   for _ in range(len(df))]
+        positions = pd.Series(range(len(df)), index=df.index)
+        for position, distance_km in zip(positions, context.derived['distance_km']):
+            if pd.notna(distance_km):
+                derived[position]['distance_km'] = float(distance_km)
+        journeys = context.pro_journeys
+        journeys = journeys[journeys['days'].notna()]
+        for record, journey_idx, distance_km, distance_type in zip(
+                journeys['record'], journeys['journey_idx'], journeys['distance_km'], journeys['distance_type']):
+            derived[positions[record]]['pro_journeys'][str(journey_idx)] = {
+                'distance_km': float(distance_km), 'distance_type': distance_type}
+        return derived
+
+
+class StatsContext:
+    """Data shared by all the stats services for one DataFrame of flattened records.
+
+    It is built once and holds the records partitions per data version, the schema of the
+    journey columns and the derived columns, so that services do not copy the DataFrame
+    nor scan its columns repeatedly. The DataFrame is not modified, derived columns are
+    held in a separate frame with the same index.
+    """
 
     def __init__(self, df: pd.DataFrame):
         self.df = df
+        # derived columns, read from the derived metrics stored in the records when available
+        self.derived = pd.DataFrame(index=df.index)
+        # records without origin or workplace have no distance, the columns are absent when none has one
+        distance_km = pd.to_numeric(
+            get_derived(df, 'derived.distance_km'), errors='coerce')
+        missing = distance_km.isna()
+        if missing.any():
+            df_missing = df[missing]
+            distance_km[missing] = calculate_distances(
+                get_column(df_missing, 'data.origin.lat'), get_column(df_missing, 'data.origin.lon'),
+                get_column(df_missing, 'data.workplace.lat'), get_column(df_missing, 'data.workplace.lon'))
+        self.derived['distance_km'] = distance_km
+        # partitions per data version
+        if 'data.version' not in df.columns:
+            self.df_v1 = df
+            self.df_v2 = pd.DataFrame()
+        else:
+            self.df_v1 = df[df['data.version'].isna()]
+            self.df_v2 = df[df['data.version'].notna() &
+                            df['data.version'].str.startswith('2.')]
+        # columns schema
+        self.equipments_columns = []
+        self.constraints_columns = []
+        self.reco_pros_columns = {}
+        self.journeys_columns = {}
+        self.pro_journeys_columns = {}
+        for col in df.columns:
+            if col.startswith('data.equipments.'):
+                self.equipments_columns.append(col)
+            elif col.startswith('data.constraints.'):
+                self.constraints_columns.append(col)
+            elif match := JOURNEY_COLUMN_PATTERN.match(col):
+                journey = self.journeys_columns.setdefault(
+                    int(match.group(1)), {'days': None, 'modes': []})
+                if match.group(2) == 'days':
+                    journey['days'] = col
+                else:
+                    journey['modes'].append(col)
+            elif match := PRO_JOURNEY_COLUMN_PATTERN.match(col):
+                journey = self.pro_journeys_columns.setdefault(
+                    int(match.group(1)), {'days': None, 'mode': None, 'hex_id': None})
+                journey[match.group(2)] = col
+            elif match := RECO_PRO_COLUMN_PATTERN.match(col):
+                self.reco_pros_columns[int(match.group(1))] = col
+        self.journeys_columns = dict(sorted(self.journeys_columns.items()))
+        self.pro_journeys_columns = dict(
+            sorted(self.pro_journeys_columns.items()))
+        self._journeys = None
+        self._pro_journeys = None
+
+    @property
+    def journeys(self) -> pd.DataFrame:
+        """Get the data.freq_mod_journeys of the v2 records exploded into a long table.
+
+        Each row of the result is a distinct mode used in a journey of a record, with columns:
+        record (index of the record in df), journey_idx, mode, days and is_intermodal.
+        """
+        if self._journeys is None:
+            self._journeys = self._explode_journeys(self.df_v2)
+        return self._journeys
+
+    def _explode_journeys(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Explode the data.freq_mod_journeys columns into a long table."""
+        columns = ['record', 'journey_idx', 'mode', 'days', 'is_intermodal']
+        frames = []
+        for i, journey in self.journeys_columns.items():
+            if journey['days'] is None or len(journey['modes']) == 0:
+                continue
+            # one row per (record, mode), a mode is counted once per journey
+            df_i = df[journey['modes']].melt(
+                ignore_index=False, value_name='mode')
+            df_i = df_i[df_i['mode'].notna()].rename_axis(
+                'record').reset_index()[['record', 'mode']].drop_duplicates()
+            df_i['journey_idx'] = i
+            df_i['days'] = df_i['record'].map(
+                pd.to_numeric(df[journey['days']], errors='coerce'))
+            # intermodality if more than one mode, walking is not considered
+            inter = df_i[df_i['mode'] != 'walking'].groupby('record')[
+                'mode'].nunique()
+            df_i['is_intermodal'] = df_i['record'].isin(
+                inter.index[inter > 1])
+            frames.append(df_i)
+        if len(frames) == 0:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)[columns]
+
+    @property
+    def pro_journeys(self) -> pd.DataFrame:
+        """Get the data.freq_mod_pro_journeys of the v2 records melted into a long table.
+
+        Each row of the result is a pro journey of a record having days, with columns: record (index of
+        the record in df), journey_idx, mode, days, distance_km (from the workplace to the destination)
+        and distance_type (local, national, europe or inter). Rows are in journey and records order.
+        """
+        if self._pro_journeys is None:
+            self._pro_journeys = self._melt_pro_journeys(self.df_v2)
+        return self._pro_journeys
+
+    def _melt_pro_journeys(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Melt the data.freq_mod_pro_journeys columns into a long table."""
+        columns = ['record', 'journey_idx', 'mode',
+                   'days', 'distance_km', 'distance_type']
+        frames = []
+        for i, journey in self.pro_journeys_columns.items():
+            if journey['days'] is None:
+                continue
+            # destination and mode may be missing, the columns are then absent
+            frames.append(pd.DataFrame({
+                'record': df.index,
+                'journey_idx': i,
+                'mode': df[journey['mode']].astype(object) if journey['mode'] is not None else None,
+                'hex_id': df[journey['hex_id']].astype(object) if journey['hex_id'] is not None else None,
+                'days': pd.to_numeric(df[journey['days']], errors='coerce').astype(float),
+                'lat': get_column(df, 'data.workplace.lat'),
+                'lon': get_column(df, 'data.workplace.lon'),
+                'distance_km': pd.to_numeric(
+                    get_derived(df, f'derived.pro_journeys.{i}.distance_km'), errors='coerce').astype(float),
+                'distance_type': get_derived(df, f'derived.pro_journeys.{i}.distance_type').astype(object)},
+                index=df.index))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=columns)
+        journeys = pd.concat(frames, ignore_index=True)
+        # compute the distances that are not stored in the records
+        missing = journeys['distance_km'].isna()
+        if missing.any():
+            journeys_missing = journeys[missing]
+            distance_km = calculate_distances_to_h3(
+                journeys_missing['lat'], journeys_missing['lon'], journeys_missing['hex_id'], journeys_missing['mode'])
+            journeys.loc[missing, 'distance_km'] = distance_km
+            journeys.loc[missing, 'distance_type'] = np.select(
+                [distance_km < bound for _, bound in DISTANCE_TYPES],
+                [name for name, _ in DISTANCE_TYPES], 'inter')
+        return journeys[columns]
+
+
+class BaseStatsService:
+
+    def __init__(self, df: pd.DataFrame, context: StatsContext = None):
+        self.context = context if context is not None else StatsContext(df)
+        self.df = self.context.df
 
     def _get_records_v1(self) -> pd.DataFrame:
         """Get records with data.version as NaN"""
-        if 'data.version' not in self.df.columns:
-            return self.df.copy()
-        df_v1 = self.df[self.df['data.version'].isna()].copy()
-        return df_v1
+        return self.context.df_v1
 
     def _get_records_v2(self) -> pd.DataFrame:
         """Get records with data.version starting with '2.'"""
-        if 'data.version' not in self.df.columns:
-            return pd.DataFrame()
-        df_v2 = self.df[self.df['data.version'].notna(
-        ) & self.df['data.version'].str.startswith('2.')].copy()
-        return df_v2
-
-    def _calculate_distance(self, origin_lat: float, origin_lon: float, dest_lat: float, dest_lon: float) -> float:
-        """Calculate the distance between origin and destination locations."""
-        try:
-            from math import radians, cos, sin, acos
-            distance_km = 6371 * acos(
-                cos(radians(origin_lat)) *
-                cos(radians(dest_lat)) *
-                cos(radians(dest_lon) - radians(origin_lon)) +
-                sin(radians(origin_lat)) *
-                sin(radians(dest_lat))
-            )
-            return distance_km * 1.3  # factor for real distance
-        except Exception:
-            return 0
-
-    def _calculate_distance_to_h3(self, lat: float, lon: float, h3_index: str, mode: str) -> float:
-        """Calculate the distance between workplace and destination with a transport mode."""
-        try:
-            if pd.isna(h3_index):
-                return 0
-            # Hypothèse sur l'allongement des distances : en moyenne, 1.22 (network based vs real measured distances : https://journals.sagepub.com/doi/abs/10.3141/1804-28)
-            # On pourrait améliorer ca en cherchant la meme chose pour l'avion (études sur les détours/distances faites lorsqu'on doit attendre au dessus d'un aéroport plein...)
-            # Pareil pour le bateau (pour l'instant on applique 1.22 à tous)
-            avg_dist_coeff = {'train': 1.22, 'car': 1.22, 'bike': 1.22,
-                              'walk': 1.22, 'moto': 1.22, 'pub': 1.22, 'boat': 1.22, 'plane': 1.22}
-            if h3.latlng_to_cell(lat, lon, h3.get_resolution(h3_index)) == h3_index:
-                # Si meme hexagone (apres mise à la resolution choisie par l'utilisateur), on prend une distance moyenne de la taille d'une arrête de l'hexagone.
-                return h3.average_hexagon_edge_length(h3.get_resolution(h3_index))
-            else:
-                # Si pas meme hexagone, on convertit le centre du h3 sélectionné en h3 plus petit pour calculer des distances plus précises
-                return h3.great_circle_distance(h3.cell_to_latlng(h3.cell_to_center_child(h3_index, 9)),
-                                                (lat, lon)) * avg_dist_coeff[mode]
-        except Exception:
-            return 0
-
-    def _calculate_distance_home_to_work(self, row):
-        """Calculate distance from home to workplace for a record."""
-        origin_lat = float(row['data.origin.lat'])
-        origin_lon = float(row['data.origin.lon'])
-        work_lat = float(row['data.workplace.lat'])
-        work_lon = float(row['data.workplace.lon'])
-        return self._calculate_distance(origin_lat, origin_lon, work_lat, work_lon)
+        return self.context.df_v2
+
+    def _get_distances_home_to_work(self) -> pd.Series:
+        """Get the distance from home to workplace of each record."""
+        return self.context.derived['distance_km']
@@ -1,6 +1,8 @@
+import numpy as np
 import pandas as pd
 from api.models.query import EmissionReductions, Emissions
-from api.services.stats.commons import BaseStatsService, MODES, MODES_PRO
+from api.services.stats.accumulators import EmissionsAccumulator
+from api.services.stats.commons import BaseStatsService, StatsContext, MODES, MODES_PRO
 
 MODE_EMISSIONS = {
     'walking': 0,
@@ -25,65 +27,46 @@ MODE_EMISSIONS = {
     'inter': 56  # TODO: make it dynamic, depending on observed modes over the whole dataset
 }
 
+# recommendations use different terms than the modes
+RECO_MODE_NAMES = {'covoit': 'carpool', 'velo': 'bike',
+                   'marche': 'walking', 'tpu': 'pub'}
+
 
 class EmissionsService(BaseStatsService):
 
-    def __init__(self, df: pd.DataFrame):
-        super().__init__(df)
-        # Calculate distance_km to workplace for each record
-        self.df['distance_km'] = self.df.apply(
-            lambda row: self._calculate_distance_home_to_work(row), axis=1)
+    def __init__(self, df: pd.DataFrame, context: StatsContext = None):
+        super().__init__(df, context)
+        self._journeys_emissions = None
 
     def compute_modes_emissions(self, apply_reco: bool = False) -> list[Emissions]:
         """Compute all CO2 emissions from a DataFrame of records."""
+        return self.accumulate_modes_emissions(apply_reco).to_emissions(len(self.df))
+
+    def accumulate_modes_emissions(self, apply_reco: bool = False) -> EmissionsAccumulator:
+        """Accumulate all CO2 emissions from a DataFrame of records, without rounding."""
 
         # v1: count emissions from legacy fields
         df_v1 = self._get_records_v1()
-        results_v1 = []
+        emissions = EmissionsAccumulator()
         for mode in MODES:
-            results_v1.extend(self._compute_mode_emissions_v1(
-                df_v1, mode, apply_reco))
-        results = self._merge_emissions([], results_v1)
+            self._compute_mode_emissions_v1(
+                df_v1, mode, emissions, apply_reco)
 
         # v2: count emissions from data.freq_mod_journeys
         df_v2 = self._get_records_v2()
         if not df_v2.empty:
-            results_v2 = []
-            for mode in MODES:
-                results_v2.extend(self._compute_mode_emissions_v2(
-                    df_v2, mode, apply_reco))
             # merge v1 and v2 results
-            for em_v2 in results_v2:
-                # find in results the one with same mode
-                em_v1 = next(
-                    (e for e in results if e.mode == em_v2.mode), None)
-                if em_v1 is None:
-                    results.append(em_v2)
-                else:
-                    em_v1.total += em_v2.total
-                    em_v1.distances += em_v2.distances
-                    em_v1.journeys += em_v2.journeys
-                    em_v1.emissions += em_v2.emissions
+            emissions.merge(
+                self._compute_modes_emissions_v2(df_v2, apply_reco))
 
-        # finalize totals
-        for emission in results:
-            emission.total = len(self.df)
-            # round distances, emissions
-            emission.distances = round(emission.distances, 3)
-            emission.emissions = round(emission.emissions, 3)
-        # filter out emissions with zero emissions
-        results = [e for e in results if e.emissions > 0]
-
-        return results
+        return emissions
 
     def compute_modes_emission_reductions(self) -> list[EmissionReductions]:
         """Compute all CO2 emission reductions from a DataFrame of records."""
         df_v2 = self._get_records_v2()
         results = []
         if not df_v2.empty:
-            for mode in MODES:
-                results.extend(
-                    self._compute_mode_emission_reductions_v2(df_v2, mode))
+            results = self._compute_modes_emission_reductions_v2(df_v2)
         # finalize totals
         for reduction in results:
             reduction.total = len(df_v2)
@@ -95,314 +78,209 @@ class EmissionsService(BaseStatsService):
 
     def compute_modes_pro_emissions(self, apply_reco: bool = False) -> list[Emissions]:
         """Compute all CO2 emissions from a DataFrame of records for pro journeys."""
+        return self.accumulate_modes_pro_emissions(apply_reco).to_emissions(len(self._get_records_v2()))
+
+    def accumulate_modes_pro_emissions(self, apply_reco: bool = False) -> EmissionsAccumulator:
+        """Accumulate all CO2 emissions from a DataFrame of records for pro journeys, without rounding."""
         # v1: cannot compute pro emissions from v1 data
 
         # v2: count emissions from data.freq_mod_pro_journeys
         df_v2 = self._get_records_v2()
-        results = []
+        emissions = EmissionsAccumulator()
         if not df_v2.empty:
-            for mode in MODES_PRO:
-                results.extend(
-                    self._compute_mode_pro_emissions_v2(df_v2, mode, apply_reco))
+            emissions.merge(self._compute_modes_pro_emissions_v2(df_v2))
 
-        # finalize totals
-        for emission in results:
-            emission.total = len(df_v2)
-            # round distances, emissions
-            emission.distances = round(emission.distances, 3)
-            emission.emissions = round(emission.emissions, 3)
-        # filter out emissions with zero emissions
-        results = [e for e in results if e.emissions > 0]
-
-        return results
+        return emissions
 
     #
     # Internal functions
     #
 
-    def _compute_mode_emissions_v1(self, df: pd.DataFrame, mode: str, apply_reco: bool = False) -> list[Emissions]:
-        """Compute all CO2 emissions from a DataFrame of records."""
-        emissions = Emissions(
-            mode=mode, total=len(df), distances=0, journeys=0, emissions=0)
+    def _compute_mode_emissions_v1(self, df: pd.DataFrame, mode: str, emissions: EmissionsAccumulator, apply_reco: bool = False) -> None:
+        """Accumulate all CO2 emissions from a DataFrame of records."""
         # Find the column name for the mode
         col_name = f'data.freq_mod_{mode}'
         if col_name not in df.columns:
-            return [emissions]
+            emissions.add(mode)
+            return
 
         # Subset the dataframe for the specific mode, filtered by colname not na
-        df_mode = df[df[col_name].notna()]
+        df_mode = df[[col_name, 'typo.reco.reco_dt2.0']]
+        df_mode = df_mode[df_mode[col_name].notna()]
         if len(df_mode) == 0:
-            return [emissions]
+            emissions.add(mode)
+            return
 
+        distances = self._get_distances_home_to_work().loc[df_mode.index]
         if apply_reco:
             # replace non sustainable modes (car, moto) by recommended mode
-            df_mode = df_mode.copy()
-            df_mode['applied_mode'] = df_mode.apply(
-                lambda row: row['typo.reco.reco_dt2.0'],
-                axis=1
-            )
-            # normalize mode naming
-            df_mode['applied_mode'] = self._normalize_mode_name(
-                df_mode, 'applied_mode')
-            # make Emissions per applied_mode
-            emissions_list = []
-            for applied_mode in df_mode['applied_mode'].unique():
-                df_applied_mode = df_mode[df_mode['applied_mode']
-                                          == applied_mode]
-                em = Emissions(
-                    mode=applied_mode,
-                    total=len(df_applied_mode),
-                    distances=float(sum(df_applied_mode['distance_km'])),
-                    journeys=int(sum(
-                        df_applied_mode[col_name] * 45 * 2)),
-                    emissions=float(sum(
-                        df_applied_mode['distance_km'] * df_applied_mode[col_name] * 45 * 2 * MODE_EMISSIONS[applied_mode] / 1000))
-                )
-                emissions_list.append(em)
-            return emissions_list
+            applied_mode = self._normalize_mode_names(
+                df_mode['typo.reco.reco_dt2.0'])
+            journeys = df_mode[col_name] * 45 * 2
+            df_applied = pd.DataFrame({
+                'applied_mode': applied_mode,
+                'distances': distances,
+                'journeys': journeys,
+                'emissions': distances * journeys * applied_mode.map(MODE_EMISSIONS) / 1000
+            })
+            # accumulate emissions per applied_mode
+            sums = df_applied.groupby('applied_mode', sort=False).sum()
+            for applied_mode, row in sums.iterrows():
+                emissions.add(applied_mode, float(row.distances),
+                              int(row.journeys), float(row.emissions))
         else:
-            emissions.distances = float(df_mode['distance_km'].sum())
-            emissions.journeys = int(df_mode[col_name].sum() * 45 * 2)
-            emissions.emissions = float(sum(
-                df_mode['distance_km'] * df_mode[col_name] * 45 * 2 * MODE_EMISSIONS[mode] / 1000))
-            return [emissions]
+            emissions.add(
+                mode,
+                float(distances.sum()),
+                int(df_mode[col_name].sum() * 45 * 2),
+                float((distances * df_mode[col_name] * 45 * 2 * MODE_EMISSIONS[mode] / 1000).sum()))
 
-    def _compute_mode_emissions_v2(self, df: pd.DataFrame, mode: str, apply_reco: bool = False) -> list[Emissions]:
+    def _compute_modes_emissions_v2(self, df: pd.DataFrame, apply_reco: bool = False) -> EmissionsAccumulator:
         """Compute all CO2 emissions from a DataFrame of records."""
-        def compute_mode_emissions(row, mode, i):
-            modes = []
-            for col in row.index:
-                if col.startswith(f'data.freq_mod_journeys.{i}.modes.'):
-                    val = row[col]
-                    if not pd.isna(val):
-                        modes.append(val)
-            modes = set(modes)
+        emissions = EmissionsAccumulator()
+        journeys, _, co2 = self._get_journeys_emissions()
+        if journeys.empty:
+            return emissions
+        km = journeys['days'] * journeys['distance_km'] * 45 * 2
 
-            # if the train is one of the modes, consider that 80% of the distance is done by train,
-            # then split the rest equally among the other modes used.
-            days = row[f'data.freq_mod_journeys.{i}.days']
-            dist = row['distance_km']
-            co2 = 0
-            if 'train' in modes:
-                if mode == 'train':
-                    co2 += 0.8 * 45 * 2 * \
-                        (days * dist * MODE_EMISSIONS['train'] / 1000)
-                elif mode in modes:
-                    co2 += 0.2 / (len(modes) - 1) * 45 * 2 * \
-                        (days * dist * MODE_EMISSIONS[mode] / 1000)
-            elif mode in modes:
-                co2 += 1 / len(modes) * 45 * 2 * \
-                    (days * dist * MODE_EMISSIONS[mode] / 1000)
-            em_factor = co2 * 1000 / (45 * 2 * days * dist)
-            return [co2, em_factor]
-
-        # New data version: get the series from data.freq_mod_journeys
-        col_days = df.columns[df.columns.str.contains(
-            r'^data\.freq_mod_journeys\..*\.days$', regex=True)]
+        if apply_reco:
+            # Emissions for recommended modes replacing non sustainable modes
+            applied_mode = self._normalize_mode_names(
+                df['typo.reco.reco_dt2.0']).dropna()
+            # emissions of the applied mode, if it is one of the journey modes
+            applied = journeys.index.get_level_values(
+                'record').map(applied_mode)
+            cols = co2.columns.get_indexer(applied)
+            mode_emissions = np.where(
+                cols >= 0, co2.to_numpy()[np.arange(len(co2)), cols], 0)
+            df_applied = pd.DataFrame({
+                'applied_mode': applied,
+                'distances': km.to_numpy(),
+                'journeys': np.trunc(journeys['days'].to_numpy() * 45 * 2),
+                'emissions': mode_emissions
+            })
+            # filter only positive emissions
+            sums = df_applied[df_applied['emissions'] > 0].groupby(
+                'applied_mode').sum()
+            # make emissions per applied_mode
+            for mode in applied_mode.unique():
+                if mode in sums.index:
+                    emissions.add(mode, float(sums.loc[mode, 'distances']), int(
+                        sums.loc[mode, 'journeys']), float(sums.loc[mode, 'emissions']))
+                else:
+                    emissions.add(mode)
+            return emissions
 
-        all_emissions = []
-        for i in range(len(col_days)):
-            # print("journey:", i)
-            col_modes_i = df.columns[df.columns.str.startswith(
-                f'data.freq_mod_journeys.{str(i)}.modes.')]
-            if col_modes_i.empty:
+        # Emissions for each actual mode
+        for mode in MODES:
+            if mode not in co2.columns:
+                emissions.add(mode)
                 continue
-            col_days_i = col_days[i]
-            # make a dataframe with only i columns
-            df_i = df[['distance_km', col_days_i, 'typo.reco.reco_dt2.0'] +
-                      col_modes_i.tolist()].copy()
-            if apply_reco:
-                # Emissions for recommended modes replacing non sustainable modes
-                # replace non sustainable modes (car, moto) by recommended mode
-                df_i['applied_mode'] = df_i.apply(
-                    lambda row: row['typo.reco.reco_dt2.0'],
-                    axis=1
-                )
-                # normalize mode naming
-                df_i['applied_mode'] = self._normalize_mode_name(
-                    df_i, 'applied_mode')
-                # make emissions per applied_mode
-                emissions_dict = {}
-                for idx, row in df_i.iterrows():
-                    applied_mode = row['applied_mode']
-                    co2, em_factor = compute_mode_emissions(
-                        row, applied_mode, i)
-                    if applied_mode not in emissions_dict:
-                        emissions_dict[applied_mode] = Emissions(
-                            mode=applied_mode,
-                            total=len(df),
-                            distances=0,
-                            journeys=0,
-                            emissions=0
-                        )
-                    emissions_entry = emissions_dict[applied_mode]
-                    if co2 > 0:
-                        emissions_entry.distances += float(
-                            row['distance_km'] * row[col_days_i] * 45 * 2)
-                        emissions_entry.journeys += int(
-                            row[col_days_i] * 45 * 2)
-                        emissions_entry.emissions += float(co2)
-                return list(emissions_dict.values())
-            else:
-                # Emissions for requested mode only
-                emissions = Emissions(
-                    mode=mode,
-                    total=len(df),
-                    distances=0,
-                    journeys=0,
-                    emissions=0
-                )
-                # compute emissions factor
-                df_i[['mode_emissions', 'em_factor']] = df_i.apply(
-                    lambda row: compute_mode_emissions(row, mode, i), axis=1, result_type='expand')
-                # filter only positive emissions
-                df_i = df_i[df_i['mode_emissions'] > 0]
-                # print(df_i)
-                emissions.distances += float(sum(
-                    df_i['distance_km'] * df_i[col_days_i] * 45 * 2))
-                emissions.journeys += int(sum(
-                    df_i[col_days_i] * 45 * 2))
-                emissions.emissions += float(sum(df_i['mode_emissions']))
-                all_emissions.append(emissions)
-
-        return all_emissions
-
-    def _compute_mode_emission_reductions_v2(self, df: pd.DataFrame, mode: str) -> list[EmissionReductions]:
+            # filter only positive emissions
+            positive = co2[mode] > 0
+            emissions.add(
+                mode,
+                float(km[positive].sum()),
+                sum(int(days) for days in (journeys['days'][positive] * 45 * 2).groupby(level='journey_idx').sum()),
+                float(co2[mode][positive].sum()))
+        return emissions
+
+    def _compute_modes_emission_reductions_v2(self, df: pd.DataFrame) -> list[EmissionReductions]:
         """Compute all CO2 emission reductions from a DataFrame of records."""
-        def compute_mode_reduction(row, mode, i):
-            modes = []
-            for col in row.index:
-                if col.startswith(f'data.freq_mod_journeys.{i}.modes.'):
-                    val = row[col]
-                    if not pd.isna(val):
-                        modes.append(val)
-            modes = set(modes)
-
-            # is intermodality if more than one mode, excluding walking
-            inter = len(modes - {'walking', 'marche'}) > 1
-
-            days = row[f'data.freq_mod_journeys.{i}.days']
-            dist = row['distance_km']
-            co2_actual = 0
-            co2_reco = 0
-            if mode in modes:
-                co2_actual += 1 / len(modes) * 45 * 2 * \
-                    (days * dist * MODE_EMISSIONS[mode] / 1000)
-            if row['typo.reco.reco_dt2.0'] == mode:
-                co2_reco += 1 / len(modes) * 45 * 2 * \
-                    (days * dist * MODE_EMISSIONS[mode] / 1000)
-            reduction = co2_actual - co2_reco
-            return reduction
-        # New data version: get the series from data.freq_mod_journeys
-        col_days = df.columns[df.columns.str.contains(
-            r'^data\.freq_mod_journeys\..*\.days$', regex=True)]
-        reduction_total = 0
-        for i in range(len(col_days)):
-            # print("journey:", i)
-            col_modes_i = df.columns[df.columns.str.startswith(
-                f'data.freq_mod_journeys.{str(i)}.modes.')]
-            if col_modes_i.empty:
-                continue
-            col_days_i = col_days[i]
-            # make a dataframe with only i columns
-            df_i = df[['distance_km', col_days_i,
-                       'typo.reco.reco_dt2.0'] + col_modes_i.tolist()].copy()
-            # compute reduction
-            df_i['mode_reduction'] = df_i.apply(
-                lambda row: compute_mode_reduction(row, mode, i), axis=1)
+        journeys, membership, _ = self._get_journeys_emissions()
+        reductions = []
+        if journeys.empty:
+            return reductions
+        km = journeys['days'] * journeys['distance_km'] * 45 * 2
+        # actual emissions are split equally among the modes used
+        share = 1 / membership.sum(axis=1)
+        reco = journeys.index.get_level_values('record').map(
+            df['typo.reco.reco_dt2.0'])
+        for mode in MODES:
+            actual = membership[mode].astype(
+                int) if mode in membership.columns else 0
+            reduction = (actual - (reco == mode).astype(int)) * \
+                share * km * MODE_EMISSIONS[mode] / 1000
             # sum only positive reductions
-            reduction_total += float(
-                sum(df_i['mode_reduction'][df_i['mode_reduction'] > 0]))
-        reduction = EmissionReductions(
-            mode=mode,
-            total=len(df),
-            reduced=reduction_total
-        )
-        return [reduction]
-
-    def _compute_mode_pro_emissions_v2(self, df: pd.DataFrame, mode: str, apply_reco: bool = False) -> list[Emissions]:
-        """Compute all CO2 emissions from a DataFrame of records."""
-
-        def calculate_distance(row, i):
-            lat = float(row['data.workplace.lat'])
-            lon = float(row['data.workplace.lon'])
-            h3_index = row[f'data.freq_mod_pro_journeys.{str(i)}.hex_id']
-            mode = row[f'data.freq_mod_pro_journeys.{str(i)}.mode']
-            return self._calculate_distance_to_h3(lat, lon, h3_index, mode)
-
-        def compute_mode_emissions(row, mode, i):
-            # if the train is one of the modes, consider that 80% of the distance is done by train,
-            # then split the rest equally among the other modes used.
-            days = row[f'data.freq_mod_pro_journeys.{i}.days']
-            dist = row['distance_km']
-            co2 = 2 * (days * dist * MODE_EMISSIONS[mode] / 1000)
-            em_factor = co2 * 1000 / (2 * days * dist)
-            return [co2, em_factor]
-
-        # New data version: get the series from data.freq_mod_journeys
-        col_days = df.columns[df.columns.str.contains(
-            r'^data\.freq_mod_pro_journeys\..*\.days$', regex=True)]
-        emissions = Emissions(
-            mode=mode,
-            total=len(df),
-            distances=0,
-            journeys=0,
-            emissions=0
-        )
-        for i in range(len(col_days)):
-            # print("journey:", i)
-            col_mode_i = f'data.freq_mod_pro_journeys.{str(i)}.mode'
-            if col_mode_i not in df.columns:
-                continue
-            col_hexid_i = f'data.freq_mod_pro_journeys.{str(i)}.hex_id'
-            if col_hexid_i not in df.columns:
-                continue
-            col_days_i = col_days[i]
-            # filter only rows where mode matches
-            df_i = df[df[col_mode_i] == mode]
-            if len(df_i) == 0:
-                continue
-            # make a dataframe with only i columns and workplace lat/lon
-            df_i = df_i[['data.workplace.lat', 'data.workplace.lon',
-                         col_days_i, col_mode_i, col_hexid_i]].copy()
-            # Calculate distance_km to pro travel destination for each record
-            df_i['distance_km'] = df.apply(
-                lambda row: calculate_distance(row, i), axis=1)
-            # compute emissions factor
-            df_i[['mode_emissions', 'em_factor']] = df_i.apply(
-                lambda row: compute_mode_emissions(row, mode, i), axis=1, result_type='expand')
-            # filter only positive emissions
-            df_i = df_i[df_i['mode_emissions'] > 0]
-            # print(df_i)
-            emissions.distances += float(
-                sum(df_i['distance_km'] * df_i[col_days_i] * 2))
-            emissions.journeys += int(sum(df_i[col_days_i] * 2))
-            emissions.emissions += float(sum(df_i['mode_emissions']))
-
-        return [emissions]
-
-    def _merge_emissions(self, emissions1: list[Emissions], emissions2: list[Emissions]) -> list[Emissions]:
-        """Merge each Emissions into a list of Emissions."""
-        for em2 in emissions2:
-            em1 = next(
-                (e for e in emissions1 if e.mode == em2.mode), None)
-            if not em1:
-                emissions1.append(em2)
-                continue
-            em = Emissions(
-                mode=em1.mode,
-                total=em1.total + em2.total,
-                distances=em1.distances + em2.distances,
-                journeys=em1.journeys + em2.journeys,
-                emissions=em1.emissions + em2.emissions
-            )
-            # replace in emissions1
-            for i in range(len(emissions1)):
-                if emissions1[i].mode == em.mode:
-                    emissions1[i] = em
-                    break
-
-        return emissions1
+            reduction_total = float(reduction[reduction > 0].sum())
+            reductions.append(EmissionReductions(
+                mode=mode,
+                total=len(df),
+                reduced=reduction_total
+            ))
+        return reductions
+
+    def _get_journeys_emissions(self) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        """Get the CO2 emissions of each mode for each journey of data.freq_mod_journeys, computed once.
+
+        Returns:
+            tuple: the journeys days and distance_km, the mode-membership matrix and the CO2 emissions matrix,
+                all indexed by (record, journey_idx), matrices having one column per mode.
+        """
+        if self._journeys_emissions is not None:
+            return self._journeys_emissions
+        long = self.context.journeys
+        if long.empty:
+            empty = pd.DataFrame(index=pd.MultiIndex.from_arrays(
+                [[], []], names=['record', 'journey_idx']))
+            self._journeys_emissions = (
+                empty.assign(days=[], distance_km=[]), empty, empty)
+            return self._journeys_emissions
+        # modes used by each journey, built without the intermediate frames of a crosstab
+        membership = pd.get_dummies(long['mode']).groupby(
+            [long['record'], long['journey_idx']]).any()
+        membership = membership.loc[:, membership.any()]
+        journeys = pd.DataFrame({
+            'days': long.groupby(['record', 'journey_idx'])['days'].first(),
+        }).reindex(membership.index)
+        journeys['distance_km'] = membership.index.get_level_values(
+            'record').map(self._get_distances_home_to_work()).to_numpy()
+
+        modes = membership.columns
+        n_modes = membership.sum(axis=1).to_numpy()
+        has_train = membership['train'].to_numpy() if 'train' in modes else np.zeros(
+            len(membership), dtype=bool)
+        # if the train is one of the modes, consider that 80% of the distance is done by train,
+        # then split the rest equally among the other modes used.
+        other_share = np.divide(0.2, n_modes - 1, out=np.zeros(len(n_modes)),
+                                where=n_modes > 1)
+        share = np.where(has_train, other_share, 1 / n_modes)[:, None] * \
+            membership.to_numpy()
+        if 'train' in modes:
+            share[:, modes.get_loc('train')] = np.where(has_train, 0.8, 0)
+        mode_emissions = np.array(
+            [MODE_EMISSIONS.get(mode, np.nan) for mode in modes])
+        km = (journeys['days'] * journeys['distance_km']).to_numpy()
+        co2 = share * 45 * 2 * (km[:, None] * mode_emissions / 1000)
+        self._journeys_emissions = (journeys, membership, pd.DataFrame(
+            co2, index=membership.index, columns=modes))
+        return self._journeys_emissions
+
+    def _compute_modes_pro_emissions_v2(self, df: pd.DataFrame) -> EmissionsAccumulator:
+        """Compute all modes CO2 emissions from a DataFrame of records for pro journeys."""
+        # New data version: one row per journey of data.freq_mod_pro_journeys, with its distance
+        journeys = self.context.pro_journeys
+        journeys = journeys[journeys['mode'].isin(MODES_PRO)]
+        days = journeys['days']
+        dist = journeys['distance_km']
+        co2 = 2 * (days * dist *
+                   journeys['mode'].map(MODE_EMISSIONS).astype(float) / 1000)
+        # only positive emissions, round trips
+        positive = co2 > 0
+        sums = pd.DataFrame({
+            'mode': journeys['mode'],
+            'journey_idx': journeys['journey_idx'],
+            'distances': dist * days * 2,
+            'journeys': days * 2,
+            'emissions': co2})[positive].groupby(['mode', 'journey_idx']).sum()
+
+        emissions = EmissionsAccumulator()
+        for mode in MODES_PRO:
+            emissions.add(mode)
+        for row in sums.itertuples():
+            emissions.add(row.Index[0], float(row.distances),
+                          int(row.journeys), float(row.emissions))
+        return emissions
 
     def _compute_mode_emissions_part(self, mode: str, modes: list[str], days: int, dist: float) -> list[float]:
         """Compute CO2 emissions for a mode given the other modes used, days and distance."""
@@ -420,10 +298,7 @@ class EmissionsService(BaseStatsService):
         em_factor = co2 * 1000 / (45 * 2 * days * dist)
         return [co2, em_factor]
 
-    def _normalize_mode_name(self, df: pd.DataFrame, column: str) -> str:
+    def _normalize_mode_names(self, modes: pd.Series) -> pd.Series:
         """Normalize mode naming, because recommendations use different terms."""
-        if column not in df.columns:
-            return df[column]
-        df[column] = df[column].replace(
-            'covoit', 'carpool').replace('velo', 'bike').replace('marche', 'walking').replace('tpu', 'pub')
-        return df[column]
+        # categorical recommendations are renamed as plain values
+        return modes.astype(object).replace(RECO_MODE_NAMES)
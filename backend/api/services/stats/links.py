@@ -1,102 +1,84 @@
+import numpy as np
 import pandas as pd
-from api.models.query import Link, Links
-from api.services.stats.commons import BaseStatsService, MODES, MODES_PRO_V1
+from api.models.query import Links
+from api.services.stats.accumulators import LinksAccumulator
+from api.services.stats.commons import BaseStatsService, StatsContext, MODES, MODES_PRO_V1
 
 
 class LinksService(BaseStatsService):
 
-    def __init__(self, df: pd.DataFrame):
-        super().__init__(df)
+    def __init__(self, df: pd.DataFrame, context: StatsContext = None):
+        super().__init__(df, context)
 
     def compute_mode_reco_links(self) -> Links:
         """Compute all mode recommendation links from a DataFrame of records."""
         # v1: legacy data version
         df_v1 = self._get_records_v1()
-        links_v1 = self._compute_mode_reco_links_v1(df_v1)
+        links = self._compute_mode_reco_links_v1(df_v1)
 
         # v2: new data version
         df_v2 = self._get_records_v2()
-        links_v2 = Links(total=0, data=[])
         if not df_v2.empty:
-            links_v2 = self._compute_mode_reco_links_v2(df_v2)
+            # merge links of same source and target
+            links.merge(self._compute_mode_reco_links_v2(df_v2))
 
-        # merge links of same source and target
-        return self._merge_links(links_v1, links_v2)
+        return links.to_links()
 
     def compute_mode_reco_pro_links(self) -> Links:
         """Compute all mode recommendation links from a DataFrame of records."""
         # v1: legacy data version
         df_v1 = self._get_records_v1()
-        links_v1 = self._compute_mode_reco_pro_links_v1(df_v1)
+        links = self._compute_mode_reco_pro_links_v1(df_v1)
 
         # v2: new data version
         df_v2 = self._get_records_v2()
-        links_v2 = Links(total=0, data=[])
         if not df_v2.empty:
-            links_v2 = self._compute_mode_reco_pro_links_v2(df_v2)
+            # merge links of same source and target
+            links.merge(self._compute_mode_reco_pro_links_v2(df_v2))
 
-        # merge links of same source and target
-        return self._merge_links(links_v1, links_v2)
+        return links.to_links()
 
     #
     # Internal functions
     #
 
-    def _compute_mode_reco_links_v1(self, df: pd.DataFrame) -> Links:
+    def _compute_mode_reco_links_v1(self, df: pd.DataFrame) -> LinksAccumulator:
         """Compute all mode recommendation links from a DataFrame of records."""
-        counts = {}
+        frames = []
         for mode in MODES:
             col_name = f'data.freq_mod_{mode}'
             if col_name not in df.columns:
                 continue
-            df_mode = df[df[col_name].notna()]
-            for _, row in df_mode.iterrows():
-                reco = row['typo.reco.reco_dt2.0']
-                mod_count = int(row[col_name])
-                if mod_count <= 0:
-                    continue
-                mod_counts = counts.get(mode, {})
-                mod_counts[reco] = mod_counts.get(reco, 0) + 1
-                counts[mode] = mod_counts
-        links = [Link(source=mod, target=reco, value=int(count)) for mod,
-                 reco_counts in counts.items() for reco, count in reco_counts.items()]
-        return Links(total=len(df), data=links)
-
-    def _compute_mode_reco_links_v2(self, df: pd.DataFrame) -> Links:
+            # count records using the mode
+            mod_count = pd.to_numeric(df[col_name], errors='coerce')
+            frames.append(pd.DataFrame({
+                'source': mode,
+                'target': df.loc[np.trunc(mod_count) > 0, 'typo.reco.reco_dt2.0']
+            }))
+        return self._count_links(frames, len(df))
+
+    def _compute_mode_reco_links_v2(self, df: pd.DataFrame) -> LinksAccumulator:
         """Compute all mode recommendation links from a DataFrame of records."""
 
         # New data version: get the series from data.freq_mod_journeys
-        col_days = df.columns[df.columns.str.contains(
-            r'^data\.freq_mod_journeys\..*\.days$', regex=True)]
-        counts = {}
-        for i in range(len(col_days)):
-            col_modes_i = df.columns[df.columns.str.startswith(
-                f'data.freq_mod_journeys.{str(i)}.modes.')]
-            if col_modes_i.empty:
+        frames = []
+        for i, journey in self.context.journeys_columns.items():
+            col_modes_i = journey['modes']
+            col_days_i = journey['days']
+            if col_days_i is None or len(col_modes_i) == 0:
                 continue
-            col_days_i = col_days[i]
-            # make a dataframe with only i columns
-            df_i = df[[col_days_i] + col_modes_i.tolist() +
-                      ['typo.reco.reco_dt2.0']].copy()
-            # iterate rows
-            for _, row in df_i.iterrows():
-                days = row[col_days_i]
-                if pd.isna(days) or int(days) <= 0:
-                    continue
-                for col in col_modes_i:
-                    mode = row[col]
-                    if pd.isna(mode):
-                        continue
-                    reco = row['typo.reco.reco_dt2.0']
-                    mod_counts = counts.get(mode, {})
-                    mod_counts[reco] = mod_counts.get(reco, 0) + 1
-                    counts[mode] = mod_counts
-        data = [Link(source=mod, target=reco, value=int(count)) for mod,
-                reco_counts in counts.items() for reco, count in reco_counts.items()]
-        links = Links(total=len(df), data=data)
-        return links
-
-    def _compute_mode_reco_pro_links_v1(self, df: pd.DataFrame) -> Links:
+            # journeys with positive days
+            days = pd.to_numeric(df[col_days_i], errors='coerce')
+            df_i = df[col_modes_i + ['typo.reco.reco_dt2.0']]
+            df_i = df_i[np.trunc(days) > 0]
+            # melt modes of the journey, by record then by mode column
+            modes = df_i[col_modes_i].to_numpy().ravel()
+            recos = np.repeat(
+                df_i['typo.reco.reco_dt2.0'].to_numpy(), len(col_modes_i))
+            frames.append(pd.DataFrame({'source': modes, 'target': recos}))
+        return self._count_links(frames, len(df))
+
+    def _compute_mode_reco_pro_links_v1(self, df: pd.DataFrame) -> LinksAccumulator:
         """Compute all mode recommendation links from a DataFrame of records."""
         area_reco = {
             'local': 'typo.reco_pro.reco_pro_loc',
@@ -104,71 +86,56 @@ class LinksService(BaseStatsService):
             'europe': 'typo.reco_pro.reco_pro_reg',
             'inter': 'typo.reco_pro.reco_pro_int'
         }
-        counts = {}
+        frames = []
         for area_mode in MODES_PRO_V1:
-          # split mode into area and transport mode
+            # split mode into area and transport mode
             area, mode = area_mode.split('_', 1)
             col_name = f'data.freq_mod_{area}_{mode}'
-            if col_name not in df.columns:
+            if col_name not in df.columns or area not in area_reco:
                 continue
-            df_mode = df[df[col_name].notna()]
-            for _, row in df_mode.iterrows():
-                mod_count = int(row[col_name])
-                if mod_count <= 0:
-                    continue
-                if area not in area_reco:
-                    continue
-                reco = row[area_reco[area]]
-                mod_counts = counts.get(mode, {})
-                mod_counts[reco] = mod_counts.get(reco, 0) + 1
-                counts[mode] = mod_counts
-        links = [Link(source=mod, target=reco, value=int(count)) for mod,
-                 reco_counts in counts.items() for reco, count in reco_counts.items()]
-        return Links(total=len(df), data=links)
-
-    def _compute_mode_reco_pro_links_v2(self, df: pd.DataFrame) -> Links:
+            if area_reco[area] not in df.columns:
+                continue
+            # count records using the mode
+            mod_count = pd.to_numeric(df[col_name], errors='coerce')
+            frames.append(pd.DataFrame({
+                'source': mode,
+                'target': df.loc[np.trunc(mod_count) > 0, area_reco[area]]
+            }))
+        return self._count_links(frames, len(df))
+
+    def _compute_mode_reco_pro_links_v2(self, df: pd.DataFrame) -> LinksAccumulator:
         """Compute all mode recommendation links from a DataFrame of records."""
 
         # New data version: get the series from data.freq_mod_pro_journeys
-        col_days = df.columns[df.columns.str.contains(
-            r'^data\.freq_mod_pro_journeys\..*\.days$', regex=True)]
-        counts = {}
-        for i in range(len(col_days)):
-            col_mode_i = f'data.freq_mod_pro_journeys.{str(i)}.mode'
-            if col_mode_i not in df.columns:
-                continue
-            col_reco_i = f"typo.reco_pro.reco_pros.{str(i)}"
-            if col_reco_i not in df.columns:
+        frames = []
+        for i, journey in self.context.pro_journeys_columns.items():
+            col_mode_i = journey['mode']
+            col_reco_i = self.context.reco_pros_columns.get(i)
+            if journey['days'] is None or col_mode_i is None or col_reco_i is None:
                 continue
-            # make a dataframe with only i columns
-            df_i = df[[col_mode_i, col_reco_i]].copy()
-            # iterate rows
-            for _, row in df_i.iterrows():
-                mode = row[col_mode_i]
-                reco = row[col_reco_i]
-                if pd.isna(mode) or pd.isna(reco):
-                    continue
-                mod_counts = counts.get(mode, {})
-                mod_counts[reco] = mod_counts.get(reco, 0) + 1
-                counts[mode] = mod_counts
-        data = [Link(source=mod, target=reco, value=int(count)) for mod,
-                reco_counts in counts.items() for reco, count in reco_counts.items()]
-        links = Links(total=len(df), data=data)
+            frames.append(pd.DataFrame({
+                'source': df[col_mode_i].to_numpy(),
+                'target': df[col_reco_i].to_numpy()
+            }))
+        return self._count_links(frames, len(df))
+
+    def _count_links(self, frames: list[pd.DataFrame], total: int) -> LinksAccumulator:
+        """Count the links of source and target pairs.
+
+        Links are ordered by source first appearance, then by target first appearance.
+        """
+        links = LinksAccumulator(total)
+        if len(frames) == 0:
+            return links
+        pairs = pd.concat(frames, ignore_index=True).dropna()
+        counts = pairs.groupby(['source', 'target'], sort=False, observed=True).size()
+        if counts.empty:
+            return links
+        # order by source first appearance
+        source_order = {source: i for i,
+                        source in enumerate(pd.unique(pairs['source']))}
+        order = counts.index.get_level_values('source').map(source_order)
+        counts = counts.iloc[np.argsort(order.to_numpy(), kind='stable')]
+        for (mod, reco), count in counts.items():
+            links.add(mod, reco, int(count))
         return links
-
-    def _merge_links(self, links1: Links, links2: Links) -> Links:
-        """Merge two Links into one Links."""
-        # merge links of same source and target
-        merged_data = links1.data.copy()
-        for link in links2.data:
-            existing_link = next(
-                (l for l in merged_data if l.source == link.source and l.target == link.target), None)
-            if existing_link:
-                existing_link.value += link.value
-            else:
-                merged_data.append(link)
-        merged_links = Links(
-            total=links1.total + links2.total,
-            data=merged_data
-        )
-        return merged_links
@@ -0,0 +1,109 @@
+import asyncio
+import multiprocessing
+import pickle
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import HTTPException
+from api.config import config
+from api.models.query import Stats
+from api.services.stats.accumulators import StatsAggregates
+from api.services.stats.commons import compute_derived
+from api.services.stats.stats import StatsService
+
+
+def serialize_dataframe(df: pd.DataFrame, sections: list[str] = None) -> bytes:
+    """Serialize a DataFrame of flattened records to be sent to a worker process.
+
+    Only the columns used by the statistics sections are kept, and pickle protocol 5 stores the
+    column blocks as contiguous buffers.
+    """
+    df = StatsService().select_columns(df, sections)
+    return pickle.dumps(df, protocol=5)
+
+
+def compute_stats(data: bytes, sections: list[str] = None) -> Stats:
+    """Compute the statistics of a serialized DataFrame, in a worker process."""
+    with pd.option_context('mode.copy_on_write', True):
+        return StatsService().compute_stats(pickle.loads(data), sections)
+
+
+def compute_aggregates(df: pd.DataFrame) -> StatsAggregates:
+    """Compute the statistics aggregates of a DataFrame, in a worker process."""
+    return StatsService().compute_aggregates(df)
+
+
+class StatsPool:
+    """Bounded pool of worker processes computing the statistics, off the event loop."""
+
+    def __init__(self, size: int = 2, queue_size: int = 8):
+        self.size = size
+        self.queue_size = queue_size
+        # submitted computations, running or waiting for a worker
+        self.pending = 0
+        self._executor: ProcessPoolExecutor | None = None
+
+    async def compute_stats(self, df: pd.DataFrame, sections: list[str] = None) -> Stats:
+        """Compute the statistics of a DataFrame of flattened records in a worker process.
+
+        Args:
+            df (pd.DataFrame): The flattened records.
+            sections (list[str], optional): The statistics to compute. Defaults to all.
+
+        Raises:
+            HTTPException: 503 if too many computations are pending.
+        """
+        if self.size <= 0:
+            return StatsService().compute_stats(df, sections)
+        if self.pending >= self.size + self.queue_size:
+            raise HTTPException(
+                status_code=503, detail="Too many statistics computations, retry later", headers={"Retry-After": "10"})
+        self.pending += 1
+        try:
+            data = serialize_dataframe(df, sections)
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), compute_stats, data, sections)
+        except BrokenProcessPool:
+            # a worker died (e.g. out of memory), start a new pool on next computation
+            self.shutdown()
+            raise HTTPException(
+                status_code=503, detail="Statistics computation failed, retry later")
+        finally:
+            self.pending -= 1
+
+    async def compute_aggregates(self, df: pd.DataFrame) -> StatsAggregates:
+        """Compute the statistics aggregates of a DataFrame of flattened records in a worker process.
+
+        Computations wait for a worker, they are not limited by the queue size.
+        """
+        return await self._run(compute_aggregates, df)
+
+    async def compute_derived(self, df: pd.DataFrame) -> list[dict]:
+        """Compute the derived metrics of a DataFrame of flattened records in a worker process, see compute_aggregates."""
+        return await self._run(compute_derived, df)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, fn, df: pd.DataFrame):
+        if self.size <= 0:
+            return fn(df)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, df)
+        except BrokenProcessPool:
+            # a worker died, start a new pool on next computation
+            self.shutdown()
+            raise
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn fresh interpreters, forking the event loop threads is unsafe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.size, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+
+stats_pool = StatsPool(config.STATS_POOL_SIZE, config.STATS_POOL_QUEUE_SIZE)
+# the record writes do not wait for the statistics requests computations
+record_stats_pool = StatsPool(config.RECORD_STATS_POOL_SIZE, 0)
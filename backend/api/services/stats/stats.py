@@ -1,63 +1,177 @@
+import re
+from logging import DEBUG, debug, getLogger
 import pandas as pd
 from api.models.query import Stats
+from api.services.stats.accumulators import StatsAggregates
+from api.services.stats.commons import StatsContext, MODES, MODES_PRO_V1, match_columns
 from api.services.stats.emissions import EmissionsService
 from api.services.stats.frequencies import FrequenciesService
 from api.services.stats.links import LinksService
 
+# Flattened record columns used by the statistics sections: exact names or prefixes of nested fields
+COMMON_COLUMNS = ['data.version', 'typo.reco.reco_dt2']
+MODES_COLUMNS = [f'data.freq_mod_{mode}' for mode in MODES] + \
+    ['data.freq_mod_journeys']
+DISTANCE_COLUMNS = ['data.origin', 'data.workplace',
+                    'derived.version', 'derived.distance_km']
+PRO_JOURNEYS_COLUMNS = ['data.freq_mod_pro_journeys', 'data.workplace',
+                        'derived.version', 'derived.pro_journeys']
+SECTION_COLUMNS = {
+    # individual
+    'frequencies': ['data.equipments', 'data.constraints', 'data.travel_time'],
+    'mode_frequencies': MODES_COLUMNS,
+    'mode_emissions': MODES_COLUMNS + DISTANCE_COLUMNS,
+    'reco_mode_emissions': MODES_COLUMNS + DISTANCE_COLUMNS,
+    'mode_links': MODES_COLUMNS,
+    # professional
+    'pro_frequencies': ['typo.reco_pro'],
+    'pro_mode_frequencies': [f'data.freq_mod_pro_{mode}' for mode in MODES_PRO_V1] + PRO_JOURNEYS_COLUMNS,
+    'pro_mode_emissions': PRO_JOURNEYS_COLUMNS,
+    'pro_mode_links': [f'data.freq_mod_{mode}' for mode in MODES_PRO_V1] +
+    ['data.freq_mod_pro_journeys', 'typo.reco_pro'],
+}
+
+# Statistics sections, in Stats order
+SECTIONS = list(SECTION_COLUMNS.keys())
+
+# Statistics sections, cheapest to compute first (as measured on a campaign of 1000 records)
+SECTIONS_BY_COST = ['pro_frequencies', 'pro_mode_links', 'frequencies', 'mode_links', 'mode_frequencies',
+                    'pro_mode_emissions', 'mode_emissions', 'reco_mode_emissions', 'pro_mode_frequencies']
+
+# Flattened record columns compacted by dtype: modes, recommendations, equipments and constraints values,
+# distance types, days and rates, coordinates
+CATEGORY_COLUMN_PATTERN = re.compile(
+    r'^(data\.version|data\.(equipments|constraints)\.\d+|data\.freq_mod_journeys\.\d+\.modes\.\d+|'
+    r'data\.freq_mod_pro_journeys\.\d+\.mode|typo\.reco\.reco_dt2\.\d+|typo\.reco_pro\..+|'
+    r'derived\.pro_journeys\.\d+\.distance_type)$')
+INTEGER_COLUMN_PATTERN = re.compile(
+    r'^data\.(freq_mod_[a-z_]+|freq_mod(_pro)?_journeys\.\d+\.days|employment_rate|remote_work_rate)$')
+COORDINATE_COLUMN_PATTERN = re.compile(r'^data\.(origin|workplace)\.(lat|lon)$')
+# Largest compacted integer, leaving room in Int16 for the days per year computations
+MAX_COMPACT_INTEGER = 255
+
+
+def get_section_columns(sections: list[str] = None) -> list[str]:
+    """Get the names and nested field prefixes of the flattened record columns used by some statistics sections"""
+    return COMMON_COLUMNS + [name for section in (sections if sections is not None else SECTIONS)
+                             for name in SECTION_COLUMNS[section]]
+
 
 class StatsService:
 
-    def compute_stats(self, df: pd.DataFrame) -> Stats:
-        """Compute all statistics for equipments, constraints, travel_time, and recommendations."""
+    def compute_stats(self, df: pd.DataFrame, sections: list[str] = None) -> Stats:
+        """Compute all statistics for equipments, constraints, travel_time, and recommendations.
+
+        Args:
+            df (pd.DataFrame): The flattened records.
+            sections (list[str], optional): The statistics to compute, the others are left to None. Defaults to all.
+        """
+        return self.compute_aggregates(df, sections).to_stats(sections)
+
+    def compute_aggregates(self, df: pd.DataFrame, sections: list[str] = None) -> StatsAggregates:
+        """Compute the mergeable aggregates of all statistics, see compute_stats()."""
+        # the stats services derive new frames instead of modifying the records DataFrame, copy-on-write
+        # lets them select and filter it without copying the data
+        with pd.option_context('mode.copy_on_write', True):
+            return self._compute_aggregates(df, sections)
+
+    def _compute_aggregates(self, df: pd.DataFrame, sections: list[str] = None) -> StatsAggregates:
+        def requested(section: str) -> bool:
+            return sections is None or section in sections
+
+        aggregates = StatsAggregates()
+        if 'typo.reco.reco_dt2.0' not in df.columns:
+            # no completed records
+            return aggregates
         df = self._preprocess_dataframe(df)
+        context = StatsContext(df)
+        aggregates.total = len(df)
+        aggregates.total_v2 = len(context.df_v2)
 
-        freq_stats = FrequenciesService(df)
-        equipments = freq_stats.compute_equipments_frequencies()
-        constraints = freq_stats.compute_constraints_frequencies()
-        travel_time = freq_stats.compute_travel_time_frequencies()
-        recommendations = freq_stats.compute_recommendation_frequencies()
-        mode_frequencies = freq_stats.compute_modes_frequencies()
-        pro_mode_frequencies = freq_stats.compute_modes_pro_frequencies()
-        pro_recommendations = freq_stats.compute_recommendation_pro_frequencies()
-
-        emissions_stats = EmissionsService(df)
-        mode_emissions = emissions_stats.compute_modes_emissions()
-        reco_mode_emissions = emissions_stats.compute_modes_emissions(
-            apply_reco=True)
-        pro_mode_emissions = emissions_stats.compute_modes_pro_emissions()
-        # pro_reco_mode_emissions = emissions_stats.compute_modes_pro_emissions(apply_reco=True)
-
-        links_stats = LinksService(df)
-        mode_links = links_stats.compute_mode_reco_links()
-        pro_mode_links = links_stats.compute_mode_reco_pro_links()
-
-        return Stats(
-            total=len(df),
-            # individual
-            frequencies=[
-                equipments,
-                constraints,
-                travel_time,
-                recommendations
-            ],
-            mode_frequencies=mode_frequencies,
-            mode_emissions=mode_emissions,
-            reco_mode_emissions=reco_mode_emissions,
-            mode_links=mode_links,
-            # professional
-            pro_frequencies=[
-                pro_recommendations
-            ],
-            pro_mode_frequencies=pro_mode_frequencies,
-            pro_mode_emissions=pro_mode_emissions,
-            pro_mode_links=pro_mode_links
-        )
+        freq_stats = FrequenciesService(df, context)
+        # individual
+        if requested('frequencies'):
+            aggregates.frequencies.add_frequencies(
+                freq_stats.compute_equipments_frequencies())
+            aggregates.frequencies.add_frequencies(
+                freq_stats.compute_constraints_frequencies())
+            aggregates.frequencies.add_frequencies(
+                freq_stats.compute_travel_time_frequencies())
+            aggregates.frequencies.add_frequencies(
+                freq_stats.compute_recommendation_frequencies())
+        if requested('mode_frequencies'):
+            for frequencies in freq_stats.compute_modes_frequencies():
+                aggregates.mode_frequencies.add_frequencies(frequencies)
+        # professional
+        if requested('pro_frequencies'):
+            aggregates.pro_frequencies.add_frequencies(
+                freq_stats.compute_recommendation_pro_frequencies())
+        if requested('pro_mode_frequencies'):
+            for frequencies in freq_stats.compute_modes_pro_frequencies():
+                aggregates.pro_mode_frequencies.add_frequencies(frequencies)
+
+        emissions_stats = EmissionsService(df, context)
+        if requested('mode_emissions'):
+            aggregates.mode_emissions = emissions_stats.accumulate_modes_emissions()
+        if requested('reco_mode_emissions'):
+            aggregates.reco_mode_emissions = emissions_stats.accumulate_modes_emissions(
+                apply_reco=True)
+        if requested('pro_mode_emissions'):
+            aggregates.pro_mode_emissions = emissions_stats.accumulate_modes_pro_emissions()
+        # pro_reco_mode_emissions = emissions_stats.accumulate_modes_pro_emissions(apply_reco=True)
+
+        links_stats = LinksService(df, context)
+        if requested('mode_links'):
+            aggregates.mode_links.add_links(
+                links_stats.compute_mode_reco_links())
+        if requested('pro_mode_links'):
+            aggregates.pro_mode_links.add_links(
+                links_stats.compute_mode_reco_pro_links())
+
+        return aggregates
+
+    def select_columns(self, df: pd.DataFrame, sections: list[str] = None) -> pd.DataFrame:
+        """Select the flattened record columns used to compute some statistics sections.
+
+        Args:
+            df (pd.DataFrame): The flattened records.
+            sections (list[str], optional): The statistics sections. Defaults to all.
+        """
+        return df[match_columns(df.columns, get_section_columns(sections))]
+
+    def compact_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Compact the dtypes of the flattened records.
+
+        Modes, recommendations, equipments and constraints become categorical, days and rates
+        nullable small integers, and coordinates float32. Columns having unexpected values are left unchanged.
+
+        Args:
+            df (pd.DataFrame): The flattened records.
+        """
+        columns = {}
+        for col in df.columns:
+            series = df[col]
+            if CATEGORY_COLUMN_PATTERN.match(col):
+                if series.dtype == object and series.dropna().map(lambda value: isinstance(value, str)).all():
+                    columns[col] = series.astype('category')
+            elif INTEGER_COLUMN_PATTERN.match(col):
+                if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+                    values = series.dropna()
+                    if (values == values.round()).all() and (values.abs() <= MAX_COMPACT_INTEGER).all():
+                        columns[col] = series.astype('Int16')
+            elif COORDINATE_COLUMN_PATTERN.match(col):
+                if pd.api.types.is_float_dtype(series):
+                    columns[col] = series.astype('float32')
+        compact = df.assign(**columns)
+        if getLogger().isEnabledFor(DEBUG):
+            debug(f"Records DataFrame memory: {df.memory_usage(deep=True).sum()} bytes, "
+                  f"compacted: {compact.memory_usage(deep=True).sum()} bytes")
+        return compact
 
     def _preprocess_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
         """Preprocess the DataFrame before computing statistics."""
         # Filter only completed records
-        df = self._filter_completed_records(df).copy()
-        return df
+        return self._filter_completed_records(df)
 
     def _filter_completed_records(self, df: pd.DataFrame) -> pd.DataFrame:
         """Get a DataFrame representation of the completed records.
@@ -67,5 +181,6 @@ class StatsService:
             flat (bool, optional): Whether to flatten the DataFrame. Defaults to False.
         """
         # Filter records with values in column typo.reco_dt2.0
-        df = df[df['typo.reco.reco_dt2.0'].notna()]
-        return df
+        completed = df['typo.reco.reco_dt2.0'].notna()
+        # filtering copies the records, even when all of them are completed
+        return df if completed.all() else df[completed]
@@ -159,9 +159,11 @@ async def getTypo(token: str, locale: str = "en", session: AsyncSession = Depend
         actions = service.get_recommendation_employer_actions(
             company, campaign, custom_actions, locale, reco["reco_dt2"], reco_pro["reco_pros"])
         response["reco_actions"] = actions
-    record.typo = response
-    record.comments = None  # clear comments
-    await recordService.update(record.id, record)
+    # update from a draft, so that the record statistics before update can be retracted
+    draft = RecordDraft(**record.model_dump())
+    draft.typo = response
+    draft.comments = None  # clear comments
+    await recordService.update(record.id, draft)
     return response
 
 
@@ -2,8 +2,9 @@ from fastapi import APIRouter, Depends, Query, HTTPException, Response
 from api.db import get_session, AsyncSession
 from api.auth import kc_service, User
 from api.models.domain import Record
-from api.models.query import RecordResult
+from api.models.query import RecordRead, RecordResult
 from api.services.records import RecordService
+from api.services.snapshots import RecordSnapshotService
 from enacit4r_sql.utils.query import validate_params, ValidationError
 
 router = APIRouter()
@@ -26,7 +27,7 @@ async def find(
         raise HTTPException(status_code=400, detail=f"{e}")
 
 
-@router.get("/{id}", response_model=Record, response_model_exclude_none=True)
+@router.get("/{id}", response_model=RecordRead, response_model_exclude_none=True)
 async def get(id: int,
               user: User = Depends(kc_service.require_admin()),
               session: AsyncSession = Depends(get_session)) -> Record:
@@ -34,7 +35,7 @@ async def get(id: int,
     return await RecordService(session).get(id)
 
 
-@router.delete("/{id}", response_model=Record, response_model_exclude_none=True)
+@router.delete("/{id}", response_model=RecordRead, response_model_exclude_none=True)
 async def delete(
     id: int,
     session: AsyncSession = Depends(get_session),
@@ -56,7 +57,10 @@ async def compute_flat(
     try:
         validated = validate_params(filter, None, None, None)
         service = RecordService(session)
-        df = await service.get_dataframe(validated["filter"], flat=True)
+        # campaigns records are read from their snapshot, if enabled
+        df = await RecordSnapshotService(session).get_dataframe(validated["filter"])
+        if df is None:
+            df = await service.get_dataframe(validated["filter"], flat=True)
         if completed:
             df = service.filter_completed(df)
         return Response(content=df.to_csv(date_format="%Y-%m-%dT%H:%M:%S.%f", index=False), media_type="text/csv")
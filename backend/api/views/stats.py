@@ -1,9 +1,20 @@
+import json
+import pandas as pd
+from logging import exception
+from typing import AsyncIterator, Dict, List
 from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi.responses import StreamingResponse
 from api.db import get_session, AsyncSession
 from api.auth import kc_service, User
-from api.models.query import Stats, LocationFilter
+from api.models.query import Emissions, Frequencies, Stats, LocationFilter
 from api.services.records import RecordService
-from api.services.stats.stats import StatsService
+from api.services.campaign_stats import CampaignStatsService
+from api.services.record_stats import RecordStatsService
+from api.services.snapshots import RecordSnapshotService
+from api.services.stats.cache import stats_cache
+from api.services.stats.pool import stats_pool
+from api.services.stats.singleflight import stats_flight
+from api.services.stats.stats import SECTIONS, SECTIONS_BY_COST, StatsService, get_section_columns
 from enacit4r_sql.utils.query import validate_params, ValidationError, paramAsDict
 
 router = APIRouter()
@@ -12,22 +23,208 @@ router = APIRouter()
 @router.get("/all", response_model_exclude_none=True)
 async def compute_all_statistics(
     filter: str = Query(None),
+    sections: str = Query(None),
     user: User = Depends(kc_service.get_user_info()),
     session: AsyncSession = Depends(get_session),
 ) -> Stats:
-    """Query all type of all statistics in records"""
+    """Query all type of all statistics in records, or only some comma separated sections (e.g. mode_frequencies,mode_links)"""
     try:
+        sections_list = _parse_sections(sections)
         filter_dict = paramAsDict(filter)
         workplace_filter = filter_dict.get('workplace_location', None)
         if 'workplace_location' in filter_dict:
             del filter_dict['workplace_location']
         validated = validate_params(filter_dict, None, None, None)
+        if not workplace_filter:
+            # campaigns dashboards are served from the campaigns statistics aggregates
+            stats = await CampaignStatsService(session).get_stats(filter_dict, sections_list)
+            if stats is not None:
+                return stats
         service = RecordService(session)
-        df = await service.get_dataframe(validated["filter"], flat=True)
-        if workplace_filter:
-            workplace_filter = LocationFilter.model_validate(
-                workplace_filter, by_alias=True)
-            df = service.filter_by_workplace_location(df, workplace_filter)
-        return StatsService().compute_stats(df)
+        # cached statistics are valid as long as the selected records are unchanged
+        version = await service.get_data_version(validated["filter"])
+        cache_key = stats_cache.make_key(
+            {**validated["filter"], "workplace_location": workplace_filter}, version, sections_list)
+        stats = stats_cache.get(cache_key)
+        if stats is not None:
+            return stats
+        location_filter = LocationFilter.model_validate(
+            workplace_filter, by_alias=True) if workplace_filter else None
+
+        bind = session.bind
+
+        async def compute_stats() -> Stats:
+            # shared by identical requests: records are read in its own session, the request session
+            # is closed when the request that started the computation is cancelled
+            async with AsyncSession(bind, expire_on_commit=False) as computation_session:
+                df = await _get_dataframe(computation_session, validated["filter"], sections_list, location_filter)
+            # CPU bound, computed in a worker process
+            stats = await stats_pool.compute_stats(df, sections_list)
+            stats_cache.put(cache_key, stats)
+            return stats
+
+        # identical concurrent requests share the same computation
+        return await stats_flight.do(cache_key, compute_stats)
     except ValidationError as e:
         raise HTTPException(status_code=400, detail=f"{e}")
+
+
+@router.get("/stream")
+async def stream_all_statistics(
+    filter: str = Query(None),
+    sections: str = Query(None),
+    format: str = Query("ndjson"),
+    user: User = Depends(kc_service.get_user_info()),
+    session: AsyncSession = Depends(get_session),
+) -> StreamingResponse:
+    """Stream the statistics sections in records as soon as each one is computed, cheapest first.
+
+    Each section is sent as a JSON object {"section", "total", "data"}, one per line (format=ndjson),
+    or as a server-sent event named after the section (format=sse).
+    """
+    if format not in ["ndjson", "sse"]:
+        raise HTTPException(
+            status_code=400, detail="Format must be ndjson or sse")
+    try:
+        sections_list = _parse_sections(sections) or SECTIONS
+        filter_dict = paramAsDict(filter)
+        workplace_filter = filter_dict.get('workplace_location', None)
+        if 'workplace_location' in filter_dict:
+            del filter_dict['workplace_location']
+        validated = validate_params(filter_dict, None, None, None)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    sections_list = [
+        section for section in SECTIONS_BY_COST if section in sections_list]
+    # the session is closed once the response starts, records are read beforehand
+    service = RecordService(session)
+    stats = None
+    if not workplace_filter:
+        stats = await CampaignStatsService(session).get_stats(filter_dict, sections_list)
+    if stats is not None:
+        cached = {section: stats for section in sections_list}
+        cache_keys = {}
+    else:
+        version = await service.get_data_version(validated["filter"])
+        cache_keys = {section: stats_cache.make_key(
+            {**validated["filter"], "workplace_location": workplace_filter}, version, [section]) for section in sections_list}
+        cached = {section: stats_cache.get(cache_keys[section])
+                  for section in sections_list}
+    df = None
+    if any(stats is None for stats in cached.values()):
+        df = await _get_dataframe(session, validated["filter"], sections_list,
+                                  LocationFilter.model_validate(workplace_filter, by_alias=True) if workplace_filter else None)
+
+    async def stream_sections() -> AsyncIterator[str]:
+        for section in sections_list:
+            stats = cached[section]
+            if stats is None:
+                async def compute_stats() -> Stats:
+                    # shared by identical requests, computed from the records read beforehand, not from the session
+                    # CPU bound, computed in a worker process
+                    stats = await stats_pool.compute_stats(df, [section])
+                    stats_cache.put(cache_keys[section], stats)
+                    return stats
+                try:
+                    stats = await stats_flight.do(cache_keys[section], compute_stats)
+                except HTTPException as e:
+                    # the response has started, the error is the last item
+                    yield _format_section(section, {"section": section, "error": e.detail}, format)
+                    return
+                except Exception:
+                    exception(f"Statistics section {section} computation failed")
+                    yield _format_section(section, {"section": section, "error": "Statistics computation failed"}, format)
+                    return
+            data = stats.model_dump(mode="json", exclude_none=True)
+            yield _format_section(section, {"section": section, "total": stats.total, "data": data.get(section)}, format)
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream_sections(), media_type=media_type)
+
+
+@router.get("/frequencies", response_model_exclude_none=True)
+async def compute_frequencies_statistics(
+    filter: str = Query(None),
+    user: User = Depends(kc_service.get_user_info()),
+    session: AsyncSession = Depends(get_session),
+) -> List[Frequencies]:
+    """Query equipments, constraints, travel time and recommendation frequencies in records, computed in the database"""
+    try:
+        filter_dict = paramAsDict(filter)
+        if 'workplace_location' in filter_dict:
+            raise HTTPException(
+                status_code=400, detail="Workplace location filter is not supported")
+        validated = validate_params(filter_dict, None, None, None)
+        return await RecordStatsService(session).compute_frequencies(validated["filter"])
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+
+
+@router.get("/emissions", response_model_exclude_none=True)
+async def compute_emissions_statistics(
+    filter: str = Query(None),
+    apply_reco: bool = Query(False),
+    user: User = Depends(kc_service.get_user_info()),
+    session: AsyncSession = Depends(get_session),
+) -> List[Emissions]:
+    """Query commute CO2 emissions per mode in records, or per recommended mode if apply_reco, computed in the database"""
+    try:
+        filter_dict = paramAsDict(filter)
+        if 'workplace_location' in filter_dict:
+            raise HTTPException(
+                status_code=400, detail="Workplace location filter is not supported")
+        validated = validate_params(filter_dict, None, None, None)
+        return await RecordStatsService(session).compute_modes_emissions(validated["filter"], apply_reco)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+
+
+@router.get("/cache")
+async def get_statistics_cache_info(
+    user: User = Depends(kc_service.get_user_info()),
+) -> Dict:
+    """Get the statistics cache size and hit/miss counts"""
+    return stats_cache.info()
+
+
+@router.get("/inflight")
+async def get_statistics_inflight_info(
+    user: User = Depends(kc_service.get_user_info()),
+) -> Dict:
+    """Get the statistics computations counts: calls, coalesced calls and in flight computations"""
+    return stats_flight.info()
+
+
+async def _get_dataframe(session: AsyncSession, filter: dict, sections: list[str] | None, location_filter: LocationFilter | None) -> pd.DataFrame:
+    """Get the flattened records used by some statistics sections, read from the campaigns snapshots when possible,
+    with compact dtypes"""
+    columns = get_section_columns(sections) + \
+        (['data.workplace'] if location_filter else [])
+    df = await RecordSnapshotService(session).get_dataframe(filter, columns, derived=True)
+    service = RecordService(session)
+    if df is None:
+        # completed records and the bounding box of the location are filtered in the database
+        df = await service.get_dataframe(filter, flat=True, location_filter=location_filter, completed=True,
+                                         derived=True)
+    if location_filter:
+        df = service.filter_by_workplace_location(df, location_filter)
+    return StatsService().compact_dataframe(df)
+
+
+def _parse_sections(sections: str | None) -> list[str] | None:
+    """Parse comma separated statistics sections, in Stats order, None if all"""
+    if not sections:
+        return None
+    names = [name.strip() for name in sections.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SECTIONS]
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown statistics sections: {', '.join(unknown)}")
+    return [section for section in SECTIONS if section in names]
+
+
+def _format_section(section: str, content: dict, format: str) -> str:
+    """Format a streamed statistics section, as a JSON line or a server-sent event"""
+    if format == "sse":
+        return f"event: {section}\ndata: {json.dumps(content)}\n\n"
+    return json.dumps(content) + "\n"
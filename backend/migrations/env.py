@@ -33,6 +33,15 @@ config.set_main_option("sqlalchemy.url", app_config.DB_URL)
 # ... etc.
 
 
+# indexes created by migrations only, not declared in the models
+MIGRATION_ONLY_INDEXES = {"ix_participant_identifier_trgm"}
+
+
+def include_object(object, name, type_, reflected, compare_to) -> bool:
+    """Exclude the indexes created by migrations only from autogenerate"""
+    return not (type_ == "index" and name in MIGRATION_ONLY_INDEXES)
+
+
 def run_migrations_offline() -> None:
     """Run migrations in 'offline' mode.
 
@@ -49,6 +58,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_object=include_object,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -61,6 +71,7 @@ def do_run_migrations(connection: Connection) -> None:
     context.configure(
         connection=connection,
         target_metadata=target_metadata,
+        include_object=include_object,
     )
 
     with context.begin_transaction():
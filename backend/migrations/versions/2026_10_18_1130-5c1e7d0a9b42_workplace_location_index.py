@@ -0,0 +1,32 @@
+"""workplace location index
+
+Revision ID: 5c1e7d0a9b42
+Revises: a85791398572
+Create Date: 2026-10-18 11:30:41.527301
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c1e7d0a9b42'
+down_revision: Union[str, None] = 'a85791398572'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# record workplace coordinates, null when missing, not numeric or out of range
+WORKPLACE_LAT = r"""(CASE WHEN ((data -> 'workplace') ->> 'lat') ~ '^\s*[-+]?(\d{1,20}(\.\d{0,30})?|\.\d{1,30})([eE][-+]?\d{1,2})?\s*$' THEN CAST(((data -> 'workplace') ->> 'lat') AS FLOAT) END)"""
+WORKPLACE_LON = r"""(CASE WHEN ((data -> 'workplace') ->> 'lon') ~ '^\s*[-+]?(\d{1,20}(\.\d{0,30})?|\.\d{1,30})([eE][-+]?\d{1,2})?\s*$' THEN CAST(((data -> 'workplace') ->> 'lon') AS FLOAT) END)"""
+
+
+def upgrade() -> None:
+    op.create_index('ix_record_workplace_location', 'record',
+                    [sa.text(WORKPLACE_LAT), sa.text(WORKPLACE_LON)], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_record_workplace_location', table_name='record')
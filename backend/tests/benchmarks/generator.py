@@ -0,0 +1,169 @@
+import sys
+from datetime import datetime, timedelta, timezone
+import h3
+import numpy as np
+import pandas as pd
+from api.services.stats.commons import MODES, MODES_PRO, MODES_PRO_V1, RECOS, RECOS_PRO
+
+EQUIPMENTS = ['car', 'car_driver', 'moto', 'bike', 'ebike',
+              'train_subs', 'upt_subs', 'mob_subs']
+CONSTRAINTS = ['none', 'night', 'disabled', 'heavy', 'dependent']
+AGE_CLASSES = ['16-24', '25-44', '45-64', '65+']
+TRAVEL_TIMES = [0, 5, 10, 15, 20, 25, 30, 35, 40, 50, 60]
+RECO_ACCESS = [0.0, 0.7, 0.9, 1.0]
+
+# workplaces around Geneva, Lausanne and Zurich
+WORKPLACES = [(46.2102, 6.1426), (46.5168, 6.6291), (47.3779, 8.5403)]
+# pro journeys destinations, by distance type
+DESTINATIONS = {
+    'local': [(46.2044, 6.1432), (46.5197, 6.6323)],
+    'national': [(46.9480, 7.4474), (47.0502, 8.3093), (45.7640, 4.8357)],
+    'europe': [(48.8566, 2.3522), (52.5200, 13.4050), (41.9028, 12.4964)],
+    'inter': [(40.7128, -74.0060), (35.6762, 139.6503), (-23.5505, -46.6333)]
+}
+
+
+def generate_records(n: int, seed: int = 0, v2_ratio: float = 0.5, completed_ratio: float = 0.8) -> list[dict]:
+    """Generate realistic survey records, as Record dumps.
+
+    Args:
+        n (int): The number of records.
+        seed (int, optional): The random seed, the same seed gives the same records. Defaults to 0.
+        v2_ratio (float, optional): The ratio of records of data version 2. Defaults to 0.5.
+        completed_ratio (float, optional): The ratio of records having recommendations. Defaults to 0.8.
+    """
+    rng = np.random.default_rng(seed)
+    created_at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    records = []
+    for i in range(n):
+        v2 = rng.random() < v2_ratio
+        data = _generate_data(rng, v2)
+        typo = _generate_typo(rng, data) if rng.random() < completed_ratio else None
+        updated_at = created_at + timedelta(minutes=int(rng.integers(0, 60)))
+        records.append({
+            'id': i + 1,
+            'token': rng.bytes(16).hex(),
+            'data': data,
+            'typo': typo,
+            'comments': None,
+            'campaign_id': 1,
+            'company_id': 1,
+            'created_at': created_at,
+            'updated_at': updated_at
+        })
+        created_at += timedelta(minutes=int(rng.integers(1, 30)))
+    return records
+
+
+def generate_dataframe(n: int, seed: int = 0, **kwargs) -> pd.DataFrame:
+    """Generate realistic survey records as a flattened DataFrame, see generate_records()."""
+    return to_dataframe(generate_records(n, seed, **kwargs))
+
+
+def to_dataframe(records: list[dict]) -> pd.DataFrame:
+    """Flatten generated records as the records service does."""
+    from api.models.domain import Record
+    from api.services.records import RecordService
+
+    return RecordService(None).to_dataframe([Record(**record) for record in records], flat=True)
+
+
+def _generate_data(rng: np.random.Generator, v2: bool) -> dict:
+    workplace = WORKPLACES[rng.integers(len(WORKPLACES))]
+    data = {
+        'age_class': str(rng.choice(AGE_CLASSES)),
+        'workplace': {
+            'lat': workplace[0] + rng.normal(0, 0.01),
+            'lon': workplace[1] + rng.normal(0, 0.01),
+            'address': 'Workplace'
+        },
+        'equipments': _sample(rng, EQUIPMENTS, 0, 3),
+        'constraints': _sample(rng, CONSTRAINTS, 0, 2),
+        'travel_time': int(rng.choice(TRAVEL_TIMES)),
+        'employment_rate': int(rng.choice([50, 80, 100])),
+        'remote_work_rate': int(rng.choice([0, 20, 40])),
+        'company_vehicle': bool(rng.random() < 0.2),
+        'travel_pro': bool(rng.random() < 0.4)
+    }
+    for need in ['car', 'pub', 'bike', 'moto', 'train', 'walking']:
+        data[f'needs_{need}'] = int(rng.integers(1, 6))
+    if rng.random() < 0.9:
+        # commuting distances from 1 to 50 km
+        distance = rng.gamma(2, 5) / 111
+        angle = rng.uniform(0, 2 * np.pi)
+        data['origin'] = {
+            'lat': data['workplace']['lat'] + distance * np.sin(angle),
+            'lon': data['workplace']['lon'] + distance * np.cos(angle) / np.cos(np.radians(workplace[0]))
+        }
+    if v2:
+        data['version'] = '2.0.0'
+        data['freq_mod_journeys'] = [
+            {
+                'days': int(rng.integers(1, 6)),
+                'modes': _sample(rng, MODES, 1, 3)
+            }
+            for _ in range(rng.integers(1, 4))
+        ]
+        if data['travel_pro']:
+            data['freq_mod_pro_journeys'] = [
+                _generate_pro_journey(rng, workplace) for _ in range(rng.integers(1, 4))]
+    else:
+        for mode in ['walking', 'bike', 'pub', 'moto', 'car', 'train']:
+            data[f'freq_mod_{mode}'] = float(
+                rng.choice([0, 0, 0, 1, 2, 3, 4, 5]))
+        data['freq_mod_combined'] = False
+        for mode in MODES_PRO_V1:
+            data[f'freq_mod_pro_{mode}'] = float(
+                rng.choice([0, 0, 0, 0, 1, 2, 4])) if data['travel_pro'] else 0.0
+    return data
+
+
+def _generate_pro_journey(rng: np.random.Generator, workplace: tuple) -> dict:
+    area = str(rng.choice(list(DESTINATIONS.keys())))
+    destinations = DESTINATIONS[area]
+    lat, lon = destinations[rng.integers(len(destinations))]
+    if area == 'local':
+        lat, lon = workplace[0] + rng.normal(0, 0.05), workplace[1] + rng.normal(0, 0.05)
+    # users select destination hexagons at coarse resolutions
+    resolution = int(rng.choice([1, 2, 5]))
+    return {
+        'days': int(rng.integers(1, 10)),
+        # walking pro journeys have no distance coefficient, the pro emissions cannot be computed
+        'mode': str(rng.choice([mode for mode in MODES_PRO if mode != 'walking'])),
+        'hex_id': h3.latlng_to_cell(lat, lon, resolution)
+    }
+
+
+def _generate_typo(rng: np.random.Generator, data: dict) -> dict:
+    scores = {reco: float(round(rng.uniform(35, 75), 1)) for reco in RECOS}
+    typo = {
+        'reco': {
+            'access': {reco: float(rng.choice(RECO_ACCESS)) for reco in RECOS},
+            'scores': scores,
+            'reco_dt2': sorted(RECOS, key=lambda reco: -scores[reco])[:2]
+        }
+    }
+    if 'version' in data:
+        journeys = data.get('freq_mod_pro_journeys', [])
+        if len(journeys) > 0:
+            typo['reco_pro'] = {
+                'reco_pros': [str(rng.choice(RECOS_PRO)) for _ in journeys]}
+    elif data['travel_pro']:
+        typo['reco_pro'] = {
+            'reco_pro_loc': str(rng.choice(RECOS_PRO)),
+            'reco_pro_reg': str(rng.choice(RECOS_PRO)),
+            'reco_pro_int': str(rng.choice(RECOS_PRO))
+        }
+    return typo
+
+
+def _sample(rng: np.random.Generator, values: list, min_count: int, max_count: int) -> list:
+    count = rng.integers(min_count, max_count + 1)
+    return [str(value) for value in rng.choice(values, size=count, replace=False)]
+
+
+if __name__ == '__main__':
+    # usage: python -m tests.benchmarks.generator <count> <csv file> [seed]
+    df = generate_dataframe(int(sys.argv[1]), int(
+        sys.argv[3]) if len(sys.argv) > 3 else 0)
+    df.to_csv(sys.argv[2], index=False)
@@ -0,0 +1,192 @@
+import inspect
+import json
+import os
+import time
+import tracemalloc
+from pathlib import Path
+import pandas as pd
+import pytest
+from api.services.stats.emissions import EmissionsService
+from api.services.stats.frequencies import FrequenciesService
+from api.services.stats.links import LinksService
+from api.services.stats.stats import StatsService
+from tests.benchmarks.generator import generate_records, to_dataframe
+from tests.conftest import requires_db
+
+# Benchmarks are slow, they run only when BENCHMARK is set
+BENCHMARK = os.environ.get("BENCHMARK")
+SIZES = [int(size) for size in os.environ.get(
+    "BENCHMARK_SIZES", "1000,10000,100000").split(",")]
+# A measure regresses when it exceeds its baseline by this factor, and by more than a minimal delta
+THRESHOLD = float(os.environ.get("BENCHMARK_THRESHOLD", "1.5"))
+MIN_DELTAS = {"time": 0.01, "peak_memory": 1024 * 1024}
+# Store the measures as the new baselines, instead of comparing them
+UPDATE = os.environ.get("BENCHMARK_UPDATE") is not None
+BASELINES_PATH = Path(__file__).parent / "baselines.json"
+
+pytestmark = pytest.mark.skipif(
+    BENCHMARK is None, reason="BENCHMARK is not set")
+
+
+def public_methods(cls) -> list[str]:
+    return [name for name, _ in inspect.getmembers(cls, inspect.isfunction) if not name.startswith('_')]
+
+
+STATS_METHODS = [(cls, name) for cls in [FrequenciesService, EmissionsService, LinksService]
+                 for name in public_methods(cls)]
+
+
+@pytest.fixture(scope="session")
+def baselines():
+    baselines = json.loads(BASELINES_PATH.read_text()
+                           ) if BASELINES_PATH.exists() else {}
+    yield baselines
+    if UPDATE:
+        BASELINES_PATH.write_text(json.dumps(
+            baselines, indent=2, sort_keys=True) + "\n")
+
+
+@pytest.fixture(scope="module", params=SIZES)
+def dataset(request):
+    """Generated records of a size, their flattened records and completed records DataFrames"""
+    records = generate_records(request.param)
+    df_records = to_dataframe(records)
+    df = StatsService()._preprocess_dataframe(df_records)
+    return request.param, records, df_records, df
+
+
+def measure(fn, setup, repeat: int) -> dict:
+    """Measure the best time of some runs, and the peak memory allocated by a traced run.
+
+    Args:
+        fn: The function to measure, called with the setup results.
+        setup: The function preparing the arguments of each run, not measured.
+        repeat (int): The number of timed runs.
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    args = setup()
+    tracemalloc.start()
+    try:
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"time": round(min(times), 4), "peak_memory": peak}
+
+
+async def measure_async(fn, repeat: int) -> dict:
+    """Measure the best time of some runs of a coroutine function, and the peak memory allocated by a traced run"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        await fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"time": round(min(times), 4), "peak_memory": peak}
+
+
+def check_baseline(baselines: dict, size: int, name: str, measures: dict):
+    """Compare measures to their baseline, or store them as the new baseline"""
+    if UPDATE:
+        baselines.setdefault(str(size), {})[name] = measures
+        return
+    baseline = baselines.get(str(size), {}).get(name)
+    if baseline is None:
+        pytest.skip(f"No baseline for {name} with {size} records")
+    for key, value in measures.items():
+        limit = max(baseline[key] * THRESHOLD, baseline[key] + MIN_DELTAS[key])
+        assert value <= limit, f"{name} {key} regressed with {size} records: {value} > {baseline[key]} (baseline)"
+
+
+def get_repeat(size: int) -> int:
+    return 3 if size < 100000 else 1
+
+
+@pytest.mark.parametrize("cls, method", STATS_METHODS, ids=[f"{cls.__name__}.{method}" for cls, method in STATS_METHODS])
+def test_stats_service_method(dataset, baselines, cls, method):
+    size, _, _, df = dataset
+    # services do not modify the DataFrame, runs share it, under copy-on-write as in StatsService
+    with pd.option_context('mode.copy_on_write', True):
+        measures = measure(lambda: getattr(cls(df), method)(),
+                           lambda: (), get_repeat(size))
+    check_baseline(baselines, size, f"{cls.__name__}.{method}", measures)
+
+
+def test_compute_stats(dataset, baselines):
+    size, _, _, df = dataset
+    measures = measure(lambda: StatsService().compute_stats(df),
+                       lambda: (), get_repeat(size))
+    check_baseline(baselines, size, "StatsService.compute_stats", measures)
+
+
+def test_stats_request(dataset, baselines):
+    """Statistics of all the records, as computed for a /stats/all request"""
+    size, _, df_records, _ = dataset
+    service = StatsService()
+    measures = measure(lambda: service.compute_stats(service.compact_dataframe(df_records)),
+                       lambda: (), get_repeat(size))
+    check_baseline(baselines, size, "/stats/all", measures)
+
+
+def test_flatten_json(dataset, baselines):
+    from api.services.records import RecordService
+
+    size, records, _, _ = dataset
+    service = RecordService(None)
+
+    def flatten_records():
+        for record in records:
+            service.flatten_json(record['data'])
+            service.flatten_json(record['typo'] or {})
+
+    measures = measure(flatten_records, lambda: (), get_repeat(size))
+    check_baseline(baselines, size, "RecordService.flatten_json", measures)
+
+
+@requires_db
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", SIZES)
+async def test_get_dataframe(db_session, baselines, size):
+    """Records loaded as a flattened DataFrame, compared to loading them as models"""
+    from datetime import datetime, timezone
+    from sqlalchemy import insert
+    from api.models.domain import Campaign, Company, Record
+    from api.services.records import RecordService
+
+    now = datetime.now(timezone.utc)
+    company = Company(name="benchmark", created_at=now, updated_at=now)
+    db_session.add(company)
+    await db_session.flush()
+    campaign = Campaign(name="benchmark", company_id=company.id,
+                        created_at=now, updated_at=now)
+    db_session.add(campaign)
+    await db_session.flush()
+    records = [{**record, 'campaign_id': campaign.id, 'company_id': company.id}
+               for record in generate_records(size)]
+    await db_session.exec(insert(Record), params=records)
+    await db_session.commit()
+
+    service = RecordService(db_session)
+    filter = {"campaign_id": campaign.id}
+
+    async def get_models_dataframe():
+        # records hydrated as models, then dumped
+        result = await service.find(filter, fields=[], sort=[], range=[])
+        return service.to_dataframe(result.data, flat=True)
+
+    measures = await measure_async(lambda: service.get_dataframe(filter, flat=True), get_repeat(size))
+    models_measures = await measure_async(get_models_dataframe, get_repeat(size))
+    for key, value in measures.items():
+        assert value <= models_measures[key], \
+            f"RecordService.get_dataframe {key} exceeds the models one with {size} records: {value} > {models_measures[key]}"
+    check_baseline(baselines, size, "RecordService.get_dataframe", measures)
@@ -0,0 +1,90 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import pytest_asyncio
+
+# Database tests need a disposable Postgres database, its tables are dropped and created
+TEST_DB_URL = os.environ.get("TEST_DB_URL")
+
+requires_db = pytest.mark.skipif(
+    TEST_DB_URL is None, reason="TEST_DB_URL is not set")
+
+
+def load_test_dataframe() -> pd.DataFrame:
+    """Load the flattened test records"""
+    return pd.read_csv('tests/data/records.csv')
+
+
+def unflatten_record(row: pd.Series) -> dict:
+    """Rebuild the nested record of a flattened row, list items having numeric keys."""
+    record = {}
+    for key, value in row.items():
+        if pd.isna(value):
+            continue
+        if isinstance(value, np.generic):
+            value = value.item()
+        node = record
+        parts = key.split('.')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+
+    def to_lists(node):
+        if not isinstance(node, dict):
+            return node
+        items = {key: to_lists(value) for key, value in node.items()}
+        if items and all(key.isdigit() for key in items):
+            return [items[key] for key in sorted(items, key=int)]
+        return items
+    return to_lists(record)
+
+
+@pytest_asyncio.fixture
+async def db_session():
+    os.environ.setdefault("DB_URL", TEST_DB_URL)
+    os.environ.setdefault("KEYCLOAK_API_ID", "test")
+    os.environ.setdefault("KEYCLOAK_API_SECRET", "test")
+    from sqlalchemy.ext.asyncio import create_async_engine
+    from sqlmodel import SQLModel
+    from sqlmodel.ext.asyncio.session import AsyncSession
+    import api.models.domain  # noqa: F401, registers the tables
+
+    engine = create_async_engine(TEST_DB_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+        await conn.run_sync(SQLModel.metadata.create_all)
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        yield session
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+    await engine.dispose()
+
+
+@pytest_asyncio.fixture
+async def records_campaign(db_session) -> int:
+    """Save the test records in a campaign, and get the campaign id"""
+    from datetime import datetime, timezone
+    from api.models.domain import Campaign, Company, Record
+
+    now = datetime.now(timezone.utc)
+    company = Company(name="test", created_at=now, updated_at=now)
+    db_session.add(company)
+    await db_session.flush()
+    campaign = Campaign(name="test", company_id=company.id,
+                        created_at=now, updated_at=now)
+    db_session.add(campaign)
+    await db_session.flush()
+    df = load_test_dataframe()
+    for _, row in df.iterrows():
+        record = unflatten_record(row)
+        db_session.add(Record(
+            token=record["token"],
+            data=record.get("data"),
+            typo=record.get("typo"),
+            campaign_id=campaign.id,
+            company_id=company.id,
+            created_at=now,
+            updated_at=now))
+    await db_session.commit()
+    return campaign.id
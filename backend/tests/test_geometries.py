@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import Point
+from geojson_pydantic import MultiPolygon, Polygon
+from api.services.geometries import GeometryCache, contains_points
+
+# square with a square hole
+POLYGON = Polygon.model_validate({
+    "type": "Polygon",
+    "coordinates": [
+        [[6.0, 46.0], [7.0, 46.0], [7.0, 47.0], [6.0, 47.0], [6.0, 46.0]],
+        [[6.4, 46.4], [6.6, 46.4], [6.6, 46.6], [6.4, 46.6], [6.4, 46.4]]
+    ]
+})
+MULTIPOLYGON = MultiPolygon.model_validate({
+    "type": "MultiPolygon",
+    "coordinates": [
+        POLYGON.model_dump()["coordinates"],
+        [[[8.0, 47.0], [9.0, 47.0], [9.0, 48.0], [8.0, 48.0], [8.0, 47.0]]]
+    ]
+})
+
+
+def test_contains_points():
+    lat = pd.Series([46.2, 46.5, 47.5, 47.5, 46.2, np.nan, "46.2"])
+    lon = pd.Series([6.2, 6.5, 8.5, 6.2, 7.0, 6.2, "6.2"])
+    # inside, in the hole, in the other polygon, outside, on the boundary, missing, string
+    assert contains_points(POLYGON, lat, lon).tolist() == [
+        True, False, False, False, False, False, True]
+    assert contains_points(MULTIPOLYGON, lat, lon).tolist() == [
+        True, False, True, False, False, False, True]
+
+    # same results as shapely contains, point by point
+    rng = np.random.default_rng(0)
+    lat = pd.Series(rng.uniform(45.5, 48.5, 1000))
+    lon = pd.Series(rng.uniform(5.5, 9.5, 1000))
+    shape = shapely.from_geojson(MULTIPOLYGON.model_dump_json())
+    expected = [shape.contains(Point(x, y)) for x, y in zip(lon, lat)]
+    assert contains_points(MULTIPOLYGON, lat, lon).tolist() == expected
+
+
+def test_geometry_cache():
+    cache = GeometryCache(maxsize=1)
+    prepared = cache.get(POLYGON)
+    assert shapely.is_prepared(prepared)
+    # same GeoJSON, same prepared geometry
+    assert cache.get(Polygon.model_validate(POLYGON.model_dump())) is prepared
+    cache.get(MULTIPOLYGON)
+    assert cache.get(POLYGON) is not prepared
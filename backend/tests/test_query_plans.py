@@ -0,0 +1,136 @@
+"""Query plans of the services hot lookups: each query must use its index.
+
+Sequential scans are disabled, so that an index is used whenever it applies, even on the small test tables.
+"""
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import pytest
+from sqlalchemy import event
+from tests.conftest import requires_db
+from tests.test_records import LOCATION_FILTER
+
+pytestmark = [requires_db, pytest.mark.asyncio]
+
+
+@asynccontextmanager
+async def capture_statements(session):
+    """Capture the SQL statements, and their parameters, executed in a session"""
+    statements = []
+    engine = session.bind.sync_engine
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+async def explain(session, statements: list[tuple]) -> list[str]:
+    """Get the query plan of each statement"""
+    conn = await session.connection()
+    await conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+    plans = []
+    for statement, parameters in statements:
+        res = await conn.exec_driver_sql(f"EXPLAIN {statement}", parameters)
+        plans.append("\n".join(row[0] for row in res.all()))
+    return plans
+
+
+async def get_plans(session, fn) -> list[str]:
+    """Run a service query and get the query plans of its statements"""
+    async with capture_statements(session) as statements:
+        await fn()
+    assert len(statements) > 0
+    return await explain(session, statements)
+
+
+async def test_record_by_token(db_session, records_campaign):
+    from sqlmodel import select
+    from api.models.domain import Record
+    from api.services.records import RecordService
+
+    token = (await db_session.exec(select(Record.token).limit(1))).one()
+    service = RecordService(db_session)
+    plans = await get_plans(db_session, lambda: service.get_by_token(token))
+    assert all("ix_record_token" in plan for plan in plans)
+
+
+async def test_records_by_campaign(db_session, records_campaign):
+    from api.services.records import RecordService
+
+    service = RecordService(db_session)
+    plans = await get_plans(db_session, lambda: service.find(
+        {"campaign_id": records_campaign}, fields=[], sort=[], range=[]))
+    assert all("ix_record_campaign_id" in plan for plan in plans)
+    plans = await get_plans(db_session, lambda: service.count_completed(
+        {"campaign_id": records_campaign}))
+    assert all("Seq Scan" not in plan for plan in plans)
+
+
+async def test_records_by_company(db_session, records_campaign):
+    from api.models.domain import Campaign
+    from api.services.records import RecordService
+
+    campaign = await db_session.get(Campaign, records_campaign)
+    service = RecordService(db_session)
+    plans = await get_plans(db_session, lambda: service.find(
+        {"company_id": campaign.company_id}, fields=[], sort=[], range=[]))
+    assert all("ix_record_company_id" in plan for plan in plans)
+
+
+async def test_records_by_workplace_location(db_session, records_campaign):
+    from api.services.records import RecordService
+
+    service = RecordService(db_session)
+    plans = await get_plans(db_session, lambda: service.find(
+        {}, fields=[], sort=[], range=[], location_filter=LOCATION_FILTER))
+    assert all("ix_record_workplace_location" in plan for plan in plans)
+
+
+async def test_campaign_by_slug(db_session, records_campaign):
+    from api.models.domain import Campaign
+    from api.services.campaigns import CampaignService
+
+    campaign = await db_session.get(Campaign, records_campaign)
+    campaign.slug = "test"
+    db_session.add(campaign)
+    await db_session.commit()
+    plans = await get_plans(db_session, lambda: CampaignService(db_session).get_by_slug("test"))
+    # the campaign, then its workplaces
+    assert "ix_campaign_slug" in plans[0]
+
+
+async def test_participants(db_session, records_campaign):
+    from api.models.domain import Participant
+    from api.services.participants import ParticipantService
+
+    now = datetime.now(timezone.utc)
+    db_session.add(Participant(token="abc", identifier="participant@example.com",
+                               campaign_id=records_campaign, created_at=now, updated_at=now))
+    await db_session.commit()
+    service = ParticipantService(db_session)
+    plans = await get_plans(db_session, lambda: service.get_by_token("abc"))
+    assert all("participant_token_key" in plan for plan in plans)
+    plans = await get_plans(db_session, lambda: service.find(
+        {"campaign_id": records_campaign}, fields=[], sort=[], range=[]))
+    assert all("ix_participant_campaign_id" in plan for plan in plans)
+
+
+async def test_participants_identifier_search(db_session, records_campaign):
+    from sqlalchemy import text
+    from api.services.participants import ParticipantService
+
+    res = await db_session.exec(text("SELECT count(*) FROM pg_available_extensions WHERE name = 'pg_trgm'"))
+    if res.one()[0] == 0:
+        pytest.skip("pg_trgm extension is not available")
+    # created by migration only
+    await db_session.exec(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    await db_session.exec(text(
+        "CREATE INDEX ix_participant_identifier_trgm ON participant USING gin (identifier gin_trgm_ops)"))
+    service = ParticipantService(db_session)
+    plans = await get_plans(db_session, lambda: service.find(
+        {"identifier": {"$ilike": "%example%"}}, fields=[], sort=[], range=[]))
+    assert all("ix_participant_identifier_trgm" in plan for plan in plans)
@@ -0,0 +1,88 @@
+import pytest
+from api.models.query import Emissions, Frequencies
+from api.services.stats.stats import StatsService
+from tests.conftest import load_test_dataframe, requires_db
+
+pytestmark = [requires_db, pytest.mark.asyncio]
+
+
+def assert_frequencies_same(result: Frequencies, expected: Frequencies):
+    """Compare frequencies, values having the same count included, in order of appearance"""
+    assert result.field == expected.field
+    assert result.total == expected.total
+    assert [(f.value, f.count) for f in result.data] == \
+        [(f.value, f.count) for f in expected.data]
+
+
+def assert_emissions_same(result: list[Emissions], expected: list[Emissions]):
+    """Compare emissions, sums being computed in a different order"""
+    assert [e.mode for e in result] == [e.mode for e in expected]
+    for emissions, expected_emissions in zip(result, expected):
+        assert emissions.total == expected_emissions.total
+        assert emissions.journeys == expected_emissions.journeys
+        assert emissions.distances == pytest.approx(
+            expected_emissions.distances, abs=1e-3)
+        assert emissions.emissions == pytest.approx(
+            expected_emissions.emissions, abs=1e-3)
+
+
+async def test_compute_frequencies(db_session, records_campaign):
+    from api.services.record_stats import RecordStatsService
+    from enacit4r_sql.utils.query import validate_params
+
+    filter = validate_params(
+        {"campaign_id": records_campaign}, None, None, None)["filter"]
+    result = await RecordStatsService(db_session).compute_frequencies(filter)
+
+    expected = StatsService().compute_stats(load_test_dataframe()).frequencies
+    assert len(result) == len(expected)
+    for freqs, expected_freqs in zip(result, expected):
+        assert_frequencies_same(freqs, expected_freqs)
+
+
+@pytest.mark.parametrize("travel_times", [
+    # float values, missing values, strings
+    {0: 7.5, 1: 7.5},
+    {0: None},
+    {0: "15", 1: 5.0, 2: True}
+])
+async def test_compute_travel_time_frequencies(db_session, records_campaign, travel_times):
+    from sqlmodel import select
+    from api.models.domain import Record
+    from api.services.record_stats import RecordStatsService
+    from api.services.records import RecordService
+    from enacit4r_sql.utils.query import validate_params
+
+    records = (await db_session.exec(
+        select(Record).where(Record.campaign_id == records_campaign, Record.completed).order_by(Record.id))).all()
+    for i, travel_time in travel_times.items():
+        data = {key: value for key, value in records[i].data.items() if key != 'travel_time'}
+        if travel_time is not None:
+            data['travel_time'] = travel_time
+        records[i].data = data
+        db_session.add(records[i])
+    await db_session.commit()
+
+    filter = validate_params(
+        {"campaign_id": records_campaign}, None, None, None)["filter"]
+    result = await RecordStatsService(db_session).compute_travel_time_frequencies(filter)
+    # statistics of the completed records loaded from the database, in id order
+    df = await RecordService(db_session).get_dataframe(filter, flat=True, completed=True)
+    df = df.sort_values('id', ignore_index=True)
+    expected = StatsService().compute_stats(df, ['frequencies']).frequencies
+    assert_frequencies_same(result, next(f for f in expected if f.field == 'travel_time'))
+
+
+@pytest.mark.parametrize("apply_reco", [False, True])
+async def test_compute_modes_emissions(db_session, records_campaign, apply_reco):
+    from api.services.record_stats import RecordStatsService
+    from enacit4r_sql.utils.query import validate_params
+
+    filter = validate_params(
+        {"campaign_id": records_campaign}, None, None, None)["filter"]
+    result = await RecordStatsService(db_session).compute_modes_emissions(filter, apply_reco)
+
+    stats = StatsService().compute_stats(load_test_dataframe())
+    expected = stats.reco_mode_emissions if apply_reco else stats.mode_emissions
+    assert len(expected) > 0
+    assert_emissions_same(result, expected)
@@ -0,0 +1,224 @@
+import asyncio
+import pandas as pd
+import pytest
+from api.models.query import LocationFilter
+from tests.conftest import requires_db
+from tests.test_snapshots import get_db_dataframe, to_csv
+
+pytestmark = [requires_db, pytest.mark.asyncio]
+
+# Geneva, with a hole around the most frequent workplace
+LOCATION_FILTER = LocationFilter.model_validate({
+    "$geoWithin": {
+        "$geometry": {
+            "type": "Polygon",
+            "coordinates": [
+                [[6.0, 46.1], [6.3, 46.1], [6.3, 46.4], [6.0, 46.4], [6.0, 46.1]],
+                [[6.143, 46.2098], [6.1434, 46.2098], [6.1434, 46.2100], [6.143, 46.2100], [6.143, 46.2098]]
+            ]
+        }
+    }
+})
+
+
+async def test_get_dataframe(db_session, records_campaign):
+    from sqlmodel import select
+    from api.models.domain import Record
+    from api.services.records import RecordService
+
+    service = RecordService(db_session)
+    records = (await db_session.exec(select(Record).where(Record.campaign_id == records_campaign))).all()
+    # same DataFrames as the hydrated records ones, dtypes included, loaded models columns order varies
+    for flat, derived in [(False, False), (True, False), (True, True)]:
+        df = await service.get_dataframe({"campaign_id": records_campaign}, flat=flat, derived=derived)
+        expected = service.to_dataframe(records, flat=flat, derived=derived)
+        pd.testing.assert_frame_equal(df.sort_values('id', ignore_index=True),
+                                      expected.sort_values('id', ignore_index=True),
+                                      check_like=True)
+    assert len(await service.get_dataframe({"campaign_id": records_campaign + 1}, flat=True)) == 0
+
+
+async def test_get_dataframe_location_filter(db_session, records_campaign):
+    from api.services.records import RecordService
+
+    service = RecordService(db_session)
+    df = await get_db_dataframe(db_session, records_campaign)
+    candidates = await service.get_dataframe({"campaign_id": records_campaign}, flat=True,
+                                             location_filter=LOCATION_FILTER)
+    # the records having their workplace in the bounding box only
+    lat = df['data.workplace.lat'].astype(float)
+    lon = df['data.workplace.lon'].astype(float)
+    in_bounds = lat.between(46.1, 46.4) & lon.between(6.0, 6.3)
+    assert 0 < len(candidates) < len(df)
+    assert sorted(candidates['id']) == sorted(df[in_bounds]['id'])
+    # same records once the exact filter applied
+    expected = service.filter_by_workplace_location(df, LOCATION_FILTER)
+    filtered = service.filter_by_workplace_location(candidates, LOCATION_FILTER)
+    assert len(filtered) < len(candidates)
+    assert sorted(filtered['id']) == sorted(expected['id'])
+    # the fields of the other records are missing
+    assert to_csv(filtered) == to_csv(expected[filtered.columns])
+
+    result = await service.find({"campaign_id": records_campaign}, fields=[], sort=[], range=[],
+                                location_filter=LOCATION_FILTER)
+    assert result.total == len(candidates)
+
+
+async def test_get_dataframe_location_filter_no_records(db_session, records_campaign):
+    from api.services.records import RecordService
+    from api.services.stats.stats import StatsService
+
+    # Lyon, no workplace in the bounding box
+    location_filter = LocationFilter.model_validate({
+        "$geoWithin": {
+            "$geometry": {
+                "type": "Polygon",
+                "coordinates": [[[4.8, 45.7], [4.9, 45.7], [4.9, 45.8], [4.8, 45.8], [4.8, 45.7]]]
+            }
+        }
+    })
+    service = RecordService(db_session)
+    df = await service.get_dataframe({"campaign_id": records_campaign}, flat=True,
+                                     location_filter=location_filter, completed=True)
+    assert len(df) == 0
+    df = service.filter_by_workplace_location(df, location_filter)
+    assert len(df) == 0
+    stats = StatsService().compute_stats(StatsService().compact_dataframe(df))
+    assert stats.total == 0
+
+
+async def test_backfill_derived(db_session, records_campaign):
+    from api.services.records import RecordService
+    from api.services.stats.commons import DERIVED_VERSION
+    from api.services.stats.stats import StatsService
+
+    service = RecordService(db_session)
+    df = await get_db_dataframe(db_session, records_campaign)
+    assert 'derived.version' not in df.columns
+    assert await service.backfill_derived(records_campaign, batch_size=7) == len(df)
+    assert await service.backfill_derived(records_campaign) == 0
+
+    df_derived = await service.get_dataframe({"campaign_id": records_campaign}, flat=True, derived=True)
+    assert (df_derived['derived.version'] == DERIVED_VERSION).all()
+    # the derived metrics are internal to the statistics, they are not exported
+    assert not (await get_db_dataframe(db_session, records_campaign)).columns.str.startswith('derived.').any()
+    # same metrics as computed when a record is written
+    record = await service.get(int(df_derived['id'].iloc[0]))
+    assert await service._get_derived(record) == record.derived
+    # statistics read the stored metrics, with the same results
+    assert StatsService().compute_stats(df_derived) == \
+        StatsService().compute_stats(df_derived[df.columns])
+
+
+async def test_generated_columns(db_session, records_campaign):
+    from sqlalchemy.sql import text
+    from sqlmodel import select
+    from api.models.domain import Record
+    from api.services.records import RecordService
+    from api.services.stats.stats import StatsService
+
+    service = RecordService(db_session)
+    df = await get_db_dataframe(db_session, records_campaign)
+    records = (await db_session.exec(
+        select(Record).where(Record.campaign_id == records_campaign))).all()
+    generated = pd.DataFrame([record.model_dump() for record in records]).set_index('id')
+    expected = df.set_index('id').loc[generated.index]
+    assert (generated['completed'] == expected['typo.reco.reco_dt2.0'].notna()).all()
+    assert generated['reco_primary'].equals(
+        expected['typo.reco.reco_dt2.0'].where(expected['typo.reco.reco_dt2.0'].notna(), None))
+    assert generated['data_version'].equals(
+        expected['data.version'].where(expected['data.version'].notna(), None))
+    assert generated['workplace_lat'].equals(expected['data.workplace.lat'].astype(float))
+
+    # completed records are filtered in the database
+    completed = StatsService()._filter_completed_records(df)
+    assert 0 < len(completed) < len(df)
+    assert await service.count_completed({"campaign_id": records_campaign}) == len(completed)
+    df_completed = await service.get_dataframe({"campaign_id": records_campaign}, flat=True, completed=True)
+    assert sorted(df_completed['id']) == sorted(completed['id'])
+    assert StatsService().compute_stats(df_completed) == StatsService().compute_stats(df)
+
+    # generated columns are read back when the record is written
+    record = records[0]
+    record.data = {**record.data, "workplace": {"lat": "46.5", "lon": "invalid"}}
+    db_session.add(record)
+    await db_session.commit()
+    assert record.workplace_lat == 46.5
+    assert record.workplace_lon is None
+
+    # out of range numbers are missing, they do not fail the write
+    record.data = {**record.data, "workplace": {"lat": "1e400", "lon": "-1e-400"}}
+    db_session.add(record)
+    await db_session.commit()
+    assert record.workplace_lat is None
+    assert record.workplace_lon is None
+    # JSON numbers are converted to text without exponent
+    await db_session.exec(text(
+        "UPDATE record SET data = jsonb_set(data, '{origin}', '{\"lat\": 1e400, \"lon\": 1e-400}') WHERE id = :id"
+    ).bindparams(id=record.id))
+    await db_session.commit()
+    await db_session.refresh(record)
+    assert record.origin_lat is None
+    assert record.origin_lon is None
+
+
+async def test_campaign_stats_writes(db_session, records_campaign):
+    from sqlmodel import select
+    from sqlmodel.ext.asyncio.session import AsyncSession
+    from api.models.domain import Record
+    from api.services.campaign_stats import CampaignStatsService, campaign_stats_rebuilds
+    from api.services.records import RecordService
+    from api.services.stats.accumulators import StatsAggregates
+
+    async def get_aggregates() -> StatsAggregates | None:
+        async with AsyncSession(db_session.bind) as session:
+            entity = await CampaignStatsService(session).get(records_campaign)
+            return StatsAggregates.from_dict(entity.data) if entity else None
+
+    async def get_completed_ids() -> list[int]:
+        res = await db_session.exec(
+            select(Record.id).where(Record.campaign_id == records_campaign, Record.completed).order_by(Record.id))
+        return res.all()
+
+    ids = await get_completed_ids()
+    # no aggregates yet, they are rebuilt in the background after the write
+    await RecordService(db_session).delete(ids[0])
+    assert await get_aggregates() is None
+    await campaign_stats_rebuilds.wait()
+    assert (await get_aggregates()).total == len(ids) - 1
+
+    # concurrent writes apply their deltas one after the other
+    async def delete(id: int):
+        async with AsyncSession(db_session.bind, expire_on_commit=False) as session:
+            await RecordService(session).delete(id)
+    await asyncio.gather(*[delete(id) for id in ids[1:5]])
+    assert (await get_aggregates()).total == len(ids) - 5
+
+    # stale aggregates are rebuilt instead of failing the write
+    await CampaignStatsService(db_session).save(records_campaign, (await db_session.get(Record, ids[5])).company_id,
+                                                StatsAggregates())
+    await db_session.commit()
+    await RecordService(db_session).delete(ids[5])
+    await campaign_stats_rebuilds.wait()
+    expected = await RecordService(db_session).compute_campaign_stats(records_campaign)
+    assert (await get_aggregates()).to_dict() == expected.to_dict()
+    assert expected.total == len(ids) - 6
+
+    # records without some fields have their deltas applied, as a rebuild computes them
+    for id in ids[6:9]:
+        record = await db_session.get(Record, id)
+        record.data = {key: value for key, value in record.data.items() if key not in ['travel_time', 'origin']}
+        db_session.add(record)
+    await db_session.commit()
+    await RecordService(db_session).rebuild_campaign_stats(records_campaign, record.company_id)
+    await db_session.commit()
+    for id in ids[6:8]:
+        await RecordService(db_session).delete(id)
+    aggregates = await get_aggregates()
+    assert aggregates is not None
+    expected = await RecordService(db_session).compute_campaign_stats(records_campaign)
+    assert aggregates.total == expected.total == len(ids) - 8
+    assert aggregates.frequencies.to_dict() == expected.frequencies.to_dict()
+    assert aggregates.mode_emissions.modes.keys() == expected.mode_emissions.modes.keys()
+    for mode, entry in expected.mode_emissions.modes.items():
+        assert aggregates.mode_emissions.modes[mode] == pytest.approx(entry)
@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+import pytest
+from api.services.stats.stats import StatsService, get_section_columns
+from tests.conftest import requires_db
+
+pytestmark = [requires_db, pytest.mark.asyncio]
+
+
+def to_csv(df: pd.DataFrame) -> str:
+    """Records as CSV, in id and column names order"""
+    if 'id' in df.columns:
+        df = df.sort_values('id', ignore_index=True)
+    return df[sorted(df.columns)].to_csv(index=False)
+
+
+async def get_db_dataframe(session, campaign_id: int) -> pd.DataFrame:
+    from api.services.records import RecordService
+    return await RecordService(session).get_dataframe({"campaign_id": campaign_id}, flat=True)
+
+
+async def test_get_dataframe(db_session, records_campaign, tmp_path):
+    from api.services.snapshots import RecordSnapshotService
+
+    service = RecordSnapshotService(db_session, str(tmp_path))
+    df = await service.get_dataframe({"campaign_id": records_campaign})
+    expected = await get_db_dataframe(db_session, records_campaign)
+    assert to_csv(df) == to_csv(expected)
+    # snapshots are sorted by id, the order of values having the same count follows the records order
+    expected = expected.sort_values('id', ignore_index=True)
+    assert StatsService().compute_stats(df).frequencies == \
+        StatsService().compute_stats(expected[df.columns]).frequencies
+
+    columns = get_section_columns(['frequencies'])
+    df = await service.get_dataframe({"campaign_id": records_campaign}, columns)
+    assert to_csv(df) == to_csv(
+        StatsService().select_columns(expected, ['frequencies']))
+
+
+async def test_get_dataframe_not_supported(db_session, records_campaign, tmp_path):
+    from api.services.snapshots import RecordSnapshotService
+
+    service = RecordSnapshotService(db_session, str(tmp_path))
+    assert await service.get_dataframe({"token": "abc"}) is None
+    assert await service.get_dataframe({"campaign_id": records_campaign, "token": "abc"}) is None
+    assert await RecordSnapshotService(db_session, "").get_dataframe({"campaign_id": records_campaign}) is None
+
+
+async def test_refresh(db_session, records_campaign, tmp_path):
+    from sqlmodel import select
+    from api.models.domain import Record
+    from api.services.snapshots import RecordSnapshotService
+
+    service = RecordSnapshotService(db_session, str(tmp_path))
+    await service.refresh(records_campaign)
+
+    records = (await db_session.exec(
+        select(Record).where(Record.campaign_id == records_campaign).order_by(Record.id))).all()
+    updated_at = datetime.now(timezone.utc) + timedelta(seconds=1)
+    # updated, deleted and added records
+    records[0].data = {**records[0].data, "age_class": "updated"}
+    records[0].updated_at = updated_at
+    db_session.add(records[0])
+    await db_session.delete(records[1])
+    db_session.add(Record(token="added", data={"age_class": "added"}, campaign_id=records_campaign,
+                          company_id=records[0].company_id, created_at=updated_at, updated_at=updated_at))
+    await db_session.commit()
+
+    df = await service.get_dataframe({"campaign_id": records_campaign})
+    expected = await get_db_dataframe(db_session, records_campaign)
+    assert len(df) == len(records)
+    assert to_csv(df) == to_csv(expected)
+    ages = df.set_index('token')['data.age_class']
+    assert ages[records[0].token] == "updated"
+    assert ages["added"] == "added"
+    assert records[1].token not in ages.index
+
+
+async def test_refresh_back_dated(db_session, records_campaign, tmp_path):
+    from sqlmodel import select
+    from api.models.domain import Record
+    from api.services.snapshots import RecordSnapshotService
+
+    service = RecordSnapshotService(db_session, str(tmp_path))
+    await service.refresh(records_campaign)
+
+    records = (await db_session.exec(
+        select(Record).where(Record.campaign_id == records_campaign).order_by(Record.id))).all()
+    # written after the snapshot, with an update time set before it (e.g. a transaction committed late)
+    updated_at = datetime(2000, 1, 1, tzinfo=timezone.utc)
+    records[0].data = {**records[0].data, "age_class": "updated"}
+    records[0].updated_at = updated_at
+    db_session.add(records[0])
+    db_session.add(Record(token="added", data={"age_class": "added"}, campaign_id=records_campaign,
+                          company_id=records[0].company_id, created_at=updated_at, updated_at=updated_at))
+    await db_session.commit()
+
+    df = await service.get_dataframe({"campaign_id": records_campaign})
+    expected = await get_db_dataframe(db_session, records_campaign)
+    assert to_csv(df) == to_csv(expected)
+    ages = df.set_index('token')['data.age_class']
+    assert ages[records[0].token] == "updated"
+    assert ages["added"] == "added"
+
+
+async def test_get_dataframe_mixed_types(db_session, records_campaign, tmp_path):
+    from sqlmodel import select
+    from api.models.domain import Record
+    from api.services.snapshots import RecordSnapshotService
+
+    records = (await db_session.exec(
+        select(Record).where(Record.campaign_id == records_campaign).order_by(Record.id))).all()
+    # values of a field having different types across records
+    for record, travel_time in zip(records, ["15", 5, True, 7.5]):
+        record.data = {**record.data, "travel_time": travel_time}
+        db_session.add(record)
+    await db_session.commit()
+
+    service = RecordSnapshotService(db_session, str(tmp_path))
+    df = await service.get_dataframe({"campaign_id": records_campaign})
+    expected = await get_db_dataframe(db_session, records_campaign)
+    expected = expected.sort_values('id', ignore_index=True)
+    # values keep their types
+    assert df['data.travel_time'].tolist()[:4] == ["15", 5, True, 7.5]
+    # missing values are None in the snapshot, and NaN or None in the loaded records
+    def nulls_as_none(df: pd.DataFrame) -> pd.DataFrame:
+        return df.astype(object).where(df.notna(), None)
+    pd.testing.assert_frame_equal(nulls_as_none(df), nulls_as_none(expected[df.columns]))
@@ -1,9 +1,15 @@
+import asyncio
+import json
 import pandas as pd
+import pytest
 from api.services.stats.links import LinksService
-from api.services.stats.stats import StatsService
+from api.services.stats.stats import SECTIONS, StatsService
 from api.models.query import Emissions, Frequencies, Frequency, Link, Links
 from api.services.stats.frequencies import FrequenciesService
 from api.services.stats.emissions import EmissionsService
+from api.services.stats.commons import DERIVED_VERSION, StatsContext, calculate_distances, calculate_distances_to_h3, compute_derived, distance_to_h3
+from api.services.stats.singleflight import SingleFlight
+from api.services.stats.accumulators import EmissionsAccumulator, FrequenciesAccumulator, InconsistentAggregatesError, LinksAccumulator, StatsAggregates
 
 
 def assert_frequencies_equal(result: Frequencies, expected: Frequencies):
@@ -18,7 +24,7 @@ def assert_frequencies_equal(result: Frequencies, expected: Frequencies):
 
 
 def assert_emissions_equal(result: Emissions, expected: Emissions):
-    assert result.field == expected.field
+    assert result.mode == expected.mode
     assert result.total == expected.total
     assert result.distances == expected.distances
     assert result.journeys == expected.journeys
@@ -200,6 +206,124 @@ def test_compute_modes_frequencies():
         assert_frequencies_equal(res_freqs, exp_freqs)
 
 
+def test_stats_context():
+    # Load the test CSV into a DataFrame
+    df = load_test_dataframe()
+    context = StatsContext(df)
+
+    assert len(context.df_v1) == 23
+    assert len(context.df_v2) == 7
+    # derived columns do not modify the records
+    assert 'distance_km' in context.derived.columns
+    assert 'distance_km' not in df.columns
+    assert list(context.journeys_columns.keys()) == [0, 1, 2]
+    assert context.journeys_columns[1] == {
+        'days': 'data.freq_mod_journeys.1.days',
+        'modes': ['data.freq_mod_journeys.1.modes.0', 'data.freq_mod_journeys.1.modes.1', 'data.freq_mod_journeys.1.modes.2']
+    }
+    assert context.pro_journeys_columns[3] == {
+        'days': 'data.freq_mod_pro_journeys.3.days',
+        'mode': 'data.freq_mod_pro_journeys.3.mode',
+        'hex_id': 'data.freq_mod_pro_journeys.3.hex_id'
+    }
+    assert list(context.reco_pros_columns.keys()) == [0, 1, 2]
+    # services share the same context
+    service = FrequenciesService(df, context)
+    assert service._get_records_v2() is context.df_v2
+
+
+def test_explode_journeys():
+    # Load the test CSV into a DataFrame
+    df = load_test_dataframe()
+    service = FrequenciesService(df)
+    journeys = service.context.journeys
+
+    assert journeys.columns.tolist() == [
+        'record', 'journey_idx', 'mode', 'days', 'is_intermodal']
+    # a mode is counted once per journey
+    assert not journeys.duplicated(['record', 'journey_idx', 'mode']).any()
+    assert set(journeys['record']).issubset(set(df.index))
+    # intermodal journeys have more than one mode, walking excluded
+    inter = journeys[journeys['mode'] != 'walking'].groupby(
+        ['record', 'journey_idx'])['mode'].nunique() > 1
+    flags = journeys.groupby(['record', 'journey_idx'])['is_intermodal'].first()
+    assert (flags.reindex(inter.index) == inter).all()
+
+
+def test_melt_pro_journeys():
+    # Load the test CSV into a DataFrame
+    df = load_test_dataframe()
+    service = FrequenciesService(df)
+    journeys = service.context.pro_journeys
+
+    assert journeys.columns.tolist() == [
+        'record', 'journey_idx', 'mode', 'days', 'distance_km', 'distance_type']
+    assert set(journeys['record']).issubset(set(service.context.df_v2.index))
+    assert journeys['journey_idx'].is_monotonic_increasing
+    assert set(journeys['distance_type']) <= {
+        'local', 'national', 'europe', 'inter'}
+    assert (journeys[journeys['distance_type'] == 'local']['distance_km'] < 20).all()
+    assert (journeys[journeys['distance_type'] == 'inter']['distance_km'] >= 1500).all()
+
+
+def test_calculate_distances_to_h3():
+    # Paris cell, and the cell of the location
+    h3_index = '851fb467fffffff'
+    same_index = '851f826ffffffff'
+    lat = pd.Series([46.5, 46.5, 46.5, 46.5, None, 46.5, 46.5])
+    lon = pd.Series([6.6, 6.6, 6.6, 6.6, 6.6, 6.6, 6.6])
+    cells = pd.Series([h3_index, h3_index, h3_index, same_index,
+                      h3_index, None, 'invalid'])
+    modes = pd.Series(['train', 'car', 'walking', 'walking',
+                      'train', 'train', 'train'])
+    distance_km, detour = distance_to_h3(46.5, 6.6, h3_index)
+    assert detour and 400 < distance_km < 500
+    edge_km, detour = distance_to_h3(46.5, 6.6, same_index)
+    assert not detour and edge_km > 0
+
+    distances = calculate_distances_to_h3(lat, lon, cells, modes)
+    # modes without detour coefficient and invalid locations or cells have no distance
+    assert distances.tolist() == [
+        distance_km * 1.22, distance_km * 1.22, 0, edge_km, 0, 0, 0]
+
+
+def with_derived(df: pd.DataFrame, derived: list[dict]) -> pd.DataFrame:
+    """Add derived metrics to flattened records"""
+    df_derived = pd.json_normalize(derived).set_axis(
+        df.index).add_prefix('derived.')
+    return pd.concat([df, df_derived], axis=1)
+
+
+def test_compute_derived():
+    # Load the test CSV into a DataFrame
+    df = load_test_dataframe()
+    derived = compute_derived(df)
+
+    assert len(derived) == len(df)
+    assert all(item['version'] == DERIVED_VERSION for item in derived)
+    context = StatsContext(df)
+    assert [item['distance_km'] for item in derived] == \
+        [None if pd.isna(value) else value for value in context.derived['distance_km']]
+    journeys = context.pro_journeys.dropna(subset=['days'])
+    assert sum(len(item['pro_journeys']) for item in derived) == len(journeys)
+
+    # statistics read the stored metrics, with the same results
+    df_derived = with_derived(df, derived)
+    assert StatsService().compute_stats(df_derived) == StatsService().compute_stats(df)
+    derived[0]['distance_km'] = 1234.5
+    assert StatsContext(with_derived(df, derived)).derived['distance_km'].iloc[0] == 1234.5
+    record, journey_idx = journeys[['record', 'journey_idx']].iloc[0]
+    derived[df.index.get_loc(record)]['pro_journeys'][str(journey_idx)] = {
+        'distance_km': 5000.0, 'distance_type': 'inter'}
+    stored = StatsContext(with_derived(df, derived)).pro_journeys.set_index(['record', 'journey_idx'])
+    assert stored.loc[(record, journey_idx), 'distance_km'] == 5000.0
+    assert stored.loc[(record, journey_idx), 'distance_type'] == 'inter'
+    # metrics of a previous version are computed again
+    derived[0]['version'] = DERIVED_VERSION - 1
+    assert StatsContext(with_derived(df, derived)).derived['distance_km'].iloc[0] == \
+        context.derived['distance_km'].iloc[0]
+
+
 def test_compute_modes_pro_frequencies():
     # Load the test CSV into a DataFrame
     df = load_test_dataframe()
@@ -277,6 +401,23 @@ def test_compute_modes_pro_frequencies():
         assert_frequencies_equal(res_freqs, exp_freqs)
 
 
+def test_calculate_distances():
+    # Load the test CSV into a DataFrame
+    df = load_test_dataframe()
+    df.loc[df.index[0], 'data.origin.lat'] = None
+    service = EmissionsService(df)
+    distances = service._get_distances_home_to_work()
+
+    assert len(distances) == len(df)
+    # missing coordinates give NaN distance
+    assert pd.isna(distances.iloc[0])
+    assert (distances.iloc[1:] >= 0).all()
+    # Geneva Cornavin to Lausanne station, with the real distance factor
+    lausanne = calculate_distances(
+        pd.Series([46.2101]), pd.Series([6.1424]), pd.Series([46.5167]), pd.Series([6.6291]))
+    assert round(lausanne[0] / 1.3) == 51
+
+
 def test_compute_modes_emissions():
     # Load the test CSV into a DataFrame
     df = load_test_dataframe()
@@ -285,17 +426,17 @@ def test_compute_modes_emissions():
 
     # print(result)
     expected = [
-        Emissions(field='bike', total=30, distances=6728.72,
+        Emissions(mode='bike', total=30, distances=6728.72,
                   journeys=2430, emissions=151.304),
-        Emissions(field='pub', total=30, distances=20859.321,
+        Emissions(mode='pub', total=30, distances=20859.321,
                   journeys=3690, emissions=2243.077),
-        Emissions(field='moto', total=30, distances=6837.789,
+        Emissions(mode='moto', total=30, distances=6837.789,
                   journeys=1620, emissions=2469.62),
-        Emissions(field='carpool', total=30, distances=4605.723,
+        Emissions(mode='carpool', total=30, distances=4605.723,
                   journeys=270, emissions=214.166),
-        Emissions(field='car', total=30, distances=15839.606,
+        Emissions(mode='car', total=30, distances=15839.606,
                   journeys=2970, emissions=15023.343),
-        Emissions(field='train', total=30, distances=2122.997,
+        Emissions(mode='train', total=30, distances=2122.997,
                   journeys=1080, emissions=82.563)
     ]
     assert len(result) == len(expected)
@@ -303,6 +444,32 @@ def test_compute_modes_emissions():
         assert_emissions_equal(res_emission, exp_emission)
 
 
+def test_compute_modes_reco_emissions():
+    # Load the test CSV into a DataFrame
+    df = load_test_dataframe()
+    service = EmissionsService(df)
+    result = service.compute_modes_emissions(apply_reco=True)
+
+    # print(result)
+    expected = [
+        Emissions(mode='carpool', total=30, distances=1413.548,
+                  journeys=3780, emissions=4110.244),
+        Emissions(mode='elec', total=30, distances=485.009,
+                  journeys=1620, emissions=5130.162),
+        Emissions(mode='bike', total=30, distances=12.472,
+                  journeys=450, emissions=5.612),
+        Emissions(mode='train', total=30, distances=117.626,
+                  journeys=1620, emissions=192.787),
+        Emissions(mode='inter', total=30, distances=1478.478,
+                  journeys=1080, emissions=3880.854),
+        Emissions(mode='pub', total=30, distances=20290.966,
+                  journeys=2160, emissions=303.365)
+    ]
+    assert len(result) == len(expected)
+    for res_emission, exp_emission in zip(result, expected):
+        assert_emissions_equal(res_emission, exp_emission)
+
+
 def test_compute_modes_pro_emissions():
     # Load the test CSV into a DataFrame
     df = load_test_dataframe()
@@ -311,15 +478,15 @@ def test_compute_modes_pro_emissions():
 
     # print(result)
     expected = [
-        Emissions(field='bike', total=7, distances=153.654,
+        Emissions(mode='bike', total=7, distances=153.654,
                   journeys=2, emissions=0.922),
-        Emissions(field='moto', total=7, distances=546.692,
+        Emissions(mode='moto', total=7, distances=546.692,
                   journeys=4, emissions=84.737),
-        Emissions(field='car', total=7, distances=1259.281,
+        Emissions(mode='car', total=7, distances=1259.281,
                   journeys=6, emissions=234.226),
-        Emissions(field='train', total=7, distances=5651.081,
+        Emissions(mode='train', total=7, distances=5651.081,
                   journeys=22, emissions=45.209),
-        Emissions(field='plane', total=7, distances=41811.232,
+        Emissions(mode='plane', total=7, distances=41811.232,
                   journeys=10, emissions=10996.354)
     ]
     assert len(result) == len(expected)
@@ -389,3 +556,172 @@ def test_compute_mode_reco_pro_links():
         ]
     )
     assert_links_equal(result, expected)
+
+
+def test_accumulators_merge():
+    # Split the records in two partitions: merged partial results equal the whole results
+    df = load_test_dataframe()
+    df_a, df_b = df.iloc[:15].copy(), df.iloc[15:].copy()
+
+    links = LinksService(df_a)._compute_mode_reco_links_v2(
+        StatsContext(df_a).df_v2)
+    links.merge(LinksService(df_b)._compute_mode_reco_links_v2(
+        StatsContext(df_b).df_v2))
+    expected = LinksService(df)._compute_mode_reco_links_v2(
+        StatsContext(df).df_v2)
+    assert links.total == expected.total
+    assert links.links == expected.links
+
+    frequencies = FrequenciesAccumulator()
+    frequencies.add('car', '1', 2, 2)
+    frequencies.add_field('bike')
+    other = FrequenciesAccumulator()
+    other.add('car', '1', 1, 1)
+    other.add('car', '3', 1, 3)
+    result = frequencies.merge(other).to_frequencies(10)
+    assert_frequencies_equal(result[0], Frequencies(
+        field='car', total=10, data=[Frequency(value='1', count=3, sum=3), Frequency(value='3', count=1, sum=3)]))
+    assert_frequencies_equal(
+        result[1], Frequencies(field='bike', total=10, data=[]))
+
+    empty = LinksAccumulator(3)
+    assert empty.merge(LinksAccumulator(2)).to_links().total == 5
+
+
+def test_emissions_accumulator_retract():
+    emissions = EmissionsAccumulator()
+    emissions.add('car', 0.1, 1, 0.3)
+    emissions.add('car', 0.2, 1, 0.6)
+    record = EmissionsAccumulator()
+    record.add('car', 0.2, 1, 0.6)
+    # sums rounded differently are retracted
+    assert emissions.retract(record).modes['car'] == pytest.approx([0.1, 1, 0.3])
+
+    # retracting a mode not merged, or a record twice, is detected
+    other = EmissionsAccumulator()
+    other.add('train', 10, 1, 0.1)
+    with pytest.raises(InconsistentAggregatesError):
+        emissions.retract(other)
+    with pytest.raises(InconsistentAggregatesError):
+        emissions.retract(record)
+
+
+def canonical_stats(stats) -> dict:
+    """Stats as a dict with entries sorted and floats rounded, for order insensitive comparison."""
+    def canonical(obj):
+        if isinstance(obj, dict):
+            return {key: canonical(value) for key, value in obj.items()}
+        if isinstance(obj, list):
+            return sorted((canonical(item) for item in obj), key=repr)
+        if isinstance(obj, float):
+            return round(obj, 2)
+        return obj
+    return canonical(stats.model_dump())
+
+
+def test_stats_aggregates():
+    # Aggregates of each record, as written one by one, sum up to the aggregates of all records
+    df = load_test_dataframe()
+    service = StatsService()
+    expected = service.compute_stats(df)
+
+    aggregates = StatsAggregates()
+    records = []
+    for i in range(len(df)):
+        # a single record has only its non empty columns
+        record = service.compute_aggregates(
+            df.iloc[[i]].dropna(axis=1, how='all'))
+        records.append(record)
+        aggregates.merge(record)
+    # persisted as JSON
+    aggregates = StatsAggregates.from_dict(
+        json.loads(json.dumps(aggregates.to_dict())))
+    assert canonical_stats(aggregates.to_stats()) == canonical_stats(expected)
+
+    # Retract a completed v2 record
+    i = df[df['data.version'].notna() & df['typo.reco.reco_dt2.0'].notna()].index[0]
+    aggregates.retract(records[i])
+    expected = service.compute_stats(df.drop(index=i))
+    assert aggregates.total == expected.total
+    assert canonical_stats(aggregates.to_stats()) == canonical_stats(expected)
+
+    # Retracting a record not merged, or twice, is detected
+    with pytest.raises(InconsistentAggregatesError):
+        StatsAggregates().retract(records[i])
+    with pytest.raises(InconsistentAggregatesError):
+        aggregates.retract(records[i])
+
+
+def test_stats_aggregates_missing_fields():
+    # Records without travel time, origin or workplace, their aggregates sum up to a full rebuild
+    df = load_test_dataframe()
+    completed = df.index[df['typo.reco.reco_dt2.0'].notna()]
+    df.loc[completed[0], 'data.travel_time'] = None
+    df.loc[completed[1], 'data.travel_time'] = 7.5
+    df.loc[completed[2], ['data.origin.lat', 'data.origin.lon']] = None
+    df.loc[completed[3], ['data.workplace.lat', 'data.workplace.lon']] = None
+    service = StatsService()
+    expected = service.compute_stats(df)
+
+    aggregates = StatsAggregates()
+    for i in range(len(df)):
+        aggregates.merge(service.compute_aggregates(
+            df.iloc[[i]].dropna(axis=1, how='all')))
+    assert canonical_stats(aggregates.to_stats()) == canonical_stats(expected)
+    # integral travel times are formatted as integers, also in a column of floats
+    travel_times = next(f for f in expected.frequencies if f.field == 'travel_time')
+    assert {f.value for f in travel_times.data} >= {'5', '7.5'}
+
+
+def test_compute_stats_sections():
+    df = pd.read_csv('tests/data/records.csv')
+    service = StatsService()
+    expected = service.compute_stats(df.copy()).model_dump()
+
+    for section in SECTIONS:
+        # a section is computed from its own columns only
+        df_section = service.select_columns(df, [section])
+        assert len(df_section.columns) < len(df.columns)
+        result = service.compute_stats(df_section.copy(), [section]).model_dump()
+        assert result['total'] == expected['total']
+        assert result[section] == expected[section]
+        assert all(result[other] is None for other in SECTIONS if other != section)
+
+
+def test_compact_dataframe():
+    df = pd.read_csv('tests/data/records.csv')
+    service = StatsService()
+    compact = service.compact_dataframe(df)
+    assert compact.memory_usage(deep=True).sum() < df.memory_usage(deep=True).sum()
+    assert compact['data.equipments.0'].dtype == 'category'
+    assert compact['typo.reco.reco_dt2.0'].dtype == 'category'
+    assert compact['data.freq_mod_journeys.0.days'].dtype == 'Int16'
+    assert compact['data.workplace.lat'].dtype == 'float32'
+    # other columns are unchanged
+    assert compact['token'].equals(df['token'])
+
+    # statistics are the same, with coordinates of float32 precision
+    coordinates = [col for col in df.columns if col.startswith(
+        ('data.origin.l', 'data.workplace.l'))]
+    df[coordinates] = df[coordinates].astype('float32').astype('float64')
+    assert service.compute_stats(compact).model_dump() == \
+        service.compute_stats(df).model_dump()
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    flight = SingleFlight()
+    computations = []
+
+    async def compute():
+        computations.append(1)
+        count = len(computations)
+        await asyncio.sleep(0.01)
+        return count
+
+    # concurrent calls with the same key share one computation
+    results = await asyncio.gather(*[flight.do('a', compute) for _ in range(3)], flight.do('b', compute))
+    assert results == [1, 1, 1, 2]
+    assert flight.info() == {'calls': 4, 'coalesced': 2, 'inflight': 0}
+    # once done, the computation is run again
+    assert await flight.do('a', compute) == 3